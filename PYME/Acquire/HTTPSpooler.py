@@ -178,16 +178,25 @@ class Spooler(sp.Spooler):
                     self._numThreadsProcessing += 1
 
                 try:
-                    files = []
+                    # encode all the frames into a single buffer (sized for uncompressed frames, which is an upper
+                    # bound for everything but pathological data), and send views onto it.
+                    buf = bytearray(sum([PZFFormat.HEADER_LENGTH_V3 + frame.nbytes for imNum, frame in data]))
+                    spans = []
+                    end = 0
                     for imNum, frame in data:
                         if self._aggregate_h5:
                             fn = '/'.join(['__aggregate_h5', self.seriesName, 'frame%05d.pzf' % imNum])
                         else:
                             fn = '/'.join([self.seriesName, 'frame%05d.pzf' % imNum])
-                            
-                        pzf = PZFFormat.dumps(frame, sequenceID=self.sequenceID, frameNum = imNum, **self.compSettings)
-
-                        files.append((fn, pzf))
+                        
+                        start = end
+                        end = PZFFormat.dumps_into(buf, frame, offset=start, sequenceID=self.sequenceID, frameNum = imNum, **self.compSettings)
+
+                        spans.append((fn, start, end))
+                    
+                    # NB - only take views once everything is encoded, as dumps_into might need to resize buf
+                    bv = memoryview(buf)
+                    files = [(fn, bv[start:end]) for fn, start, end in spans]
 
                     if len(files) > 0:
                         clusterIO.put_files(files, serverfilter=self.clusterFilter)
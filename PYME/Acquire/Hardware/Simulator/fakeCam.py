@@ -182,6 +182,9 @@ class compThread(threading.Thread):
         self.bufferWritePos = 0
         self.bufferReadPos = 0
         self.numBufferedImages = 0
+        # protects the buffer counters (which are modified from both this thread and the camera thread) and lets us
+        # wake up as soon as space becomes available in the buffer
+        self._bufferCond = threading.Condition()
 
         self.biplane = biplane
         self.deltaZ = biplane_z
@@ -257,8 +260,12 @@ class compThread(threading.Thread):
 
         while not self.kill:
             #self.frameLock.acquire()
-            while ((not self.aqRunning) or (self.numBufferedImages > self.bufferlength/2.)) and (not self.kill) :
-                time.sleep(.01)
+            with self._bufferCond:
+                while ((not self.aqRunning) or (self.numBufferedImages > self.bufferlength/2.)) and (not self.kill) :
+                    self._bufferCond.wait(.01)
+                    
+            if self.kill:
+                break
 
             zPos = (self.zPiezo.GetPos() - self.zOffset)*1e3
 
@@ -287,27 +294,30 @@ class compThread(threading.Thread):
             _im = self.noiseMaker.noisify(r_i)
             self.im = _im.astype('uint16')
 
-            self.buffer[self.bufferWritePos,:,:] = self.im
-            self.bufferWritePos +=1
-            if self.bufferWritePos >= self.bufferlength: #wrap around
-                self.bufferWritePos = 0
-
-            self.numBufferedImages = min(self.numBufferedImages +1, self.bufferlength)
-
-
-            if not self.contMode:
-                self.aqRunning = False
-
-            if self.stopAq:
-                self.aqRunning = False
-                self.bufferWritePos = 0
-                self.bufferReadPos = 0
-                self.numBufferedImages = 0
-                self.stopAq = False
-
-            if self.startAq:
-                self.aqRunning = True
-                self.startAq = False
+            with self._bufferCond:
+                self.buffer[self.bufferWritePos,:,:] = self.im
+                self.bufferWritePos +=1
+                if self.bufferWritePos >= self.bufferlength: #wrap around
+                    self.bufferWritePos = 0
+    
+                self.numBufferedImages = min(self.numBufferedImages +1, self.bufferlength)
+    
+    
+                if not self.contMode:
+                    self.aqRunning = False
+    
+                if self.stopAq:
+                    self.aqRunning = False
+                    self.bufferWritePos = 0
+                    self.bufferReadPos = 0
+                    self.numBufferedImages = 0
+                    self.stopAq = False
+    
+                if self.startAq:
+                    self.aqRunning = True
+                    self.startAq = False
+                    
+                self._bufferCond.notify_all()
 
             #self.frameLock.release()
 
@@ -315,19 +325,25 @@ class compThread(threading.Thread):
         return self.numBufferedImages
 
     def StartExp(self):
-        self.bufferWritePos = 0
-        self.bufferReadPos = 0
-        self.numBufferedImages = 0
-        self.aqRunning = True
-        self.startAq = True
+        with self._bufferCond:
+            self.bufferWritePos = 0
+            self.bufferReadPos = 0
+            self.numBufferedImages = 0
+            self.aqRunning = True
+            self.startAq = True
+            self._bufferCond.notify_all()
         #self.frameLock.release()
 
     def getIm(self):
-        im = np.copy(self.buffer[self.bufferReadPos,:,:], order='F')
-        self.numBufferedImages -= 1
-        self.bufferReadPos +=1
-        if self.bufferReadPos >= self.bufferlength: #wrap around
-            self.bufferReadPos = 0
+        with self._bufferCond:
+            im = np.copy(self.buffer[self.bufferReadPos,:,:], order='F')
+            self.numBufferedImages -= 1
+            self.bufferReadPos +=1
+            if self.bufferReadPos >= self.bufferlength: #wrap around
+                self.bufferReadPos = 0
+                
+            # wake the render loop if it was waiting for space in the buffer
+            self._bufferCond.notify_all()
 
         return im
 
@@ -27,6 +27,7 @@ from numpy.fft import ifftshift, fftn, ifftn
 from . import fluor
 from PYME.Analysis import MetaData
 from PYME.localization import cInterp
+from PYME.misc import thread_pools
 
 try:
     import cPickle as pickle
@@ -505,6 +506,12 @@ def _rFluorSubset(im, fl, A, x0, y0, z, dx, dy, dz, maxz, ChanXOffsets=[0,], Cha
                                         z_, A * fl['spec'][:, spec_chan], roiSize, dx, dy, dz)
 
 
+def _rFluorSubsetIm(shape, *args):
+    """Render a subset of fluorophores into a new image (so that threads don't write into the same image concurrently)"""
+    im = zeros(shape, 'f')
+    _rFluorSubset(im, *args)
+    return im
+
 def simPalmImFI(X,Y, z, fluors, intTime=.1, numSubSteps=10, roiSize=100, laserPowers = [.1,1], position=[0,0,0], illuminationFunction='ConstIllum', ChanXOffsets=[0,], ChanZOffsets=[0,], ChanSpecs = None):
     if interpModel() is None:
         genTheoreticalModel(mdh)
@@ -514,13 +521,14 @@ def simPalmImFI(X,Y, z, fluors, intTime=.1, numSubSteps=10, roiSize=100, laserPo
     if fluors is None:
         return im
     
-    A = zeros(len(fluors.fl), 'f')
-    
-    for n  in range(numSubSteps):
-        A += fluors.illuminate(laserPowers,intTime/numSubSteps, position=position, illuminationFunction=illuminationFunction)
+    if hasattr(fluors, 'illuminate_substeps'):
+        A = fluors.illuminate_substeps(laserPowers, intTime, numSubSteps, position=position,
+                                       illuminationFunction=illuminationFunction)
+    else:
+        A = zeros(len(fluors.fl), 'f')
+        for n  in range(numSubSteps):
+            A += fluors.illuminate(laserPowers,intTime/numSubSteps, position=position, illuminationFunction=illuminationFunction)
 
-    flOn = where(A > 0.1)[0]
-    
     dx = X[1] - X[0]
     dy = Y[1] - Y[0]
     
@@ -534,27 +542,18 @@ def simPalmImFI(X,Y, z, fluors, intTime=.1, numSubSteps=10, roiSize=100, laserPo
     fl = fluors.fl[m]
     A2 = A[m]
     
-    #z2 = np.minimum(np.maximum(z - fl['z'], -maxz), maxz)#.astype('f')
+    # split the fluorophores between the threads of the shared compute pool, each of which renders into its own image
+    nChunks = int(min(thread_pools.COMPUTE_THREADS, len(A2)))
     
-    #roiS = np.minimum(3 + np.abs(z2)*(2.5/70), 100).astype('i')
-    #roiS = np.minimum(8 + np.abs(z2)*(2.5/70), 140).astype('i')
-
-    
-    nCPUs = int(min(multiprocessing.cpu_count(), len(flOn)))
-    
-    if nCPUs > 0:
-        threads = [threading.Thread(target = _rFluorSubset, args=(im, fl[i::nCPUs], A2[i::nCPUs], x0, y0, z, dx, dy, dz, maxz, ChanXOffsets, ChanZOffsets, ChanSpecs)) for i in range(nCPUs)]
-    
-        for p in threads:
-            p.start()
-    
-        for p in threads:
-            p.join()
-
-    #for i in flOn:
-    #    x = fluors.fl['x'][i] #+ position[0]
-    #    y = fluors.fl['y'][i] #+ position[1]
-    #    cInterp.InterpolateInplace(interpModel, im, x - x0, y - y0, min(max(z - fluors.fl['z'][i], -maxz), maxz-dz), roiSize, roiSize,dx,dy,dz, A[i])
+    if nChunks == 1:
+        _rFluorSubset(im, fl, A2, x0, y0, z, dx, dy, dz, maxz, ChanXOffsets, ChanZOffsets, ChanSpecs)
+    elif nChunks > 1:
+        ims = thread_pools.parallel_map(lambda i: _rFluorSubsetIm(im.shape, fl[i::nChunks], A2[i::nChunks], x0, y0, z,
+                                                                  dx, dy, dz, maxz, ChanXOffsets, ChanZOffsets,
+                                                                  ChanSpecs),
+                                        range(nChunks))
+        for im_i in ims:
+            im += im_i
 
     return im
 
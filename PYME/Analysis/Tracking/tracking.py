@@ -9,17 +9,41 @@ import numpy as np
 from scipy import spatial
 from six.moves import xrange
 
+def linkages_by_object(linkages):
+    """
+    Convert the linkages returned by `Tracker.calcLinkages` to a dictionary of {k : (lj, lp)}, with the candidate
+    links for each object k in the current frame (most probable first), as used by older versions of calcLinkages.
+    """
+    k, lj, lp = linkages
+    if len(k) == 0:
+        return {}
+    
+    starts = np.flatnonzero(np.hstack([True, k[1:] != k[:-1]]))
+    ends = np.hstack([starts[1:], len(k)])
+    return {int(k[s]): (lj[s:e], lp[s:e]) for s, e in zip(starts, ends)}
+
 #rt = [np.vstack([x[t==i], y[t == i]]) for i in range(t.max() + 1)]
 #ind_t = [index[t == i]]
 
 class Tracker(object):
-    def __init__(self, t, xvs, pNew=0.2, r0=500, linkageCuttoffProb=0.1):
+    """
+    Frame to frame linkage of objects (e.g. single particle tracking).
+
+    Objects are grouped by frame once, with a single sort, and links are only considered between objects which are
+    closer than `maxLinkDistance` in feature space (found using a KD-tree), so that both memory use and run time scale
+    linearly with the number of frames and objects rather than with the square of the number of objects per frame.
+    """
+    def __init__(self, t, xvs, pNew=0.2, r0=500, linkageCuttoffProb=0.1, maxLinkDistance=None):
         self.t = t
         self.xvs = xvs
         
         self.pNew = pNew #probability of an object not being present in previous frame
         self.r0 = r0 #mean distance an object can move
         self.linkageCuttoffProb = linkageCuttoffProb #probability below which a possible inkage is ignored
+        
+        #distance (in feature space) beyond which we don't consider linkages. If None, a distance is chosen at which
+        #the linkage probability is negligible compared to the probability of a new object (see _getMaxLinkDistance)
+        self.maxLinkDistance = maxLinkDistance
 
         #index of objects
         self.objIndex = np.arange(len(t))
@@ -27,126 +51,219 @@ class Tracker(object):
         #this will be changed to reflect linkages
         self.clumpIndex = np.arange(len(t))
         
-        self.xvsByT = [xvs[:,t==i] for i in xrange(t.max()+1)]
-        self.indicesByT = [self.objIndex[t==i] for i in xrange(t.max()+1)]
+        #group objects by frame - sort once and find where each frame starts
+        I = np.argsort(t, kind='mergesort')
+        frameStarts = np.searchsorted(t[I], np.arange(t.max() + 2))
+        
+        self.indicesByT = np.split(self.objIndex[I], frameStarts[1:-1])
+        self.xvsByT = [xvs[:, ind] for ind in self.indicesByT]
+        
+        self._trees = {}
 
-    def calcLinkageMatrix(self, i, j, manualLinkages = []):
-        """Compare this frame (i) with another frame (j) """
-        #calculate distances 
-        #print i, j
-        if i >= len(self.xvsByT):
-            return np.empty([0,0]),np.empty([0])
-            
-        xvs_i = self.xvsByT[i].T
-        xvs_j = self.xvsByT[j].T
-        if (len(xvs_i) == 0) or (len(xvs_j) == 0):
-            return np.empty([0,0]),np.empty([0])
+    def _getMaxLinkDistance(self):
+        if self.maxLinkDistance is not None:
+            return self.maxLinkDistance
+        
+        #distance at which exp(-r/r0) drops to 1e-3*pNew
+        return self.r0*np.log(1e3/self.pNew)
+    
+    def _getTree(self, i):
+        """KD-tree of the objects in frame i. Only the most recently used frames are kept."""
+        try:
+            return self._trees[i]
+        except KeyError:
+            if len(self._trees) > 4:
+                self._trees.pop(min(self._trees.keys()))
             
-        dists = spatial.distance.cdist(xvs_j, xvs_i)
+            tree = spatial.cKDTree(self.xvsByT[i].T)
+            self._trees[i] = tree
+            return tree
+
+    def calcSparseLinkages(self, i, j, manualLinkages=[]):
+        """
+        Compare this frame (i) with another frame (j), only considering objects which are within maxLinkDistance of
+        each other.
+        
+        Returns
+        -------
+        cols, rows, lMatch : ndarray
+            sparse representation of the linkage probability matrix, where cols is the index of the object in frame i
+            and rows the index of the object in frame j (or the number of objects in frame j for the probability
+            that the object is new in frame i).
+        nI : int
+            number of objects in frame i
+        jIndices : ndarray
+            which actual events rows refer to
+        """
+        empty = np.zeros(0, 'i8')
+        if (i >= len(self.xvsByT)) or (j >= len(self.xvsByT)):
+            return empty, empty, np.zeros(0), 0, empty
+        
+        nI, nJ = self.xvsByT[i].shape[1], self.xvsByT[j].shape[1]
+        jIndices = self.indicesByT[j]
+        if (nI == 0) or (nJ == 0):
+            return empty, empty, np.zeros(0), nI, jIndices
+        
+        pairs = self._getTree(j).sparse_distance_matrix(self._getTree(i), self._getMaxLinkDistance(),
+                                                         output_type='ndarray')
+        rows = pairs['i'].astype('i8')
+        cols = pairs['j'].astype('i8')
         
         #calculate probablility of a certain distance (given a mean jump length r0)
-        pMatch = np.exp(-dists/self.r0)
+        pMatch = np.exp(-pairs['v']/self.r0)
         
-        #add the probability that the object is new in this frame
-        pMatch = np.concatenate([pMatch, self.pNew*np.ones([1,pMatch.shape[1]])], 0)
+        #the probability that the object is new in this frame
+        pNew = self.pNew*np.ones(nI)
         
         #Set the probabilities for manually specified linkages:
         for iLink, jLink in manualLinkages:
-            pMatch[j,:] = 0
-            pMatch[:,i] = 0
-            pMatch[j, i] = 1
+            keep = (rows != jLink) & (cols != iLink)
+            rows = np.hstack([rows[keep], jLink])
+            cols = np.hstack([cols[keep], iLink])
+            pMatch = np.hstack([pMatch[keep], 1])
+            pNew[iLink] = 0
         
         #of all possible matches for a given object, what are the relative probabilities
-        lMatch = pMatch/pMatch.sum(0)[None, :]
+        colSum = np.bincount(cols, pMatch, nI) + pNew
+        lMatch = pMatch/colSum[cols]
+        lNew = pNew/colSum
         
         #we don't want 2 objects in this frame to match to one object in frame j
         #reduce likelihood of object according to the relative chance of another
         #object in this frame assigning to the same object
+        rowMax = np.zeros(nJ)
+        np.maximum.at(rowMax, rows, lMatch)
+        lAdj = lMatch*(lMatch/np.maximum(rowMax[rows], np.finfo('f8').tiny))**2
         
-        lAdj = lMatch*(lMatch/lMatch.max(1)[:,None])**2
-        
-        #this is not, however the case for new matches - we don't care about those 
-        #co-inciding - reset to previous values
-        lAdj[-1,:] = lMatch[-1,:]
+        #this is not, however the case for new matches - we don't care about those
+        #co-inciding - so these keep their previous values
         
         #now repeat the normalisation above to find new relative probabilities
-        lMatch = lAdj/lAdj.sum(0)[None, :]
+        colSum = np.bincount(cols, lAdj, nI) + lNew
+        lMatch = lAdj/colSum[cols]
+        lNew = lNew/colSum
         
-        #which actual events does this information pertain to (here so we can expand this to multiple frames)
-        jIndices = self.indicesByT[j]
+        cols = np.hstack([cols, np.arange(nI)])
+        rows = np.hstack([rows, nJ*np.ones(nI, 'i8')])
+        lMatch = np.hstack([lMatch, lNew])
         
-        return lMatch, jIndices
+        return cols, rows, lMatch, nI, jIndices
+
+    def calcLinkageMatrix(self, i, j, manualLinkages = []):
+        """Compare this frame (i) with another frame (j), returning a dense [nJ + 1, nI] matrix of linkage
+        probabilities (see calcSparseLinkages)"""
+        cols, rows, lMatch, nI, jIndices = self.calcSparseLinkages(i, j, manualLinkages)
+        
+        m = np.zeros([len(jIndices) + 1, nI])
+        m[rows, cols] = lMatch
+        
+        return m, jIndices
     
     def getLinkageCandidates(self, lMatch, jIndices):
-        linkages = {}
-        for i in xrange(lMatch.shape[1]):
-            pM = lMatch[:,i].squeeze()
-            iM = np.argsort(-pM)
-            pM = pM[iM]
-            sig = pM > self.linkageCuttoffProb
-            
-            if sig.sum() == 0:
-                pM = pM[:1]
-                iM = iM[:1]
-            else:
-                pM = pM[sig]
-                iM = iM[sig]
-            
-            #print jIndices.shape[0], iM            
-            #if we matched to a new event, replace by -1
-            iM[iM == jIndices.shape[0]] = -1
-            
-            #find the real object numbers which correspond to our linkages
-            absIM = jIndices[iM]
-            absIM[iM == -1] = -1
-            
-            linkages[i] = (absIM, pM)
-            
-        return linkages
+        """
+        Select the candidate linkages for each object from a dense linkage matrix, as returned by calcLinkageMatrix
+        
+        Returns
+        -------
+        linkages : tuple of ndarray
+            (k, absIM, pM) - the index of the object within frame i, the object it links to (-1 for a new object), and
+            the probability of the link
+        """
+        rows, cols = np.nonzero(lMatch)
+        return self._selectCandidates(cols, rows, lMatch[rows, cols], jIndices)
+    
+    def _selectCandidates(self, cols, rows, lMatch, jIndices):
+        if len(cols) == 0:
+            return np.zeros(0, 'i8'), np.zeros(0, 'i8'), np.zeros(0)
+        
+        #keep the significant candidates, or the most likely one if no candidates are significant
+        nCols = cols.max() + 1
+        sig = lMatch > self.linkageCuttoffProb
+        anySig = np.bincount(cols, sig, nCols) > 0
+        colMax = np.zeros(nCols)
+        np.maximum.at(colMax, cols, lMatch)
+        keep = sig | (~anySig[cols] & (lMatch == colMax[cols]))
+        cols, rows, lMatch = cols[keep], rows[keep], lMatch[keep]
+        
+        #sort by object, and then by decreasing probability
+        I = np.lexsort([-lMatch, cols])
+        cols, rows, lMatch = cols[I], rows[I], lMatch[I]
+        
+        #only keep one candidate if there are ties for the most likely (non-significant) candidate
+        first = np.hstack([True, cols[1:] != cols[:-1]])
+        keep = first | anySig[cols]
+        cols, rows, lMatch = cols[keep], rows[keep], lMatch[keep]
+        
+        #find the real object numbers which correspond to our linkages (-1 if we matched to a new event)
+        isNew = rows == len(jIndices)
+        absIM = -np.ones(len(rows), 'i8')
+        absIM[~isNew] = jIndices[rows[~isNew]]
+        
+        return cols, absIM, lMatch
         
     def calcLinkages(self, i, j, manualLinkages = []):
-        lMatch, jIndices = self.calcLinkageMatrix(i,j, manualLinkages=manualLinkages)
-        return self.getLinkageCandidates(lMatch, jIndices)
+        """
+        Candidate linkages between the objects in frame i and those in frame j, as a (k, lj, lp) tuple of arrays giving
+        the index of the object within frame i, the (absolute) index of the linked object (-1 for a new object) and the
+        linkage probability. Links are sorted by k, and then by decreasing probability (see also `linkages_by_object`).
+        """
+        cols, rows, lMatch, nI, jIndices = self.calcSparseLinkages(i, j, manualLinkages=manualLinkages)
+        return self._selectCandidates(cols, rows, lMatch, jIndices)
         
     def updateTrack(self, i, linkages):
+        """
+        Assign objects in frame i to tracks, based on candidate linkages
+        
+        Links are accepted greedily in order of decreasing probability, with each object in this frame accepting only
+        one link and each object in the previous frame being linked to at most once. This is resolved in a vectorised
+        fashion - in each round we accept all the links which are the most probable remaining link for both of the
+        objects they connect (which is exactly the set a sequential greedy pass would accept), and then drop any
+        links to objects which have been used.
+        """
         if i >= len(self.indicesByT):
             return
             
         iIndices = self.indicesByT[i]
+        k, lj, lp = linkages
         
-        #alreadyAssigned = []
-
-        allLinks = []        
+        valid = lp > 0
+        k, lj, lp = k[valid], lj[valid], lp[valid]
         
-        for k, links in linkages.items():
-            n = iIndices[k]
-            lj, lp = links
-            
-            for lji, lpi in zip(lj, lp):
-                allLinks.append((lpi, lji, n))
-                
-        if len(allLinks) == 0:
+        if len(k) == 0:
             return
-                
-        allLinks = np.array(allLinks)
         
-        #sort so that the highest probability comes first
-        allLinks = allLinks[allLinks[:,0].argsort()[::-1], :]
+        n = iIndices[k]
+        
+        #unique rank of each link (lower is more probable)
+        rank = np.empty(len(lp), 'i8')
+        rank[np.argsort(-lp, kind='mergesort')] = np.arange(len(lp))
+        
+        #compact indices for objects in both frames
+        _, nI = np.unique(n, return_inverse=True)
+        _, jI = np.unique(lj, return_inverse=True)
+        nI, jI = nI.ravel(), jI.ravel()
+        isNew = lj == -1
+        
+        accepted = np.zeros(len(lp), bool)
+        remaining = np.ones(len(lp), bool)
+        
+        while remaining.any():
+            r = np.where(remaining, rank, len(rank))
+            bestN = np.full(nI.max() + 1, len(rank))
+            np.minimum.at(bestN, nI, r)
+            bestJ = np.full(jI.max() + 1, len(rank))
+            np.minimum.at(bestJ, jI[~isNew], r[~isNew])
             
-        for j in range(len(allLinks)):
-            lpi, lji, n = allLinks[j]
+            acc = remaining & (r == bestN[nI]) & (isNew | (r == bestJ[jI]))
+            accepted |= acc
             
-            if not lpi == 0:                
-                allLinks[allLinks[:,2] == n, 0] = 0
-                if not lji == -1:
-                    #we are not a new object
-                    self.clumpIndex[int(n)] = self.clumpIndex[int(lji)]
-                    allLinks[allLinks[:,1] == lji, 0] = 0
-                    
-    
-
-        
+            usedN = np.zeros(len(bestN), bool)
+            usedN[nI[acc]] = True
+            usedJ = np.zeros(len(bestJ), bool)
+            usedJ[jI[acc & ~isNew]] = True
+            
+            remaining &= ~(usedN[nI] | (usedJ[jI] & ~isNew))
         
-    
-    
-    
\ No newline at end of file
+        #we are not new objects
+        link = accepted & ~isNew
+        self.clumpIndex[n[link]] = self.clumpIndex[lj[link]]
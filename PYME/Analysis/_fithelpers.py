@@ -158,4 +158,135 @@ def FitModelFixed(modelFcn, startParameters, fitWhich, data, *args, **kwargs):
     return [out]
 
     
-#def FitModelPoissonS(modelFcn, startParmeters, data, *args):
\ No newline at end of file
+#def FitModelPoissonS(modelFcn, startParmeters, data, *args):
+
+def FitModelWeightedBatched(modelFcn, startParameters, data, weights, *args, **kwargs):
+    """
+    Vectorised Levenberg-Marquardt fitting of many independent, equally sized, problems at once (e.g. all the ROIs
+    in a frame).
+    
+    Rather than calling `leastsq` once per ROI, the model, its jacobian, and the normal equations are evaluated for all
+    ROIs with numpy array operations, avoiding per-ROI python and solver call overhead. ROIs which are smaller than
+    the common size (e.g. at the edge of the frame) can be handled by padding and setting the weights for the padding
+    pixels to 0.
+
+    Parameters
+    ----------
+    modelFcn : callable
+        modelFcn(p, *args) -> (model, jacobian), where p has shape (N, nParams), model has shape (N, M) and jacobian
+        (the derivatives of the model with respect to the parameters) has shape (N, M, nParams)
+    startParameters : array, shape (N, nParams)
+    data : array, shape (N, M)
+    weights : array, shape (N, M)
+        the weights (1/sigma) for each data point
+    args :
+        additional arguments passed to modelFcn. Array arguments with a first dimension of length N are assumed to be
+        per-problem (e.g. pixel coordinates for each ROI) and are subset along with the parameters.
+    fitWhich : [optional] bool array, shape (nParams,)
+        which parameters to fit. Parameters which are not fitted are held at their starting values.
+    maxIterations : [optional] int
+        maximum number of iterations (default 100)
+    ftol : [optional] float
+        relative reduction in chi-squared at which we consider the fit converged (default 1.49012e-8, as for leastsq)
+
+    Returns
+    -------
+    res : array, shape (N, nParams)
+        fitted parameters
+    cov_x : array, shape (N, nFit, nFit)
+        inverse of the curvature matrix (J^T J) for the fitted parameters at the solution, analogous to the cov_x
+        output of leastsq. NaN if singular.
+    chi2 : array, shape (N,)
+        sum of squared weighted residuals at the solution
+    resCode : array, shape (N,)
+        1 if the fit converged, 5 if the maximum number of iterations was reached (mirroring leastsq's ier)
+
+    """
+    fitWhich = kwargs.get('fitWhich', None)
+    maxIterations = kwargs.get('maxIterations', 100)
+    ftol = kwargs.get('ftol', 1.49012e-8)
+    
+    p = np.array(startParameters, dtype='f8', ndmin=2).copy()
+    data = np.asarray(data, dtype='f8')
+    w2 = np.asarray(weights, dtype='f8')**2
+    
+    nProblems, nParams = p.shape
+    if fitWhich is None:
+        fitWhich = np.ones(nParams, dtype=bool)
+    fitWhich = np.asarray(fitWhich, dtype=bool)
+    nFit = int(fitWhich.sum())
+    
+    def _eval(p_):
+        mod, jac = modelFcn(p_, *args)
+        resid = data - mod
+        return resid, jac[:, :, fitWhich], (w2*resid*resid).sum(1)
+    
+    resid, jac, chi2 = _eval(p)
+    lam = 1e-3*np.ones(nProblems)
+    active = np.ones(nProblems, dtype=bool)
+    resCode = 5*np.ones(nProblems, dtype='i4')
+    eye = np.eye(nFit)
+    
+    for it in range(maxIterations):
+        idx = np.where(active)[0]
+        if len(idx) == 0:
+            break
+            
+        J = jac[idx]
+        JtW = J.transpose(0, 2, 1)*w2[idx][:, None, :]
+        JtJ = np.matmul(JtW, J)
+        g = np.matmul(JtW, resid[idx][:, :, None])[:, :, 0]
+        
+        # Marquardt scaling of the damping term, with a floor to cope with parameters which have no effect on the model
+        d = np.maximum(np.diagonal(JtJ, axis1=1, axis2=2), 1e-12)
+        A = JtJ + lam[idx][:, None, None]*d[:, :, None]*eye[None, :, :]
+        
+        try:
+            delta = np.linalg.solve(A, g[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            delta = np.matmul(np.linalg.pinv(A), g[:, :, None])[:, :, 0]
+        
+        p_new = p[idx].copy()
+        p_new[:, fitWhich] += delta
+        
+        # we only need to re-evaluate the active problems
+        mod_new, jac_new = modelFcn(p_new, *[a[idx] if (np.ndim(a) > 0 and np.shape(a)[0] == nProblems) else a for a in args])
+        resid_new = data[idx] - mod_new
+        chi2_new = (w2[idx]*resid_new*resid_new).sum(1)
+        
+        improved = np.isfinite(chi2_new) & (chi2_new <= chi2[idx])
+        
+        acc = idx[improved]
+        converged = improved & ((chi2[idx] - chi2_new) <= ftol*chi2[idx])
+        
+        p[acc] = p_new[improved]
+        resid[acc] = resid_new[improved]
+        jac[acc] = jac_new[improved][:, :, fitWhich]
+        chi2[acc] = chi2_new[improved]
+        
+        lam[acc] /= 10.
+        lam[idx[~improved]] *= 10.
+        
+        # stop if the damping has blown up (we can't find a better solution)
+        stuck = (~improved) & (lam[idx] > 1e10)
+        
+        done = idx[converged | stuck]
+        resCode[done] = 1
+        active[done] = False
+        
+    # estimate the curvature at the solution
+    JtW = jac.transpose(0, 2, 1)*w2[:, None, :]
+    JtJ = np.matmul(JtW, jac)
+    cov_x = np.nan*np.ones_like(JtJ)
+    ok = np.abs(np.linalg.det(JtJ)) > 0
+    if ok.any():
+        try:
+            cov_x[ok] = np.linalg.inv(JtJ[ok])
+        except np.linalg.LinAlgError:
+            for i in np.where(ok)[0]:
+                try:
+                    cov_x[i] = np.linalg.inv(JtJ[i])
+                except np.linalg.LinAlgError:
+                    pass
+    
+    return p, cov_x, chi2, resCode
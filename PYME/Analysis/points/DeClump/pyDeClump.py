@@ -27,31 +27,116 @@ from six.moves import xrange
 
 
 def findConnected(i, t,x,y,delta_x, frameIndices, assigned, clumpNum, nFrames=5):
-    #get the indices of all the points in the next n frames
-    neighbour_inds = np.arange((i+1), min(frameIndices[int(t[i] + nFrames)], len(t)), dtype='int32')
-    #print neighbour_inds
-    
-    #keep only those which haven't already been asigned to a clump
-    neighbour_inds = neighbour_inds[assigned[neighbour_inds] == 0]
+    """
+    Assign all points which are connected to point i (i.e. which are within 2*delta_x of it and occur less than nFrames
+    later) to the clump clumpNum, following the chain of connected points.
 
-    #get the actual neighbour information
-    #neighbours = fitResults[neighbour_inds]
+    NB - this is only kept for backwards compatibility, `findClumps` no longer uses it. Neighbours are followed with an
+    explicit stack rather than recursion, so that long-lived emitters don't blow the recursion limit.
+    """
+    stack = [i]
+    while len(stack) > 0:
+        i = stack.pop()
+        
+        #get the indices of all the points in the next n frames
+        neighbour_inds = np.arange((i+1), min(frameIndices[int(t[i] + nFrames)], len(t)), dtype='int32')
+        
+        #keep only those which haven't already been asigned to a clump
+        neighbour_inds = neighbour_inds[assigned[neighbour_inds] == 0]
     
-    #calculate the square distances to the neighbours
-    dis = (x[neighbour_inds] - x[i])**2 + (y[neighbour_inds] - y[i])**2
-
-    #find the indices of those neighbours which are within twice the localisation precision
-    #note that we're relying on the fact that the x and y localisaiton precisions are
-    #typically practically the same
-    sig_n = neighbour_inds[dis < (2*delta_x[i])**2]
+        #calculate the square distances to the neighbours
+        dis = (x[neighbour_inds] - x[i])**2 + (y[neighbour_inds] - y[i])**2
+    
+        #find the indices of those neighbours which are within twice the localisation precision
+        #note that we're relying on the fact that the x and y localisaiton precisions are
+        #typically practically the same
+        sig_n = neighbour_inds[dis < (2*delta_x[i])**2]
+    
+        #add them to the clump, and add their neighbours to the clump
+        assigned[sig_n] = clumpNum
+        stack.extend(sig_n)
+
+
+#maximum number of candidate links to accumulate before merging them into the clumps
+LINK_BATCH_SIZE = 1000000
+
+def _find_roots(parent, i):
+    """Find the root of each node in i, compressing the paths of the nodes we were asked about as we go"""
+    r = parent[i]
+    while True:
+        r_ = parent[r]
+        if np.all(r_ == r):
+            break
+        r = r_
+    
+    parent[i] = r
+    return r
 
-    #add them to the clump
-    assigned[sig_n] = clumpNum
+def _union(parent, a, b):
+    """
+    Vectorised union step of a union-find (disjoint set) structure. Joins the sets containing a[k] and b[k] for all k.
 
-    #and add their neighbours to the clump
-    for n in sig_n:
-        findConnected(n, t,x,y,delta_x, frameIndices, assigned, clumpNum, nFrames)
+    Each set is represented by its lowest index member, so that clump numbers end up being in order of the first
+    point in each clump.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    
+    if len(a) == 0:
+        return
+    
+    ra = _find_roots(parent, a)
+    rb = _find_roots(parent, b)
+    
+    #find connected components of the (much smaller) graph of roots which are linked by this batch
+    roots, inv = np.unique(np.hstack([ra, rb]), return_inverse=True)
+    inv = inv.ravel()
+    n_links = len(ra)
+    n_roots = len(roots)
+    g = coo_matrix((np.ones(n_links, 'i1'), (inv[:n_links], inv[n_links:])), shape=(n_roots, n_roots))
+    n_comp, labels = connected_components(g, directed=False)
+    
+    #point all the roots in each component at the lowest one
+    new_roots = np.full(n_comp, parent.shape[0], dtype=parent.dtype)
+    np.minimum.at(new_roots, labels, roots)
+    parent[roots] = new_roots[labels]
 
+def _frame_links(t, x, y, delta_x, nFrames, frame_starts, trees, k):
+    """
+    Candidate links (i, j) from the points in the k-th frame to points in the same frame (with j > i) and in the
+    following frames up to (but not including) t + nFrames. A link is made if the distance between the points is less
+    than 2*delta_x[i].
+    """
+    s0, s1 = frame_starts[k], frame_starts[k + 1]
+    t_k = t[s0]
+    tree_k = trees[k]
+    r_max = 2*float(delta_x[s0:s1].max())
+    
+    links = []
+    
+    #links within the same frame
+    if (s1 - s0) > 1:
+        p = tree_k.query_pairs(r_max, output_type='ndarray')
+        if len(p) > 0:
+            links.append(p + s0)
+    
+    #links to later frames
+    kk = k + 1
+    while (kk < len(trees)) and (t[frame_starts[kk]] - t_k < nFrames):
+        p = tree_k.sparse_distance_matrix(trees[kk], r_max, output_type='ndarray')
+        if len(p) > 0:
+            links.append(np.vstack([p['i'] + s0, p['j'] + frame_starts[kk]]).T)
+        kk += 1
+    
+    if len(links) == 0:
+        return np.zeros((0, 2), 'i8')
+    
+    links = np.vstack(links).astype('i8')
+    i, j = links[:, 0], links[:, 1]
+    
+    #filter using the per-point search radius of the earlier point
+    d2 = (x[j] - x[i])**2 + (y[j] - y[i])**2
+    return links[d2 < (2*delta_x[i])**2]
 
 def deClumpedDType(arr):
     dt = arr.dtype.descr
@@ -99,37 +184,82 @@ def deClumpf(h5fFile):
 
 def findClumps(t, x, y, delta_x, nFrames=5):
     """Finds clumps (or single particle trajectories) of data points in a series.
-    fitRsults MUST be sorted in increasing time order.
-    """
 
+    Two points are linked if the second occurs less than nFrames after the first (or later in the same frame) and is
+    within twice the localisation precision (delta_x) of the first point. Clumps are the connected components of the
+    resulting graph.
+
+    Candidate links are found using a KD-tree for each frame, and merged into clumps with a (vectorised) union-find,
+    so that the run time scales roughly linearly with the number of points rather than quadratically, and long chains
+    of points don't hit the recursion limit.
+
+    Parameters
+    ----------
+    t : ndarray
+        frame number of each point. Should be sorted in increasing time order.
+    x, y : ndarray
+        positions
+    delta_x : ndarray
+        localisation precision of each point
+    nFrames : int
+        number of frames to look forward when linking
+
+    Returns
+    -------
+    assigned : ndarray
+        the (1-based) clump number of each point. Clumps are numbered in order of their first point.
+    """
+    from scipy.spatial import cKDTree
+    
+    t = np.asarray(t)
     nRes = len(t)
-
-    #there may be a different number of points in each frame; generate a lookup
-    #table for frame numbers so we can index into our list of results to get
-    #all the points within a certain range of frames
-    frameIndices = (nRes + 2)*np.ones(t.max() + nFrames + 1, 'int32')
-
-    for t_i, i in zip(t, range(nRes)):
-        frameIndices[:(t_i+1)] = np.minimum(frameIndices[:(t_i+1)], i)
-
-    #print frameIndices
+    if nRes == 0:
+        return np.zeros(0, 'int32')
     
-    #record whether a point has already been asigned to a clump
-    assigned = np.zeros(nRes, 'int32')
-
-    clumpNum = 1
-
-    for i in range(nRes): #loop over all the points
-        if assigned[i] == 0:
-            #if a point hasn't already been assigned to a clump, start a new
-            #clump from that point.
-            assigned[i] = clumpNum
+    I = None
+    if np.any(np.diff(t) < 0):
+        I = np.argsort(t, kind='mergesort')
+        t = t[I]
+        x, y, delta_x = x[I], y[I], delta_x[I]
+
+    x = np.asarray(x, 'f8')
+    y = np.asarray(y, 'f8')
+    delta_x = np.asarray(delta_x, 'f8')
+    
+    #there may be a different number of points in each frame - find where each frame starts
+    frame_starts = np.hstack([0, np.flatnonzero(np.diff(t)) + 1, nRes])
+    
+    pts = np.vstack([x, y]).T
+    trees = [cKDTree(pts[frame_starts[k]:frame_starts[k+1]]) for k in range(len(frame_starts) - 1)]
+    
+    #union-find forest - each point starts out in its own clump
+    parent = np.arange(nRes)
+    
+    links = []
+    n_links = 0
+    for k in range(len(trees)):
+        l = _frame_links(t, x, y, delta_x, nFrames, frame_starts, trees, k)
+        links.append(l)
+        n_links += len(l)
         
-            #find all the points which are connected to this one
-            findConnected(i, t,x,y,delta_x, frameIndices, assigned, clumpNum, nFrames)
-
-            #next pass will be a new clump
-            clumpNum +=1
+        if n_links > LINK_BATCH_SIZE:
+            links = np.vstack(links)
+            _union(parent, links[:, 0], links[:, 1])
+            links = []
+            n_links = 0
+    
+    if n_links > 0:
+        links = np.vstack(links)
+        _union(parent, links[:, 0], links[:, 1])
+    
+    #number clumps consecutively in order of their first point
+    roots = _find_roots(parent, np.arange(nRes))
+    assigned = (np.unique(roots, return_inverse=True)[1].ravel() + 1).astype('int32')
+    
+    if I is not None:
+        out = np.empty_like(assigned)
+        out[I] = assigned
+        assigned = out
 
     return assigned
 
@@ -176,6 +306,7 @@ def coalesceClumps_(fitResults, assigned):
     
 def coalesceClumps(fitResults, assigned, nphotons=None):
     """Agregates clumps to a single event"""
+    assigned = np.asarray(assigned).astype('i8')
     NClumps = int(assigned.max())
 
     #work out what the data type for our declumped data should be
@@ -184,47 +315,41 @@ def coalesceClumps(fitResults, assigned, nphotons=None):
         dt.append(('nPhotons','<f4'))
         dt.append(('photonRate','<f4'))
 
-    fres = np.empty(NClumps, dt)
+    fres = np.zeros(NClumps, dt)
     
     dtr = '%df4' % len(fitResults['fitResults'].dtype)
     
-    clist = [[] for i in xrange(NClumps)]
-    for i, c in enumerate(assigned):
-        clist[int(c-1)].append(i)
-        
-    avals = fitResults['fitResults'].view(dtr)
-    aerrs = fitResults['fitError'].view(dtr)
-    tIs = fitResults['tIndex']
-
-    for i in xrange(NClumps):
-            #coalesce the connected ponts into one
-            ci = clist[i]
-            #vals = fitResults[ci]
-            
-            rvs = avals[ci]
-            evs = aerrs[ci]
-
-            #vn = np.zeros(1,dtype=dt)
-                        
-            fres['tIndex'][i] = tIs[ci].min()
-
-            #fres['fitResults'][i], fres['fitError'][i] = weightedAverage(vals['fitResults'], vals['fitError'])
-            fres['fitResults'][i], fres['fitError'][i] = weightedAverage_(rvs, evs, dtr)
-
-            fres['nFrames'][i] = len(rvs)
-            fres['burstDuration'][i] = tIs[ci].max() - tIs[ci].min() + 1
-
-            if nphotons is not None:
-                nph = nphotons[ci]
-                fres['nPhotons'][i] = nph.sum()
-                fres['photonRate'][i] = nph.mean()
+    #group the points in each clump together
+    I = np.argsort(assigned, kind='mergesort')
+    labels = assigned[I]
+    starts = np.hstack([0, np.flatnonzero(np.diff(labels)) + 1])
+    ci = labels[starts] - 1
+    nFrames = np.diff(np.hstack([starts, len(labels)]))
+    
+    avals = fitResults['fitResults'].view(dtr)[I].astype('f8')
+    aerrs = fitResults['fitError'].view(dtr)[I].astype('f8')
+    tIs = fitResults['tIndex'][I]
+    
+    tmin = np.minimum.reduceat(tIs, starts)
+    fres['tIndex'][ci] = tmin
+    
+    #weighted average of the fit results (see weightedAverage_)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = 1.0/(aerrs*aerrs)
+        ws = 1.0/np.add.reduceat(w, starts, axis=0)
+        r = np.add.reduceat(avals*w, starts, axis=0)*ws
+    
+    fres['fitResults'][ci] = r.astype('f4').view(fres['fitResults'].dtype)[:, 0]
+    fres['fitError'][ci] = np.sqrt(ws).astype('f4').view(fres['fitError'].dtype)[:, 0]
+    
+    fres['nFrames'][ci] = nFrames
+    fres['burstDuration'][ci] = np.maximum.reduceat(tIs, starts) - tmin + 1
 
-            #fres['ATotal'][i] = vals['fitResults']['A'].sum()
-            # fres['clumpSize'][i] = selectedDS.clumpSizes[clist[i][0]] # assign the value from the first pixel of the current clump
-            # if usewidth:
-            #     fres['clumpWidth'][i] = selectedDS.clumpWidths[clist[i][0]]
-            #     fres['clumpWidthX'][i] = selectedDS.clumpWidthsX[clist[i][0]]
-            #     fres['clumpWidthY'][i] = selectedDS.clumpWidthsY[clist[i][0]]
+    if nphotons is not None:
+        nph = np.asarray(nphotons)[I]
+        nph_tot = np.add.reduceat(nph, starts)
+        fres['nPhotons'][ci] = nph_tot
+        fres['photonRate'][ci] = nph_tot/nFrames
 
     return fres
 
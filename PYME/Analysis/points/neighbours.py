@@ -0,0 +1,224 @@
+"""
+Vectorised neighbour statistics for point data sets.
+
+Everything in here works on all points at once - neighbours are found with bulk KD-tree queries (split into chunks
+which are processed in parallel on the shared compute pool, the KD-tree releases the GIL while querying) and the
+statistics are computed with array operations rather than a python loop over points. This makes density and distance
+estimates on data sets with millions of points feasible.
+
+The number of threads used is set by the ``compute-threads`` config option (see PYME.misc.thread_pools).
+"""
+import numpy as np
+from PYME.misc import thread_pools
+
+#number of query points per chunk - bounds the size of the temporary arrays allocated by each thread
+QUERY_CHUNK_SIZE = 100000
+
+
+def _as_points(points):
+    points = np.asarray(points, dtype='f8')
+    if points.ndim == 1:
+        points = points[:, None]
+    return points
+
+def query_neighbours(kdt, q_pts, k):
+    """
+    Find the k nearest neighbours of each query point.
+
+    Equivalent to ``kdt.query(q_pts, k)``, but with the query split into chunks which are run in parallel.
+
+    Parameters
+    ----------
+    kdt : scipy.spatial.cKDTree
+        tree of the points to search
+    q_pts : ndarray
+        [N, n_dim] array of query points
+    k : int
+        number of neighbours to find
+
+    Returns
+    -------
+    d, i : ndarray
+        [N, k] arrays of distances and indices of the neighbours (sorted by distance). Missing neighbours (k greater
+        than the number of points in the tree) have distance ``inf`` and index ``kdt.n``.
+    """
+    q_pts = _as_points(q_pts)
+    k = int(k)
+    n_pts = q_pts.shape[0]
+
+    d = np.empty((n_pts, k), 'f8')
+    i = np.empty((n_pts, k), 'i8')
+
+    def _query(start):
+        sl = slice(start, min(start + QUERY_CHUNK_SIZE, n_pts))
+        d_, i_ = kdt.query(q_pts[sl], k)
+        d[sl] = d_.reshape(-1, k)
+        i[sl] = i_.reshape(-1, k)
+
+    thread_pools.parallel_map(_query, range(0, n_pts, QUERY_CHUNK_SIZE))
+
+    return d, i
+
+
+def scaling_fit(d, power):
+    """
+    Closed form least squares fit of neighbour number vs distance.
+
+    For each row of d, finds the coefficient a which minimises :math:`\\sum_n (n - a d_n^p)^2`, where n = 0, 1, ...
+    is the neighbour number. This is the same as calling ``np.linalg.lstsq`` with a single column design matrix of
+    ``d**power`` for each point, but computed for all points at once as :math:`a = \\sum n d^p / \\sum d^{2p}`.
+
+    Parameters
+    ----------
+    d : ndarray
+        [N, k] array of (sorted) neighbour distances, as returned by `query_neighbours`
+    power : float
+        the expected scaling of neighbour number with distance (2 for points in a plane, 3 for points in a volume)
+
+    Returns
+    -------
+    a : ndarray
+        fitted coefficient for each point. Points where all neighbour distances are zero get a coefficient of 0.
+    """
+    x = np.asarray(d, 'f8')**power
+    n = np.arange(x.shape[1])
+
+    num = (x*n[None, :]).sum(1)
+    den = (x*x).sum(1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(den > 0, num/np.maximum(den, np.finfo('f8').tiny), 0)
+
+
+def local_density(points, q_pts=None, n_neighbours=10, n_dim=None):
+    """
+    Estimate local point density by fitting the expected scaling of neighbour number with distance (see `scaling_fit`)
+
+    Parameters
+    ----------
+    points : ndarray
+        [N, n_dim] array of point positions
+    q_pts : ndarray, optional
+        [M, n_dim] positions to estimate density at. Defaults to `points`.
+    n_neighbours : int
+        number of neighbours to include in the fit
+    n_dim : int, optional
+        dimensionality to use for the scaling (defaults to the number of columns in points)
+
+    Returns
+    -------
+    dn : ndarray
+        [M] array of density estimates
+    """
+    from scipy.spatial import cKDTree
+    points = _as_points(points)
+    if q_pts is None:
+        q_pts = points
+
+    if n_dim is None:
+        n_dim = points.shape[1]
+
+    d, _ = query_neighbours(cKDTree(points), q_pts, n_neighbours)
+    return scaling_fit(d, n_dim)
+
+
+def nearest_neighbour_distances(points, q_pts=None):
+    """
+    Distance from each query point to its nearest neighbour.
+
+    Parameters
+    ----------
+    points : ndarray
+        [N, n_dim] array of point positions
+    q_pts : ndarray, optional
+        [M, n_dim] array of positions to find the nearest neighbours of. If not given, the nearest neighbour distances
+        within `points` are computed (excluding each point itself).
+
+    Returns
+    -------
+    d : ndarray
+        [M] array of distances
+    """
+    from scipy.spatial import cKDTree
+    points = _as_points(points)
+    kdt = cKDTree(points)
+
+    if q_pts is None:
+        #the closest point will be the point itself, so take the second
+        d, _ = query_neighbours(kdt, points, 2)
+        return d[:, 1]
+    else:
+        d, _ = query_neighbours(kdt, q_pts, 1)
+        return d[:, 0]
+
+
+def triangulation_edges(simplices):
+    """
+    Unique edges of a triangulation.
+
+    Parameters
+    ----------
+    simplices : ndarray
+        [N, n_vertices] array of vertex indices for each simplex (e.g. ``scipy.spatial.Delaunay(...).simplices``)
+
+    Returns
+    -------
+    edges : ndarray
+        [M, 2] array of vertex indices, with each edge appearing only once
+    """
+    simplices = np.asarray(simplices)
+    nv = simplices.shape[1]
+
+    edges = np.vstack([simplices[:, [a, b]] for a in range(nv) for b in range(a + 1, nv)])
+    edges.sort(axis=1)
+    return np.unique(edges, axis=0)
+
+
+def mean_edge_lengths(points, edges):
+    """
+    Mean length of the edges connected to each point.
+
+    Parameters
+    ----------
+    points : ndarray
+        [N, n_dim] array of point positions
+    edges : ndarray
+        [M, 2] array of vertex indices
+
+    Returns
+    -------
+    d : ndarray
+        [N] array of mean edge lengths (NaN for points without any edges)
+    """
+    points = _as_points(points)
+    n_pts = points.shape[0]
+
+    lengths = np.sqrt(((points[edges[:, 0]] - points[edges[:, 1]])**2).sum(1))
+
+    tot = np.bincount(edges[:, 0], lengths, n_pts) + np.bincount(edges[:, 1], lengths, n_pts)
+    count = np.bincount(edges[:, 0], minlength=n_pts) + np.bincount(edges[:, 1], minlength=n_pts)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return tot/count
+
+
+def mean_neighbour_distances(points):
+    """
+    Mean distance from each point to its neighbours in a Delaunay triangulation.
+
+    Parameters
+    ----------
+    points : ndarray
+        [N, n_dim] array of point positions
+
+    Returns
+    -------
+    d : ndarray
+        [N] array of mean distances
+    """
+    from scipy.spatial import Delaunay
+    points = _as_points(points)
+
+    #joggle the input so that degenerate (e.g. duplicate) points are still included in the triangulation
+    T = Delaunay(points, qhull_options='QJ')
+    return mean_edge_lengths(points, triangulation_edges(T.simplices))
@@ -3,34 +3,76 @@ from PYME.IO.MetaDataHandler import get_camera_roi_origin, NestedClassMDHandler
 import os
 import glob
 import collections
+import threading
 import time
 import six
 import logging
 
 logger = logging.getLogger(__name__)
 
+from PYME import config
+from PYME.misc import thread_pools
+
 CacheEntry = collections.namedtuple('CacheEntry', ['data', 'saved'])
 
+# fsync each batch of tiles written by the write-behind thread (slower, but guarantees tiles are on disk once flush()
+# returns).
+TILE_CACHE_FSYNC = config.get('tile-cache-fsync', False)
+
 class TileCache(object):
-    def __init__(self, max_size=1000):
+    """
+    LRU cache of tiles, keyed by filename.
+    
+    Tiles which are modified (via `save`) are only written to disk when they are evicted from the cache, or the cache is
+    flushed. Writes happen on a background thread (write-behind) so that eviction doesn't stall the caller on disk IO.
+    Evicted tiles remain accessible (and can be reclaimed by `load`) until they have been written. A maximum of
+    `max_pending` tiles may be waiting to be written at any one time, after which eviction blocks.
+    """
+    def __init__(self, max_size=1000, max_pending=None, fsync=TILE_CACHE_FSYNC):
         self._max_size = max_size
-        self._cache = {}
-        #self._cache_size=0
-        self._cache_keys = []
+        # an OrderedDict, with the most recently used entries at the end
+        self._cache = collections.OrderedDict()
+        
+        # tiles which have been evicted but not yet written to disk
+        self._pending = {}
+        self._write_queue = six.moves.queue.Queue(max_pending if max_pending else max_size)
+        self._writer = None
+        self._fsync = fsync
+        
+        self._lock = threading.Lock()
+        # held while the writer thread is writing a file, so that `remove` can't race with a write
+        self._write_lock = threading.Lock()
         
     def _load(self, filename):
         return np.load(filename)
         
     def load(self, filename):
-        try:
-            return self._cache[filename].data
-        except KeyError:
-            data = self._load(filename)
+        with self._lock:
+            try:
+                item = self._cache.pop(filename)
+                self._cache[filename] = item #move to most recently used
+                return item.data
+            except KeyError:
+                pass
+            
+            try:
+                # evicted, but not yet written - take it back
+                data = self._pending.pop(filename)
+                self._add(filename, data, saved=False)
+                return data
+            except KeyError:
+                pass
+            
+        data = self._load(filename)
+        with self._lock:
             self._add(filename, data, saved=True)
-            return data
+        return data
         
     def save(self, filename, data):
-        self._add(filename, data, saved=False)
+        with self._lock:
+            # a newer version supersedes any pending write
+            self._pending.pop(filename, None)
+            self._add(filename, data, saved=False)
         
     def _save(self, filename, data):
         dirname = os.path.split(filename)[0]
@@ -39,54 +81,115 @@ class TileCache(object):
             
         np.save(filename, data)
         
-    def _save_entry(self, filename):
-        item = self._cache[filename]
-        if not item.saved:
-            self._save(filename, item.data)
-            self._cache[filename] = CacheEntry(data=item.data, saved=True)
-            
-        
     def _add(self, filename, data, saved=True):
-        if filename in self._cache_keys:
-            # replace existing item
-            # we are going to be a bit sneaky, and remove the key before re-adding it later. This will move the key to the
-            # back of the list, making it the most recently accessed (and least likely to be popped to make way for new data)
-            self._cache_keys.remove(filename)
+        """Add an item to the cache, evicting the least recently used item if necessary. Call with self._lock held."""
+        # remove and re-add to move the entry to the end of the LRU order
+        self._cache.pop(filename, None)
             
-        if len(self._cache_keys) >= self._max_size:
+        while len(self._cache) >= self._max_size:
             # adding item would make us too large, pop oldest entry from our cache
-            fn = self._cache_keys.pop(0) #remove oldest item
-            self._drop(fn)
+            fn, item = self._cache.popitem(last=False)
+            if not item.saved:
+                self._queue_write(fn, item.data)
         
-        self._cache_keys.append(filename)
         self._cache[filename] = CacheEntry(data=data, saved=saved)
+        
+    def _queue_write(self, filename, data):
+        """Queue an item to be written by the background thread. Call with self._lock held."""
+        self._pending[filename] = data
+        
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, name='TileCacheWriter')
+            self._writer.daemon = True
+            self._writer.start()
+        
+        try:
+            self._write_queue.put_nowait(filename)
+        except six.moves.queue.Full:
+            # the writer has fallen behind - release the lock while we wait so that it can make progress
+            self._lock.release()
+            try:
+                self._write_queue.put(filename)
+            finally:
+                self._lock.acquire()
+                
+    def _write_pending(self, filename):
+        """Write a tile from the pending list to disk. Returns the filename if a write was performed"""
+        with self._write_lock:
+            with self._lock:
+                data = self._pending.get(filename, None)
+            
+            if data is None:
+                # reclaimed by load, superseded by save, or removed
+                return None
             
-    def _drop(self, filename):
-        item = self._cache.pop(filename)
-        if not item.saved:
-            self._save(filename, item.data)
+            try:
+                self._save(filename, data)
+            except Exception:
+                logger.exception('Error saving tile %s' % filename)
             
+            with self._lock:
+                if self._pending.get(filename, None) is data:
+                    self._pending.pop(filename)
+                    
+        return filename
+    
+    def _sync(self, filenames):
+        for fn in filenames:
+            try:
+                fd = os.open(fn, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+                
+    def _write_loop(self):
+        while True:
+            # write everything in the queue as one batch
+            batch = [self._write_queue.get()]
+            while True:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except six.moves.queue.Empty:
+                    break
+            
+            try:
+                written = [self._write_pending(fn) for fn in batch]
+                if self._fsync:
+                    self._sync([fn for fn in written if fn is not None])
+            finally:
+                for fn in batch:
+                    self._write_queue.task_done()
+                    
     def flush(self):
-        for filename, item  in list(self._cache.items()):
-            if not item.saved:
-                self._save(filename, item.data)
-                self._cache[filename] = CacheEntry(data=item.data, saved=True)
+        """Write all modified tiles to disk, returning once they have been written"""
+        with self._lock:
+            for filename, item in list(self._cache.items()):
+                if not item.saved:
+                    self._cache[filename] = CacheEntry(data=item.data, saved=True)
+                    self._queue_write(filename, item.data)
+        
+        self._write_queue.join()
                 
     def remove(self, filename):
-        if filename in self._cache_keys:
-            self._cache_keys.remove(filename)
-            self._cache.pop(filename)
-            
-        if os.path.exists(filename):
-            os.remove(filename)
+        with self._lock:
+            self._cache.pop(filename, None)
+            self._pending.pop(filename, None)
+        
+        # wait for any in-progress write of this file to complete before deleting
+        with self._write_lock:
+            if os.path.exists(filename):
+                os.remove(filename)
                 
     def purge(self):
         self.flush()
-        self._cache_keys = []
-        self._cache = {}
+        with self._lock:
+            self._cache.clear()
         
     def exists(self, filename):
-        return (filename in self._cache_keys) or os.path.exists(filename)
+        return (filename in self._cache) or (filename in self._pending) or os.path.exists(filename)
     
     
 class PZFTileCache(TileCache):
@@ -120,6 +223,17 @@ class TileIO(object):
     def get_layer_tile_coords(self, layer):
         raise NotImplementedError
     
+    def tile_version(self, layer, x, y):
+        """
+        Return a token which changes whenever a tile is modified on disk (e.g. by another process), or None if the tile
+        does not exist. The token is a tuple whose first entry is the (unix) time at which the tile was last modified.
+        """
+        raise NotImplementedError
+    
+    def read_tile(self, layer, x, y):
+        """Read a tile from disk, bypassing any caching (for reading pyramids which are being written by another process)"""
+        return self.get_tile(layer, x, y)
+    
     def flush(self):
         pass
 
@@ -138,6 +252,9 @@ class NumpyTileIO(TileIO):
         #return os.path.join(self.base_dir, '%d' % layer, '%03d' % x, '%03d_%03d_%s' % (x, y, self.suff))
     
     def get_tile(self, layer, x, y):
+        if not self.tile_exists(layer, x, y):
+            return None
+        
         try:
             return self._tilecache.load(self._filename(layer, x, y))
         except IOError:
@@ -147,17 +264,27 @@ class NumpyTileIO(TileIO):
         self._check_layer_tile_coords(layer)
         self._tilecache.save(self._filename(layer, x, y), data)
         
-        if not (x,y) in self._coords[layer]:
-            self._coords[layer].append((x,y))
+        self._coords[layer][(x,y)] = True
         
     def delete_tile(self, layer, x, y):
         self._check_layer_tile_coords(layer)
         self._tilecache.remove(self._filename(layer, x, y))
-        self._coords[layer].remove((x, y))
+        self._coords[layer].pop((x, y))
         
     def tile_exists(self, layer, x, y):
-        #return (x, y) in self._coords[layer]
-        return self._tilecache.exists(self._filename(layer, x, y))
+        # use our record of which tiles exist (populated from disk the first time we touch a layer and kept up to date
+        # as tiles are added and deleted) rather than hitting the filesystem
+        self._check_layer_tile_coords(layer)
+        if (x, y) in self._coords[layer]:
+            return True
+        
+        # our record won't include tiles written since we read the layer by someone else (e.g. another ImagePyramid
+        # on the same directory), so check the disk before reporting a miss
+        if self._tilecache.exists(self._filename(layer, x, y)):
+            self._coords[layer][(x, y)] = True
+            return True
+        
+        return False
         
     def _check_layer_tile_coords(self, layer=0):
         if not layer in self._coords.keys():
@@ -169,11 +296,25 @@ class NumpyTileIO(TileIO):
             for fn in glob.glob(os.path.join(xdir, '*_%s' % self.suff)):
                 tiles.append(tuple([int(s) for s in os.path.basename(fn).split('_')[:2]]))
                 
-        self._coords[layer] = tiles
+        # use an (ordered) dictionary rather than a list for O(1) lookups and deletions
+        self._coords[layer] = collections.OrderedDict([(t, True) for t in tiles])
         
     def get_layer_tile_coords(self, layer=0):
         self._check_layer_tile_coords(layer)
-        return self._coords[layer]
+        return list(self._coords[layer].keys())
+    
+    def tile_version(self, layer, x, y):
+        try:
+            st = os.stat(self._filename(layer, x, y))
+            return (st.st_mtime, st.st_size)
+        except OSError:
+            return None
+        
+    def read_tile(self, layer, x, y):
+        try:
+            return self._tilecache._load(self._filename(layer, x, y))
+        except IOError:
+            return None
     
     def flush(self):
         self._tilecache.flush()
@@ -206,6 +347,8 @@ class SqliteTileIO(TileIO):
 
         self._known_tables =[r[0] for r in self._cur.execute("SELECT name FROM sqlite_master WHERE type='table'")]
         self._coords = {}
+        # {(layer, x, y): (first seen time, data hash)} used for tile versions, as sqlite doesn't record when rows change
+        self._versions = {}
         
         
     def get_tile(self, layer, x, y):
@@ -242,6 +385,25 @@ class SqliteTileIO(TileIO):
         
         return self._cur.execute('SELECT 1 FROM layer%d WHERE x=? AND y=?' % layer, (x, y)).fetchone() is not None
 
+    def tile_version(self, layer, x, y):
+        import hashlib
+        table = 'layer%d' % layer
+        if not table in self._known_tables:
+            return None
+        
+        r = self._cur.execute('SELECT data FROM layer%d WHERE x=? AND y=?' % layer, (x, y)).fetchone()
+        if r is None:
+            return None
+        
+        h = hashlib.md5(bytes(r[0])).hexdigest()
+        version = self._versions.get((layer, x, y), None)
+        if version is None or version[1] != h:
+            # the tile is new or has changed since we last looked
+            version = (time.time(), h)
+            self._versions[(layer, x, y)] = version
+            
+        return version
+
     def get_layer_tile_coords(self, layer=0):
         coords = self._cur.execute('SELECT x, y FROM layer%d' % layer).fetchall()
         #print coords
@@ -255,6 +417,11 @@ class SqliteTileIO(TileIO):
         self._conn.close()
     
 
+def _downsample(tile):
+    """Downsample a tile by a factor of 2 (in each dimension) by taking the mean of each 2x2 block of pixels"""
+    sx, sy = int(tile.shape[0] / 2), int(tile.shape[1] / 2)
+    return tile[:(2 * sx), :(2 * sy)].reshape(sx, 2, sy, 2).mean(3).mean(1)
+
 class ImagePyramid(object):
     def __init__(self, storage_directory, pyramid_tile_size=256, mdh=None, n_tiles_x = 0, n_tiles_y = 0, depth=0, x0=0, y0=0, pixel_size=1):
         self.base_dir = storage_directory
@@ -285,6 +452,11 @@ class ImagePyramid(object):
         self._imgs = PZFTileIO(base_dir=self.base_dir, suff='img')
         self._acc = PZFTileIO(base_dir=self.base_dir, suff='acc')
         self._occ = PZFTileIO(base_dir=self.base_dir, suff='occ')
+        
+        # base tiles whose (now stale) pyramid tiles have already been removed since the last pyramid update
+        self._cleaned = set()
+        # we don't know which tiles (if any) are out of date in an existing pyramid, so check everything on the first update
+        self._full_update = True
 
         # self._imgs = SqliteTileIO(base_dir=self.base_dir, suff='img')
         # self._acc = SqliteTileIO(base_dir=self.base_dir, suff='acc')
@@ -319,66 +491,113 @@ class ImagePyramid(object):
     def get_layer_tile_coords(self, level):
         return self._imgs.get_layer_tile_coords(level)
     
-    def _make_layer(self, inputLevel):
-        from scipy import ndimage
-
-        new_layer = inputLevel + 1
-        tile_coords = self.get_layer_tile_coords(inputLevel)
+    def get_tile_version(self, layer, x, y):
+        """
+        A token which changes whenever the tile is modified on disk, or None if the tile does not exist on disk. Used with
+        `read_tile` when serving a pyramid which may be being written by another process.
+        """
+        return self._imgs.tile_version(layer, x, y)
+    
+    def read_tile(self, layer, x, y):
+        """Read a tile directly from disk, bypassing the tile cache"""
+        return self._imgs.read_tile(layer, x, y)
+    
+    def _make_tile(self, inputLevel, xc, yc):
+        """Generate a tile in layer inputLevel + 1 by downsampling the 4 tiles below it"""
+        qsize = int(self.tile_size / 2)
+        tile = np.zeros([self.tile_size, self.tile_size])
         
-        #print('tile_coords:', tile_coords)
+        # NW, NE, SW, SE
+        for i, j in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+            subtile = self.get_tile(inputLevel, 2 * xc + i, 2 * yc + j)
+            if not subtile is None:
+                tile[(i * qsize):((i + 1) * qsize), (j * qsize):((j + 1) * qsize)] = _downsample(subtile)
         
-        qsize = int(self.tile_size / 2)
+        self._imgs.save_tile(inputLevel + 1, xc, yc, tile)
+    
+    def _make_layer(self, inputLevel, tile_coords=None):
+        """
+        Generate layer inputLevel + 1 from inputLevel.
+        
+        Parameters
+        ----------
+        inputLevel : int
+        tile_coords : set of tuples, optional
+            The tiles in inputLevel which have changed. If provided, all their parents are regenerated. Any missing
+            tiles in the new layer are generated in either case (the new layer might not have been built before, e.g.
+            if new tiles have made the pyramid deeper).
+
+        Returns
+        -------
+        new_tile_coords : set
+            the coordinates of the new layer tiles which were (or, if not changed, would have been) generated
+        """
+        new_layer = inputLevel + 1
         
-        new_tile_coords = list(set([tuple(np.floor(np.array(tc) / 2).astype('i').tolist()) for tc in tile_coords]))
-        #print('new_tile_coords:', new_tile_coords)
+        all_parents = set([(int(xc // 2), int(yc // 2)) for xc, yc in self.get_layer_tile_coords(inputLevel)])
+        missing = set([tc for tc in all_parents if not self._imgs.tile_exists(new_layer, *tc)])
         
-        for xc, yc in new_tile_coords:
-            if not self._imgs.tile_exists(new_layer, xc, yc):
-                tile = np.zeros([self.tile_size, self.tile_size])
-                
-                NW = self.get_tile(inputLevel, 2 * xc, 2 * yc)
-                if not NW is None:
-                    tile[:qsize, :qsize] = ndimage.zoom(NW, .5)
-                    #print(xc, yc, 'NW')
-                
-                NE = self.get_tile(inputLevel, (2 * xc) + 1, (2 * yc))
-                if not NE is None:
-                    tile[qsize:, :qsize] = ndimage.zoom(NE, .5)
-                    #print(xc, yc, 'NE')
-                
-                SW = self.get_tile(inputLevel, (2 * xc), (2 * yc) + 1)
-                if not SW is None:
-                    tile[:qsize, qsize:] = ndimage.zoom(SW, .5)
-                    #print(xc, yc, 'SW')
-                
-                SE = self.get_tile(inputLevel, (2 * xc) + 1, (2 * yc) + 1)
-                if not SE is None:
-                    tile[qsize:, qsize:] = ndimage.zoom(SE, .5)
-                    #print(xc, yc, 'SE')
-                
-                self._imgs.save_tile(new_layer, xc, yc, tile)
+        if tile_coords is None:
+            new_tile_coords = all_parents
+            to_build = list(missing)
+        else:
+            new_tile_coords = set([(int(xc // 2), int(yc // 2)) for xc, yc in tile_coords]) | missing
+            to_build = list(new_tile_coords)
+            
+        # make sure the layer tile list is populated before we start saving tiles from multiple threads
+        self._imgs.get_layer_tile_coords(new_layer)
         
-        return len(new_tile_coords)
+        thread_pools.parallel_map(lambda tc: self._make_tile(inputLevel, *tc), to_build)
+        
+        return new_tile_coords
     
-    def _rebuild_base(self):
-        for xc, yc in self._occ.get_layer_tile_coords(0):
-            if not self._imgs.tile_exists(0, xc, yc):
-                    occ = self._occ.get_tile(0, xc, yc) + 1e-9
-                    sf = 1.0 / occ
-                    sf[occ <= .1] = 0
-                    tile_ = self._acc.get_tile(0, xc, yc) * sf
+    def _rebuild_base(self, tile_coords=None):
+        """
+        Normalise the accumulator tiles by the occupancy to give the base layer of the pyramid.
+        
+        If tile_coords is given, these tiles are rebuilt, otherwise we rebuild any base tiles which are missing.
+        """
+        if tile_coords is None:
+            tile_coords = [tc for tc in self._occ.get_layer_tile_coords(0) if not self._imgs.tile_exists(0, *tc)]
+            
+        for xc, yc in tile_coords:
+            occ = self._occ.get_tile(0, xc, yc) + 1e-9
+            sf = 1.0 / occ
+            sf[occ <= .1] = 0
+            tile_ = self._acc.get_tile(0, xc, yc) * sf
 
-                    self._imgs.save_tile(0, xc, yc, tile_)
+            self._imgs.save_tile(0, xc, yc, tile_)
     
     def update_pyramid(self):
-        self._rebuild_base()
+        """
+        Regenerate the pyramid after base tiles have been added.
+        
+        The first time this is called for an ImagePyramid object we regenerate any missing tiles. After that (as we know
+        which base tiles have been modified by add_base_tile) we only regenerate the modified tiles and their ancestors,
+        along with any missing tiles in the upper layers (e.g. if the new tiles have made the pyramid deeper).
+        """
+        if self._full_update:
+            dirty = None
+        else:
+            dirty = set(self._cleaned)
+            
+        self._rebuild_base(dirty)
         inputLevel = 0
         
-        while self._make_layer(inputLevel) > 1:
+        while True:
+            new_tile_coords = self._make_layer(inputLevel, dirty)
+            if dirty is not None:
+                dirty = new_tile_coords
+                
+            if len(self.get_layer_tile_coords(inputLevel + 1)) <= 1:
+                break
+                
             inputLevel += 1
         
         self.pyramid_valid = True
         self.depth = inputLevel
+        self._cleaned.clear()
+        self._full_update = False
         self._imgs.flush()
     
     def _clean_tiles(self, x, y):
@@ -448,7 +667,11 @@ class ImagePyramid(object):
                 self._acc.save_tile(0, tile_x, tile_y, acc_)
                 self._occ.save_tile(0, tile_x, tile_y, occ_)
                 
-                self._clean_tiles(tile_x, tile_y)
+                if not (tile_x, tile_y) in self._cleaned:
+                    # the pyramid tiles above this one are not regenerated until the next update_pyramid, so we only
+                    # need to clean them once
+                    self._clean_tiles(tile_x, tile_y)
+                    self._cleaned.add((tile_x, tile_y))
         
         self.pyramid_valid = False
 
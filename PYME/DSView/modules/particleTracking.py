@@ -337,7 +337,8 @@ class ParticleTrackingView(HasTraits):
             if view.do.zp >=1:
                 iCurr = view.do.zp
                 iPrev = view.do.zp-1
-                links = self.tracker.tracker.calcLinkages(iCurr, iPrev)
+                from PYME.Analysis.Tracking.tracking import linkages_by_object
+                links = linkages_by_object(self.tracker.tracker.calcLinkages(iCurr, iPrev))
                 
                 #pRed = wx.Pen(wx.TheColourDatabase.FindColour('RED'),2)
                 pRedDash = wx.Pen(wx.TheColourDatabase.FindColour('RED'),2, wx.SHORT_DASH)
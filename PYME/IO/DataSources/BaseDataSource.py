@@ -22,6 +22,9 @@
 ################
 
 import numpy as np
+import threading
+from collections import OrderedDict
+
 class DefaultList(list):
     """List which returns a default value for items not in the list"""
     def __init__(self, *args):
@@ -34,6 +37,52 @@ class DefaultList(list):
             return 1
 
 
+class FrameCache(object):
+    """
+    Thread-safe LRU cache of frames, for data sources where getting a frame is expensive (e.g. decompression,
+    filtering, or a network round trip).
+    
+    Cached frames are shared by every caller of `get`, so they are made read-only when added. Data sources should hand
+    out copies.
+    """
+    def __init__(self, max_size):
+        self._max_size = max_size
+        # most recently used frames are at the end
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def __len__(self):
+        return len(self._frames)
+    
+    def __contains__(self, ind):
+        return ind in self._frames
+    
+    def keys(self):
+        """Frame indices, from least to most recently used"""
+        with self._lock:
+            return list(self._frames.keys())
+        
+    def get(self, ind):
+        """Return the cached frame (marking it as most recently used), or None if it isn't cached"""
+        with self._lock:
+            frame = self._frames.pop(ind, None)
+            if frame is not None:
+                self._frames[ind] = frame
+            
+            return frame
+        
+    def put(self, ind, frame):
+        """Add a frame, evicting the least recently used frames if the cache is full"""
+        frame.flags.writeable = False
+        
+        with self._lock:
+            self._frames.pop(ind, None)
+            self._frames[ind] = frame
+            
+            while len(self._frames) > self._max_size:
+                self._frames.popitem(last=False)
+
+
 class BaseDataSource(object):
     oldData = None
     oldSlice = None
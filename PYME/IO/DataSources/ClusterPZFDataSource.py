@@ -23,7 +23,7 @@
 
 #from PYME.ParallelTasks.relativeFiles import getFullFilename
 #import tables
-from .BaseDataSource import BaseDataSource
+from .BaseDataSource import BaseDataSource, FrameCache
 
 #import httplib
 #import urllib
@@ -33,11 +33,24 @@ import time
 import json
 #import pandas as pd
 import numpy as np
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
 SHAPE_LIFESPAN = 5
 
 from PYME.IO import clusterIO
 from PYME.IO import PZFFormat
 from PYME.IO import MetaDataHandler
+from PYME import config
+from PYME.misc import thread_pools
+
+# number of threads used (across all data sources) to fetch and decode frames in the background
+NUM_PREFETCH_THREADS = int(config.get('clusterpzf-prefetch-threads', 4))
+# how many frames after the one just requested to fetch in the background
+READAHEAD = int(config.get('clusterpzf-readahead', 10))
+# maximum number of decoded frames to keep for each data source
+CACHE_SIZE = int(config.get('clusterpzf-cache-size', 100))
 
 class DataSource(BaseDataSource):
     moduleName = 'ClusterPZFDataSource'
@@ -59,19 +72,117 @@ class DataSource(BaseDataSource):
         
         self.fshape = None#(self.mdh['Camera.ROIWidth'],self.mdh['Camera.ROIHeight'])
         
+        # decoded frames, and frames which are being fetched in the background
+        self._cache = FrameCache(CACHE_SIZE)
+        self._pending = {}
+        self._cacheLock = threading.Lock()
+        
+        self._complete = False
+        self.numFrames = 0
         self._getNumFrames()
     
+    def _frameName(self, ind):
+        return '%s/frame%05d.pzf' % (self.sequenceName, ind)
+    
+    def _frameExists(self, ind):
+        # use locate_file rather than clusterIO.exists, as the latter falls back to listing the series directory
+        # on a miss. Hits are cached by clusterIO, so re-probing frames we have already found is cheap.
+        return len(clusterIO.locate_file(self._frameName(ind), self.clusterfilter, True)) > 0
+    
     def _getNumFrames(self):
-        frameNames = [f for f in clusterIO.listdir(self.sequenceName, self.clusterfilter) if f.endswith('.pzf')]
-        self.numFrames = len(frameNames)
+        # Rather than listing the series directory (which gets expensive for long series), probe for frames past the
+        # ones we already know about. Frames are spooled in order, so we can step forwards in increasing strides until
+        # we find a missing frame, and then bisect to find the last frame which has been spooled.
+        complete = self.isComplete()
+        
+        n = self.numFrames
+        if self._frameExists(n):
+            last, step = n, 1
+            while self._frameExists(n + step):
+                last = n + step
+                step *= 2
+            
+            missing = n + step
+            while (missing - last) > 1:
+                mid = (last + missing) // 2
+                if self._frameExists(mid):
+                    last = mid
+                else:
+                    missing = mid
+            
+            with self._cacheLock:
+                self.numFrames = max(self.numFrames, last + 1)
+        
         self.lastShapeTime = time.time()
+        self._complete = complete
+        
+    def _loadSlice(self, ind):
+        frameName = self._frameName(ind)
+        # NB - for uncompressed frames this is a (read-only) view onto the downloaded data, rather than a copy
+        sl = PZFFormat.loads_view(clusterIO.get_file(frameName, self.clusterfilter))[0].squeeze()
+        
+        self._cache.put(ind, sl)
+        
+        with self._cacheLock:
+            # frames are spooled in order, so if we could get this one, we have at least this many frames
+            self.numFrames = max(self.numFrames, ind + 1)
+        
+        return sl
+    
+    def _prefetchSlice(self, ind):
+        try:
+            self._loadSlice(ind)
+        except Exception:
+            # the frame might not have been spooled yet - leave it to getSlice to report any errors
+            logger.debug('Error prefetching frame %d of %s' % (ind, self.sequenceName))
+        finally:
+            with self._cacheLock:
+                self._pending.pop(ind, None)
+    
+    def prefetch(self, indices):
+        """
+        Start fetching (and decoding) frames in the background so that they are ready when getSlice is called.
+        
+        Parameters
+        ----------
+        indices : list of int
+            the frames we expect to need soon (e.g. the background frames for a localization task).
+        """
+        # fetching is mostly waiting on the network, so use a separate pool rather than the shared compute pool
+        pool = thread_pools.get_pool('clusterpzf-prefetch', NUM_PREFETCH_THREADS)
+        with self._cacheLock:
+            for ind in indices:
+                # don't try frames which (as far as we know) haven't been spooled yet - get_file retries (with a
+                # delay) on missing files, which would tie up the pool.
+                if (ind < 0) or (ind >= self.numFrames):
+                    continue
+                    
+                if not (ind in self._cache or ind in self._pending):
+                    self._pending[ind] = pool.apply_async(self._prefetchSlice, (ind,))
     
     def getSlice(self, ind):
-        frameName = '%s/frame%05d.pzf' % (self.sequenceName, ind)
-        sl = PZFFormat.loads(clusterIO.get_file(frameName, self.clusterfilter))[0]
+        sl = self._cache.get(ind)
+        
+        if sl is None:
+            with self._cacheLock:
+                pending = self._pending.get(ind, None)
+                
+            if pending is not None:
+                # already being fetched - wait for it
+                pending.wait()
+            
+            # check the cache again, as the frame might have been prefetched since we last looked
+            sl = self._cache.get(ind)
+            if sl is None:
+                sl = self._loadSlice(ind)
+        
+        if READAHEAD > 0:
+            self.prefetch(range(ind + 1, ind + 1 + READAHEAD))
         
         #print sl.shape, sl.dtype
-        return sl.squeeze()
+        # the cached frame may be a read-only view onto the downloaded data, and is shared with later callers, so
+        # return a copy which the caller is free to modify.
+        return sl.copy()
 
     def getSliceShape(self):
         if self.fshape is None:
@@ -80,7 +191,7 @@ class DataSource(BaseDataSource):
         
     def getNumSlices(self):
         t = time.time()
-        if (t-self.lastShapeTime) > SHAPE_LIFESPAN:
+        if (not self._complete) and ((t-self.lastShapeTime) > SHAPE_LIFESPAN):
             self._getNumFrames()
             
         return self.numFrames
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+##################
+# FilterDataSource.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##################
+
+from .BaseDataSource import BaseDataSource, FrameCache
+import numpy as np
+
+from PYME import config
+
+# maximum number of filtered frames to keep for each data source
+CACHE_SIZE = int(config.get('filterdatasource-cache-size', 100))
+
+class DataSource(BaseDataSource):
+    """
+    A data source whose frames are computed on demand by applying a function to the corresponding frames of one or
+    more input images (used for lazy evaluation of recipe filters). The most recently computed frames are cached.
+    """
+    moduleName = 'FilterDataSource'
+    additionalDims = 'TC'
+    
+    def __init__(self, inputs, func, cache_size=CACHE_SIZE):
+        """
+        
+        Parameters
+        ----------
+        inputs : list
+            the input image data (e.g. `ImageStack.data`). All inputs should have the same shape.
+        func : callable
+            called as ``func(frames, chanNum, frameNum)``, where ``frames`` is a list of the (float32) input frames,
+            and returning the filtered 2D frame.
+        cache_size : int
+            maximum number of filtered frames to cache
+        """
+        self._inputs = inputs
+        self._func = func
+        
+        shape = inputs[0].shape
+        self._sizeZ = shape[2]
+        self.sizeC = shape[3]
+        
+        self._sliceShape = None
+        
+        self._cache = FrameCache(cache_size)
+        
+    def getSlice(self, ind):
+        # cached frames are read-only (they are shared between callers), so we return a copy which the caller is free
+        # to modify.
+        sl = self._cache.get(ind)
+        if sl is None:
+            sl = self._filter_slice(ind)
+            self._cache.put(ind, sl)
+            
+        return sl.copy()
+    
+    def _filter_slice(self, ind):
+        chanNum, frameNum = divmod(ind, self._sizeZ)
+        frames = [d[:, :, frameNum, chanNum].squeeze().astype('f') for d in self._inputs]
+        sl = np.atleast_3d(self._func(frames, chanNum, frameNum))
+        
+        if sl.shape[2] != 1:
+            raise RuntimeError('Filter returned %d frames for a single input frame' % sl.shape[2])
+        
+        return sl[:, :, 0]
+
+    def getSliceShape(self):
+        if self._sliceShape is None:
+            self._sliceShape = self.getSlice(0).shape
+        return self._sliceShape
+
+    def getNumSlices(self):
+        return self._sizeZ * self.sizeC
+
+    def getEvents(self):
+        return []
@@ -23,22 +23,36 @@
 
 from PYME.IO.FileUtils.nameUtils import getFullExistingFilename
 import tables
-from .BaseDataSource import BaseDataSource
+from .BaseDataSource import BaseDataSource, FrameCache
 import numpy as np
+import os
+import mmap
+import threading
+
+from PYME import config
 
 try:
     from PYME.IO import PZFFormat
 except ImportError:
     pass
 
+# number of contiguous frames to read (and decode) in one go when a frame is not already cached
+BLOCK_SIZE = int(config.get('hdfdatasource-block-size', 16))
+# maximum number of decoded frames to keep for each data source
+CACHE_SIZE = int(config.get('hdfdatasource-cache-size', 100))
+# memory-map uncompressed image data (rather than reading it through pytables) where the chunk layout allows
+USE_MMAP = config.get('hdfdatasource-use-mmap', True)
+
 class DataSource(BaseDataSource):
     moduleName = 'HDFDataSource'
     def __init__(self, h5Filename, taskQueue=None):
         self.h5Filename = getFullExistingFilename(h5Filename)#convert relative path to full path
-        self.h5File = tables.open_file(self.h5Filename)
         
-        self._pzf_index = None
-
+        # LRU cache of decoded frames, shared by everything reading from this data source
+        self._cache = FrameCache(CACHE_SIZE)
+        self._lock = threading.RLock()
+        
+        self._open()
         
         if getattr(self.h5File.root, 'PZFImageIndex', False):
             self.usePZFFormat = True
@@ -48,22 +62,118 @@ class DataSource(BaseDataSource):
                 self.framesize = PZFFormat.loads(self.h5File.root.PZFImageData[0])[0].squeeze().shape
         else:
             self.usePZFFormat = False
-
-    def getSlice(self, ind):
+            
+    def _open(self):
+        self.h5File = tables.open_file(self.h5Filename)
+        self._file_size = os.path.getsize(self.h5Filename)
+        
+        self._pzf_index = None
+        
+        self._mmap = None
+        self._chunk_offsets = {}
+        
+    @property
+    def _imageNode(self):
+        if self.usePZFFormat:
+            return self.h5File.root.PZFImageData
+        else:
+            return self.h5File.root.ImageData
+        
+    def _mmap_offset(self, ind):
+        """
+        The offset of a frame within the file if we can memory-map it, otherwise None. We can map frames if the image
+        data is uncompressed and chunked by whole frames, and if pytables can tell us where chunks are stored
+        (Leaf.chunk_info, pytables >= 3.8).
+        """
+        node = self.h5File.root.ImageData
+        chunkshape = node.chunkshape
+        
+        if not (USE_MMAP and hasattr(node, 'chunk_info') and chunkshape and tuple(chunkshape[1:]) == tuple(node.shape[1:]) and node.filters.complevel == 0
+                and not node.filters.fletcher32):
+            return None
+        
+        chunk_start = (ind // chunkshape[0]) * chunkshape[0]
+        chunk_offset = self._chunk_offsets.get(chunk_start, None)
+        if chunk_offset is None:
+            info = node.chunk_info((chunk_start,) + (0,) * (len(chunkshape) - 1))
+            if (info.offset is None) or (info.filter_mask != 0) or (info.size != np.prod(chunkshape) * node.atom.itemsize):
+                return None
+            
+            chunk_offset = self._chunk_offsets[chunk_start] = info.offset
+            
+        return chunk_offset + (ind - chunk_start) * int(np.prod(node.shape[1:])) * node.atom.itemsize
+        
+    def _get_mapped_slice(self, ind):
+        offset = self._mmap_offset(ind)
+        if offset is None:
+            return None
+        
+        node = self.h5File.root.ImageData
+        dtype = np.dtype(node.atom.dtype).newbyteorder('<' if node.byteorder == 'little' else '>')
+        nbytes = int(np.prod(node.shape[1:])) * dtype.itemsize
+        
+        if (self._mmap is None) or (offset + nbytes > len(self._mmap)):
+            # (re)map the file (it might have grown since we last mapped it). NB - we don't close the old map as frames
+            # we have returned might still reference it - it gets closed once they are garbage collected.
+            with open(self.h5Filename, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        return np.ndarray(node.shape[1:], dtype, buffer=self._mmap, offset=offset)
+    
+    def _read_block(self, ind):
+        """Read (and decode) a block of contiguous frames starting at ind, add them to the cache, and return frame ind"""
+        end = min(ind + BLOCK_SIZE, self.getNumSlices())
+        
         if self.usePZFFormat:
-            if ind >= self.h5File.root.PZFImageData.shape[0]:
-                self.reloadData() #try
-                
             if not self.pzf_index is None:
-                ind = self.pzf_index['Position'][np.searchsorted(self.pzf_index['FrameNum'], ind)]
+                positions = self.pzf_index['Position'][np.searchsorted(self.pzf_index['FrameNum'], np.arange(ind, end))]
+            else:
+                positions = np.arange(ind, end)
+            
+            if (len(positions) > 1) and np.all(np.diff(positions) == 1):
+                raw = self.h5File.root.PZFImageData[positions[0]:(positions[-1] + 1)]
+            else:
+                raw = [self.h5File.root.PZFImageData[p] for p in positions]
+                
+            frames = [PZFFormat.loads(r)[0].squeeze() for r in raw]
+        else:
+            frames = self.h5File.root.ImageData[ind:end, :, :]
             
-            return PZFFormat.loads(self.h5File.root.PZFImageData[ind])[0].squeeze() 
-        else:       
-            if ind >= self.h5File.root.ImageData.shape[0]:
-                    self.reloadData() #try reloading the data in case it's grown
+        for i, frame in enumerate(frames):
+            self._cache.put(ind + i, frame)
             
-            return self.h5File.root.ImageData[ind, :,:]
+        return frames[0]
+    
+    def _check_growth(self):
+        """Re-open the file if it has grown on disk (e.g. because it is still being spooled)"""
+        try:
+            size = os.path.getsize(self.h5Filename)
+        except OSError:
+            return
+        
+        if size != self._file_size:
+            self.reloadData()
 
+    def getSlice(self, ind):
+        with self._lock:
+            if ind < 0:
+                ind += self.getNumSlices()
+            
+            if ind >= self._imageNode.shape[0]:
+                self._check_growth()
+        
+            # NB - mapped and cached frames are read-only (they are shared with the file / other callers), so we return
+            # a copy which the caller is free to modify.
+            if not self.usePZFFormat:
+                sl = self._get_mapped_slice(ind)
+                if sl is not None:
+                    return sl.copy()
+                
+            sl = self._cache.get(ind)
+            if sl is not None:
+                return sl.copy()
+            
+            return self._read_block(ind).copy()
     @property
     def pzf_index(self):
         if self._pzf_index is None:
@@ -95,8 +205,11 @@ class DataSource(BaseDataSource):
             return []
 
     def release(self):
+        # frames we have returned might still reference the memory map, so just drop our reference to it
+        self._mmap = None
         self.h5File.close()
 
     def reloadData(self):
-        self.h5File.close()
-        self.h5File = tables.open_file(self.h5Filename)
+        with self._lock:
+            self.release()
+            self._open()
@@ -30,59 +30,84 @@ except ImportError:
     logging.warning('''Could not import pymecompress library - saving or loading compressed PZF will fail
     (the library is installable from david_baddely conda channel, but requires an AVX capable processor)''')
 
-NUM_COMP_THREADS = 2#cpu_count()
+from PYME import config
+from PYME.misc import thread_pools
 
-compPool = ThreadPool(NUM_COMP_THREADS)
+# don't break frames into chunks smaller than this (in bytes) - for small frames the overhead dominates
+MIN_CHUNK_SIZE = int(config.get('pzf-min-chunk-size', 2**16))
 
-def ChunkedHuffmanCompress(data, quantization=None):
-    num_chunks = NUM_COMP_THREADS
+def _as_bytes_buffer(a):
+    """A (flat, unsigned byte) buffer onto a contiguous numpy array or bytes-like object, without copying"""
+    if isinstance(a, np.ndarray):
+        # NB - ravel in memory order so that Fortran ordered data is not copied
+        return memoryview(a.ravel(order='K').view('u1'))
     
-    chunk_size = int(np.ceil(float(len(data))/num_chunks))
-    raw_chunks = [data[j*chunk_size:(j+1)*chunk_size].data for j in range(num_chunks)]
-    
-    #compPool = ThreadPool(NUM_COMP_THREADS)
-    
-    comp_chunk_d = {}
+    return memoryview(np.frombuffer(a, 'u1'))
 
-    if quantization is None:
-        def _compChunk(c, j):
-            comp_chunk_d[j] = bcl.HuffmanCompress(c)
+def _num_chunks(nbytes, num_chunks=None):
+    if num_chunks is None:
+        num_chunks = min(thread_pools.COMPUTE_THREADS, nbytes//MIN_CHUNK_SIZE)
+        
+    return int(max(min(num_chunks, 2**16 - 1), 1))
 
-        threads = [threading.Thread(target = _compChunk, args=(rc, j)) for j, rc in enumerate(raw_chunks)]
+def _compress_chunk(args):
+    chunk, quantization = args
+    if quantization is None:
+        return bcl.HuffmanCompress(chunk.view('u1'))
     else:
-        def _compChunk(c, j):
-            comp_chunk_d[j] = bcl.HuffmanCompressQuant(c, *quantization)
-
-        threads = [threading.Thread(target=_compChunk, args=(rc, j)) for j, rc in enumerate(raw_chunks)]
-            
-    for p in threads:
-        #print p
-        p.start()
-
-    for p in threads:
-        p.join()
+        return bcl.HuffmanCompressQuant(chunk, *quantization)
 
+def _chunked_huffman_pieces(data, quantization=None, num_chunks=None):
+    """Compress data in parallel chunks, returning the encoded stream as a list of buffers (see ChunkedHuffmanCompress)"""
+    # chunk the data in memory order, on pixel boundaries
+    data = np.asarray(data).ravel(order='K')
+    num_chunks = _num_chunks(data.nbytes, num_chunks)
     
-    #comp_chunks = compPool.map(bcl.HuffmanCompress, raw_chunks) 
+    chunk_size = int(np.ceil(float(len(data))/num_chunks))
+    raw_chunks = [data[j*chunk_size:(j+1)*chunk_size] for j in range(num_chunks)]
     
-    s = np.array([num_chunks], 'u2').tostring()
+    if num_chunks == 1:
+        comp_chunks = [_compress_chunk((raw_chunks[0], quantization))]
+    else:
+        comp_chunks = thread_pools.parallel_map(_compress_chunk, [(rc, quantization) for rc in raw_chunks])
     
-    for j, r in enumerate(raw_chunks):
-        c = comp_chunk_d[j]
-        s += np.array([len(c), len(r)], 'u4').tostring()
-        s += c.tostring()
+    pieces = [np.array([num_chunks], 'u2')]
+    
+    for c, r in zip(comp_chunks, raw_chunks):
+        # quantized data decompresses to one byte per pixel
+        raw_len = r.nbytes if quantization is None else r.size
+        pieces.append(np.array([len(c), raw_len], 'u4'))
+        pieces.append(c)
         
-    return s
+    return pieces
+
+def ChunkedHuffmanCompress(data, quantization=None, num_chunks=None):
+    """
+    Huffman compress data by splitting it into chunks which are compressed in parallel on the shared compute pool.
+    
+    Parameters
+    ----------
+    data : ndarray
+        data to compress. Chunks are taken in memory order.
+    quantization : tuple or None
+        (offset, scale) if the data should be sqrt-quantized before compression (see `dumps`)
+    num_chunks : int or None
+        number of chunks to split the data into. If None, use one chunk per compute thread, limited so that chunks
+        are at least MIN_CHUNK_SIZE bytes.
+
+    Returns
+    -------
+    bytes
+    """
+    return b''.join([_as_bytes_buffer(p).tobytes() for p in _chunked_huffman_pieces(data, quantization, num_chunks)])
 
 def ChunkedHuffmanCompress_o(data):
-    num_chunks = NUM_COMP_THREADS
+    num_chunks = thread_pools.COMPUTE_THREADS
     
     chunk_size = int(np.ceil(float(len(data))/num_chunks))
     raw_chunks = [data[j*chunk_size:(j+1)*chunk_size].data for j in range(num_chunks)]
     
-    #compPool = ThreadPool(NUM_COMP_THREADS)
-    
-    comp_chunks = compPool.map(bcl.HuffmanCompress, raw_chunks) 
+    comp_chunks = thread_pools.parallel_map(bcl.HuffmanCompress, raw_chunks) 
     
     s = np.array([num_chunks], 'u2').tostring()
     
@@ -94,26 +119,34 @@ def ChunkedHuffmanCompress_o(data):
 
 def _chunkDecompress(args):
     chunk, length = args
-    return bcl.HuffmanDecompress(np.fromstring(chunk, 'u1'), length)
+    return _huffman_decompress(chunk, length)
     
-def ChunkedHuffmanDecompress(datastring):
-    num_chunks = np.fromstring(datastring[:2], 'u2')
+def ChunkedHuffmanDecompress(datastring, offset=0):
+    # NB - chunks are read as views onto datastring rather than being sliced (and copied) out of it
+    buf = np.frombuffer(datastring, 'u1')
+    num_chunks = int(buf[offset:(offset + 2)].view('u2')[0])
     
-    #compPool = ThreadPool(NUM_COMP_THREADS)
-    
-    sp = 2
+    sp = offset + 2
     
     comp_chunks = []
     for i in range(num_chunks):
-        chunk_len, raw_len = np.fromstring(datastring[sp:(sp+8)], 'u4')
+        chunk_len, raw_len = [int(l) for l in buf[sp:(sp+8)].copy().view('u4')]
         sp += 8
-        comp_chunks.append((datastring[sp:(sp+ chunk_len)], raw_len))
+        comp_chunks.append((buf[sp:(sp+ chunk_len)], raw_len))
         sp += chunk_len
         
     
-    decomp_chunks = compPool.map(_chunkDecompress, comp_chunks) 
+    if num_chunks == 1:
+        decomp_chunks = [_chunkDecompress(comp_chunks[0])]
+    else:
+        decomp_chunks = thread_pools.parallel_map(_chunkDecompress, comp_chunks)
     
-    data = np.hstack(decomp_chunks)
+    # copy the chunks into a single pre-allocated output rather than using np.hstack
+    data = np.empty(sum([l for c, l in comp_chunks]), 'u1')
+    sp = 0
+    for c in decomp_chunks:
+        data[sp:(sp + len(c))] = c
+        sp += len(c)
     
     #print data.shape #, comp_chunks
     return data
@@ -185,40 +218,9 @@ HEADER_LENGTH = np.zeros(1, header_dtype).nbytes
 
 HEADER_LENGTH_V3 = np.zeros(1, header_dtype_v3).nbytes
 
-def dumps(data, sequenceID=0, frameNum=0, frameTimestamp=0, compression = DATA_COMP_RAW, quantization=DATA_QUANT_NONE, quantizationOffset=0, quantizationScale=1):
-    """Dump an image frame (supplied as a numpy array) into a string in PZF format.
-    
-    Parameters
-    ==========
-
-    data:  ndarray
-            The frame as a 2D (or optionally 3D) numpy array
-    
-    sequenceID:  int
-            A unique identifier for the sequence to which this frame belongs.
-            This will let us connect the frame with it's metadata even if
-            they end up in different directories etc ...
-                 
-    frameNum:   int
-            The position of this frame within the sequence
-    
-    frameTimestamp:  float
-            A timestamp for the frame (if provided by the camera)
-    
-    compression:  int (enum)
-            compression method to use - one of: `PZFFormat.DATA_COMP_RAW`,
-            `PZFFormat.DATA_COMP_HUFFCODE`, or `PZFFormat.DATA_COMP_HUFFCODE_CHUNKS`
-            Where raw stores the data with no compression, huffcode uses
-            Huffman coding, and huffcode chunks breaks the data into chunks
-            first, with each chunk meing encodes by a separate thread.
-                  
-    quantization: int (enum)
-            Whether or not the data is quantized before saving.
-            One of `DATA_QUANT_NONE` or `DATA_QUANT_SQRT`. If `DATA_QUANT_SQRT`
-            is selected, then the data is quantized as follows prior to
-            compression:
-                  
-            .. math:: data_{quant} =  \\frac{\\sqrt{data - quantizationOffset}}{quantizationScale}
+def _encode(data, sequenceID=0, frameNum=0, frameTimestamp=0, compression = DATA_COMP_RAW, quantization=DATA_QUANT_NONE, quantizationOffset=0, quantizationScale=1, numChunks=None):
+    """Encode an image frame (supplied as a numpy array) in PZF format, returning the header and data as a list of
+    (unsigned byte) memoryviews. Raw data is not copied. See :func:`dumps` for parameters.
     """
     
     header = np.zeros(1, header_dtype_v3)
@@ -271,27 +273,122 @@ def dumps(data, sequenceID=0, frameNum=0, frameTimestamp=0, compression = DATA_C
         header['DataCompression'] = DATA_COMP_HUFFCODE
 
         if quantization:
-            dataString = bcl.HuffmanCompressQuant(d1, quantizationOffset, quantizationScale).tostring()
+            pieces = [bcl.HuffmanCompressQuant(d1, quantizationOffset, quantizationScale)]
         else:
-            d2 = bcl.HuffmanCompress(d1)
-            dataString = d2.tostring()
+            pieces = [bcl.HuffmanCompress(d1)]
     elif compression == DATA_COMP_HUFFCODE_CHUNKS:
         header['DataCompression'] = DATA_COMP_HUFFCODE_CHUNKS
         
-        dataString = ChunkedHuffmanCompress(d1)
+        if quantization:
+            pieces = _chunked_huffman_pieces(d1, (quantizationOffset, quantizationScale), numChunks)
+        else:
+            pieces = _chunked_huffman_pieces(d1, None, numChunks)
     else:
         #print('saving raw')
         #print(header['DimOrder'][0])
-        dataString = d1.tostring(order=header['DimOrder'][0])
+        # d1 is contiguous in DimOrder, so this is a view onto the data, not a copy
+        pieces = [d1]
         
-    return header.tostring() + dataString
+    return [_as_bytes_buffer(p) for p in [header] + pieces]
+
+
+def dumps(data, sequenceID=0, frameNum=0, frameTimestamp=0, compression = DATA_COMP_RAW, quantization=DATA_QUANT_NONE, quantizationOffset=0, quantizationScale=1, numChunks=None):
+    """Dump an image frame (supplied as a numpy array) into a string in PZF format.
+    
+    See also :func:`dumps_into`, which writes into an existing buffer.
+    
+    Parameters
+    ==========
+
+    data:  ndarray
+            The frame as a 2D (or optionally 3D) numpy array
+    
+    sequenceID:  int
+            A unique identifier for the sequence to which this frame belongs.
+            This will let us connect the frame with it's metadata even if
+            they end up in different directories etc ...
+                 
+    frameNum:   int
+            The position of this frame within the sequence
+    
+    frameTimestamp:  float
+            A timestamp for the frame (if provided by the camera)
+    
+    compression:  int (enum)
+            compression method to use - one of: `PZFFormat.DATA_COMP_RAW`,
+            `PZFFormat.DATA_COMP_HUFFCODE`, or `PZFFormat.DATA_COMP_HUFFCODE_CHUNKS`
+            Where raw stores the data with no compression, huffcode uses
+            Huffman coding, and huffcode chunks breaks the data into chunks
+            first, with each chunk meing encodes by a separate thread.
+                  
+    quantization: int (enum)
+            Whether or not the data is quantized before saving.
+            One of `DATA_QUANT_NONE` or `DATA_QUANT_SQRT`. If `DATA_QUANT_SQRT`
+            is selected, then the data is quantized as follows prior to
+            compression:
+                  
+            .. math:: data_{quant} =  \\frac{\\sqrt{data - quantizationOffset}}{quantizationScale}
+                  
+    numChunks: int
+            The number of chunks to use with `DATA_COMP_HUFFCODE_CHUNKS`. By default this adapts to the frame size
+            and the number of compute threads (see `ChunkedHuffmanCompress`).
+    """
+    pieces = _encode(data, sequenceID, frameNum, frameTimestamp, compression, quantization, quantizationOffset,
+                     quantizationScale, numChunks)
+    
+    if six.PY2:
+        # python 2 can't join memoryviews
+        pieces = [p.tobytes() for p in pieces]
+        
+    return b''.join(pieces)
+
+
+def dumps_into(buf, data, offset=0, **kwargs):
+    """
+    Dump an image frame in PZF format into a pre-allocated buffer, avoiding the intermediate strings created by
+    :func:`dumps`.
+    
+    Parameters
+    ----------
+    buf : bytearray or writable buffer
+        The buffer to write into. If `buf` is a bytearray (and is not currently exported, e.g. to a memoryview) it is
+        extended if the encoded frame does not fit, otherwise a ValueError is raised.
+    data : ndarray
+        The frame as a 2D (or optionally 3D) numpy array
+    offset : int
+        The position in `buf` at which to start writing
+    kwargs :
+        Encoding options, as for :func:`dumps`
+
+    Returns
+    -------
+    end : int
+        The offset in `buf` of the end of the encoded frame (i.e. the offset to use for the next frame if packing several
+        frames into one buffer).
+    """
+    pieces = _encode(data, **kwargs)
+    end = offset + sum([p.nbytes for p in pieces])
+    
+    if len(buf) < end:
+        if isinstance(buf, bytearray):
+            buf.extend(b'\x00'*(end - len(buf)))
+        else:
+            raise ValueError('Buffer too small: encoded frame needs %d bytes' % (end - offset))
+    
+    out = np.frombuffer(buf, 'u1', count=(end - offset), offset=offset)
+    sp = 0
+    for p in pieces:
+        out[sp:(sp + p.nbytes)] = p
+        sp += p.nbytes
+    
+    return end
  
 
 def load_header(datastring):
     if (_ord(datastring[2]) >= 3):
-        return np.fromstring(datastring[:HEADER_LENGTH_V3], header_dtype_v3)
+        return np.frombuffer(datastring, header_dtype_v3, count=1).copy()
     else:
-        return np.fromstring(datastring[:HEADER_LENGTH], header_dtype)
+        return np.frombuffer(datastring, header_dtype, count=1).copy()
 
    
 def loads(datastring):
@@ -313,7 +410,52 @@ def loads(datastring):
         The image header, as a numpy record array with the :const:`header_dtype` dtype.
 
     """
-    header = load_header(datastring)
+    return _loads(datastring, copy=True)
+
+
+def loads_view(buf):
+    """
+    Loads image data from a buffer in PZF format without copying, where possible.
+    
+    Like :func:`loads`, but for uncompressed (and unquantized) frames the returned data is a numpy view onto `buf`
+    rather than a copy. The data is therefore only valid as long as `buf` is not modified, and will be read-only if
+    `buf` is (e.g. `bytes`). The header is always a view. Compressed frames still need to be decoded into a new array,
+    but are decoded directly from `buf` rather than from a copy of the compressed data.
+    
+    Parameters
+    ----------
+    buf : bytes, bytearray, memoryview, or other buffer
+        The encoded data
+    
+    Returns
+    -------
+    
+    data : ndarray
+        The image data as a numpy array
+        
+    header : recarray
+        The image header, as a numpy record array with the :const:`header_dtype` dtype.
+
+    """
+    return _loads(buf, copy=False)
+
+
+def _huffman_decompress(data, outsize):
+    try:
+        return bcl.HuffmanDecompress(data, outsize)
+    except ValueError:
+        # data is a view onto a read-only buffer, which older builds of pymecompress won't accept
+        return bcl.HuffmanDecompress(data.copy(), outsize)
+
+
+def _loads(buf, copy=True):
+    if (_ord(buf[2]) >= 3):
+        header = np.frombuffer(buf, header_dtype_v3, count=1)
+    else:
+        header = np.frombuffer(buf, header_dtype, count=1)
+    
+    if copy:
+        header = header.copy()
     
     if not header['ID'] == FILE_FORMAT_ID:
         raise RuntimeError("Invalid format: This doesn't appear to be a PZF file")
@@ -331,29 +473,27 @@ def loads(datastring):
         #quantized data is always 8 bit
         outsize = w * h * d
     else:
-        outsize = w*h*d*DATA_FMTS_SIZES[int(header['DataFormat'])]
+        outsize = w*h*d*DATA_FMTS_SIZES[int(header['DataFormat'][0])]
     
     
     if header['Version'] < 3:
         data_offset = HEADER_LENGTH
     else:
-        data_offset = int(header['DataOffset'])
+        data_offset = int(header['DataOffset'][0])
         
-    data_s = datastring[data_offset:]
-
     #logging.debug('About to decompress')
     #logging.debug({k:header[0][k] for k in header.dtype.names})
 
-    #logging.debug('Compressed size: %s' % len(data_s))
-    
     if header['DataCompression'] == DATA_COMP_RAW:
         #no need to decompress
-        data = np.fromstring(data_s, 'u1')
+        data = np.frombuffer(buf, 'u1', count=int(outsize), offset=data_offset)
+        if copy:
+            data = data.copy()
     elif header['DataCompression'] == DATA_COMP_HUFFCODE:
         #logging.debug('Decompressing ...')
-        data = bcl.HuffmanDecompress(np.fromstring(data_s, 'u1'), outsize)
+        data = _huffman_decompress(np.frombuffer(buf, 'u1', offset=data_offset), outsize)
     elif header['DataCompression'] == DATA_COMP_HUFFCODE_CHUNKS:
-        data = ChunkedHuffmanDecompress(data_s)
+        data = ChunkedHuffmanDecompress(buf, offset=data_offset)
     else:
         raise RuntimeError('Compression type not understood')
 
@@ -367,9 +507,9 @@ def loads(datastring):
 
         data = data.astype('f')*header['QuantScale']
         #print('data dtype: %s' % data.dtype)
-        data = (data*data + header['QuantOffset']).astype(DATA_FMTS[int(header['DataFormat'])])
+        data = (data*data + header['QuantOffset']).astype(DATA_FMTS[int(header['DataFormat'][0])])
     
     #print(dimOrder, [w, h, d])
-    data = data.view(DATA_FMTS[int(header['DataFormat'])]).reshape([w,h,d], order=dimOrder)
+    data = data.view(DATA_FMTS[int(header['DataFormat'][0])]).reshape([w,h,d], order=dimOrder)
     
-    return data, header
\ No newline at end of file
+    return data, header
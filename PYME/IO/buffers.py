@@ -143,7 +143,7 @@ class bgFrameBuffer:
             
     def getPercentile(self, pctile):
         pcIDX = int(self.validData.sum()*pctile)
-        print(pcIDX)
+        #print(pcIDX)
         
         return (self.frameBuffer*(self.indices==pcIDX)).max(0).squeeze()
             
@@ -194,13 +194,196 @@ class bgFrameBufferC(bgFrameBuffer):
         buffer_helpers.get_pct(self.frameBuffer, self.indices, pcIDX, pct_buf)
         return pct_buf
         
+class bgFrameBufferR(object):
+    """
+    Rolling order statistic (percentile) buffer.
+    
+    Rather than re-ranking the whole window whenever a frame is added or removed (as `bgFrameBuffer` does), we track
+    the current value of each requested percentile for every pixel, along with the number of frames in the window
+    which are below, or below or equal to, that value. Adding or removing a frame only needs to update these counts
+    (O(pixels)), and the tracked value only needs to be stepped to the next distinct value in the window for those
+    pixels where the counts show that it is no longer the correct order statistic. Several percentiles can be tracked
+    at once (see `getPercentiles`), so that e.g. the background percentile and the median used for the offset
+    correction in `backgroundBufferM` are both available without another pass over the window.
+    
+    If a large fraction of the window changes at once (e.g. a jump to a different part of a series) the tracked values
+    are re-initialised from scratch using `np.partition`.
+    """
+    # added to values we want to exclude from a min (or subtracted for a max). Cheaper than np.where.
+    _BIG = np.float32(1e30)
+    
+    def __init__(self, initialSize=30, percentile=.25):
+        self.frameBuffer = None
+        self.initSize = initialSize
+        
+        # the frames in the window are kept packed into the first nFrames slots of frameBuffer
+        self.frameNos = {}
+        self.slotFrames = []
+        
+        self.pctile = percentile
+        
+        # percentile -> [value, n_lt, n_le] (each of shape (n_pixels,))
+        self._trackers = {}
+        self._n_changes = 0
+        self._sliceShape = None
+        
+    @property
+    def nFrames(self):
+        return len(self.slotFrames)
+        
+    def _growBuffer(self, data):
+        if self.frameBuffer is None:
+            self._sliceShape = data.shape
+            # raw camera data is unsigned, which lets us use wrap-around rather than masking when stepping (see
+            # _step_up and _step_down). Everything else is kept as float.
+            dtype = data.dtype if data.dtype.kind == 'u' else np.dtype('f4')
+            self.frameBuffer = np.zeros((self.initSize, data.size), dtype)
+        else:
+            oldsize = self.frameBuffer.shape[0]
+            fb = np.zeros((int(oldsize*1.5) + 1, self.frameBuffer.shape[1]), self.frameBuffer.dtype)
+            fb[:oldsize, :] = self.frameBuffer
+            self.frameBuffer = fb
+        
+    def addFrame(self, frameNo, data):
+        if (self.frameBuffer is None) or (self.nFrames == self.frameBuffer.shape[0]):
+            self._growBuffer(data)
+            
+        d = data.ravel().astype(self.frameBuffer.dtype)
+        
+        slot = self.nFrames
+        self.frameBuffer[slot, :] = d
+        self.frameNos[frameNo] = slot
+        self.slotFrames.append(frameNo)
+        
+        for v, lt, le in self._trackers.values():
+            lt += (d < v)
+            le += (d <= v)
+        
+        self._n_changes += 1
+
+    def removeFrame(self, frameNo):
+        slot = self.frameNos.pop(frameNo)
+        d = self.frameBuffer[slot, :].copy()
+        
+        for v, lt, le in self._trackers.values():
+            lt -= (d < v)
+            le -= (d <= v)
+        
+        # move the last frame into the gap to keep the window packed
+        last = self.nFrames - 1
+        if slot != last:
+            self.frameBuffer[slot, :] = self.frameBuffer[last, :]
+            lastFrame = self.slotFrames[last]
+            self.slotFrames[slot] = lastFrame
+            self.frameNos[lastFrame] = slot
+        
+        self.slotFrames.pop()
+        self._n_changes += 1
+        
+    def _rank(self, pctile):
+        # match the rank convention of bgFrameBuffer.getPercentile, which takes the frame with (1-based) rank
+        # int(n*pctile), so that swapping buffers doesn't change the background estimate
+        return max(int(self.nFrames*pctile) - 1, 0)
+    
+    def _init_tracker(self, pctile):
+        fb = self.frameBuffer[:self.nFrames, :]
+        k = self._rank(pctile)
+        v = np.partition(fb, k, axis=0)[k, :]
+        self._trackers[pctile] = [v, (fb < v).sum(0, dtype='i4'), (fb <= v).sum(0, dtype='i4')]
+        
+    def _update_tracker(self, pctile):
+        v, lt, le = self._trackers[pctile]
+        k = self._rank(pctile)
+        
+        while True:
+            up = np.flatnonzero(le <= k)
+            down = np.flatnonzero(lt > k)
+            
+            if (len(up) == 0) and (len(down) == 0):
+                return
+            
+            if len(up) > 0:
+                vu, n_eq = self._step_up(up, v[up])
+                lt[up] = le[up]
+                le[up] += n_eq
+                v[up] = vu
+                
+            if len(down) > 0:
+                vd, n_eq = self._step_down(down, v[down])
+                le[down] = lt[down]
+                lt[down] -= n_eq
+                v[down] = vd
+                
+    def _window(self, pixels):
+        # NB - np.take rather than fancy indexing so that the result is C ordered and the reductions over frames are fast
+        return np.take(self.frameBuffer[:self.nFrames, :], pixels, axis=1)
+    
+    def _step_up(self, pixels, v):
+        """Find the next distinct value above v in the window (and how many times it occurs) for each of pixels"""
+        fb = self._window(pixels)
+        if fb.dtype.kind == 'u':
+            # values <= v wrap around and become large
+            w = fb - (v + 1)
+            m = w.min(0)
+            return m + (v + 1), (w == m).sum(0, dtype='i4')
+        else:
+            w = (fb <= v)*self._BIG
+            w += fb
+            vu = w.min(0)
+            return vu, (fb == vu).sum(0, dtype='i4')
+    
+    def _step_down(self, pixels, v):
+        """Find the next distinct value below v in the window (and how many times it occurs) for each of pixels"""
+        fb = self._window(pixels)
+        if fb.dtype.kind == 'u':
+            # values >= v wrap around and become large
+            w = (v - 1) - fb
+            m = w.min(0)
+            return (v - 1) - m, (w == m).sum(0, dtype='i4')
+        else:
+            w = (fb >= v)*(-self._BIG)
+            w += fb
+            vd = w.max(0)
+            return vd, (fb == vd).sum(0, dtype='i4')
+        
+    def getPercentiles(self, pctiles):
+        """
+        Get the current value of several percentiles across the window.
+        
+        Parameters
+        ----------
+        pctiles : sequence of float
+            percentiles (in the range 0-1) to return.
+
+        Returns
+        -------
+        list of arrays, one per requested percentile, each with the same shape as the frames.
+        """
+        if self._n_changes > max(4, self.nFrames/4):
+            # a large part of the window has changed, cheaper to start again
+            self._trackers = {}
+        
+        for pctile in pctiles:
+            if pctile in self._trackers:
+                self._update_tracker(pctile)
+            else:
+                self._init_tracker(pctile)
+                
+        self._n_changes = 0
+        
+        return [self._trackers[pctile][0].reshape(self._sliceShape) for pctile in pctiles]
+            
+    def getPercentile(self, pctile):
+        return self.getPercentiles([pctile])[0]
+        
+        
 class backgroundBufferM:
     def __init__(self, dataBuffer, percentile=.5):
         self.dataBuffer = dataBuffer
         self.curFrames = set()
         self.curBG = np.zeros(dataBuffer.dataSource.getSliceShape(), 'f4')
         
-        self.bfb = bgFrameBuffer(percentile=percentile)
+        self.bfb = bgFrameBufferR(percentile=percentile)
         
         self.bgSegs = None
         self.pctile = percentile
@@ -227,9 +410,9 @@ class backgroundBufferM:
                 self.curFrames.add(fi)
 
         #self.curFrames = bgi
-        self.curBG = self.bfb.getPercentile(self.pctile).astype('f')
+        bg, med = self.bfb.getPercentiles([self.pctile, 0.5])
+        self.curBG = bg.astype('f')
         
-        med = self.bfb.getPercentile(0.5).astype('f')
         off = np.median(med) - np.median(self.curBG)
         self.curBG += off
 
@@ -125,6 +125,7 @@ def to_bytes(input):
 
 
 from PYME import config
+from PYME.misc import thread_pools
 from PYME.misc.computerName import GetComputerName
 local_dataroot = (config.get('dataserver-root'))
 local_serverfilter = (config.get('dataserver-filter', GetComputerName()))
@@ -256,10 +257,65 @@ def _listSingleDir(dirurl, nRetries=1, timeout=5):
     return dirL, dt
 
 
+#misses are cached for a short time so that polling for a file which hasn't been written yet (e.g. during live
+#acquisition) doesn't query every server on every call.
+LOCATE_NEGATIVE_CACHE_TIME = config.get('clusterIO-locate-negative-cache-time', 0.5)
+_negativeLocateCache = _LimitedSizeDict(size_limit=1000)
+
+#directory queries to different servers are made in parallel
+#(this is IO bound, so uses a pool of its own rather than the shared compute pool)
+LOCATE_THREADS = config.get('clusterIO-locate-threads', 20)
+
+def _dir_urls(dirname, serverfilter):
+    """Find the directory urls for each server in the cluster, returning local and remote servers separately"""
+    servers = []
+    localServers = []
+
+    # print ns.advertised_services.keys()
+    services = get_ns().get_advertised_services()
+    for name, info in services:
+        if serverfilter in name:
+            if info is None or info.address is None or info.port is None:
+                # handle the case where zeroconf gives us bad name info. This  is a result of a race condition within
+                # zeroconf, which should probably be fixed instead, but hopefully this workaround is enough.
+                # FIXME - fix zeroconf module race condition on info update.
+                logger.error('''Zeroconf gave us NULL info, ignoring and hoping for the best ...
+                Node with bogus info was: %s
+                Total number of nodes: %d
+                ''' % (name, len(services)))
+            else:
+                dirurl = 'http://%s:%d/%s' % (socket.inet_ntoa(info.address), info.port, dirname)
+
+                if compName in name:
+                    localServers.append(dirurl)
+                else:
+                    servers.append(dirurl)
+                    
+    return localServers, servers
+
+def _locate_in_dir(args):
+    """Query a single server for a file, returning (url, dt) if the file is present, and None otherwise"""
+    dirurl, fn = args
+    try:
+        dirList, dt = _listSingleDir(dirurl)
+    except (requests.Timeout, requests.ConnectionError):
+        #don't let a single unresponsive server stop us finding a file on the others
+        logger.error('Could not list %s' % dirurl)
+        return None
+    
+    if fn in dirList.keys():
+        return (dirurl + fn, dt)
+    
 def locate_file(filename, serverfilter=local_serverfilter, return_first_hit=False):
     """
     Searches the cluster to find which server(s) a given file is stored on
 
+    Directory listings are cached for a short period (DIR_CACHE_TIME) and used if possible. Otherwise servers on the
+    local machine are queried first, followed by all the remote servers in parallel, so that (when
+    `return_first_hit` is set) the time taken is determined by the fastest server which has the file rather than the
+    sum of all the servers' response times. Successful lookups are cached indefinitely (the file system is write once),
+    and misses are cached for LOCATE_NEGATIVE_CACHE_TIME.
+
     Parameters
     ----------
     filename : str
@@ -271,6 +327,8 @@ def locate_file(filename, serverfilter=local_serverfilter, return_first_hit=Fals
 
     Returns
     -------
+    
+    a list of (url, dt) tuples for each location, where dt is the time taken to list the directory on that server
 
     """
     
@@ -283,81 +341,70 @@ def locate_file(filename, serverfilter=local_serverfilter, return_first_hit=Fals
         #logger.debug('Returning cached locs: %s' % locs)
         return locs
     except KeyError:
-        locs = []
-
-        dirname = '/'.join(filename.split('/')[:-1])
-        fn = filename.split('/')[-1]
-        if (len(dirname) >= 1):
-            dirname += '/'
-
-        servers = []
-        localServers = []
-
-        # print ns.advertised_services.keys()
-        services = get_ns().get_advertised_services()
-        for name, info in services:
-            if serverfilter in name:
-                if info is None or info.address is None or info.port is None:
-                    # handle the case where zeroconf gives us bad name info. This  is a result of a race condition within
-                    # zeroconf, which should probably be fixed instead, but hopefully this workaround is enough.
-                    # FIXME - fix zeroconf module race condition on info update.
-                    logger.error('''Zeroconf gave us NULL info, ignoring and hoping for the best ...
-                    Node with bogus info was: %s
-                    Total number of nodes: %d
-                    ''' % (name, len(services)))
-                else:
-                    dirurl = 'http://%s:%d/%s' % (socket.inet_ntoa(info.address), info.port, dirname)
+        pass
     
-                    if compName in name:
-                        localServers.append(dirurl)
-                    else:
-                        servers.append(dirurl)
-
-        #try data servers on the local machine first
-        for dirurl in localServers:
-            try:
-                dirL, rt, dt = _dirCache[dirurl]
-                cached = True
-            except KeyError:
-                cached = False
-
-            if cached and fn in dirL: #note we're using short-circuit evaluation here
-                locs.append((dirurl + fn, dt))
-
-            else:
-                dirList, dt = _listSingleDir(dirurl)
-
-                if fn in dirList.keys():
-                    locs.append((dirurl + fn, dt))
-
-            if return_first_hit and len(locs) > 0:
-                return locs
-
-        #now try data remote servers
-        for dirurl in servers:
-            try:
-                dirL, rt, dt = _dirCache[dirurl]
-                cached = True
-            except KeyError:
-                cached = False
-
-            if cached and fn in dirL: #note we're using short-circuit evaluation here
-                locs.append((dirurl + fn, dt))
+    try:
+        t = _negativeLocateCache[cache_key]
+        if (time.time() - t) < LOCATE_NEGATIVE_CACHE_TIME:
+            return []
+    except KeyError:
+        pass
+    
+    locs = []
 
-            else:
-                dirList, dt = _listSingleDir(dirurl)
+    dirname = '/'.join(filename.split('/')[:-1])
+    fn = filename.split('/')[-1]
+    if (len(dirname) >= 1):
+        dirname += '/'
 
-                if fn in dirList.keys():
-                    locs.append((dirurl + fn, dt))
+    localServers, servers = _dir_urls(dirname, serverfilter)
+    
+    #check any cached directory listings first - the listing can be out of date if the file has been written since
+    #(in which case we will query that server again below), but won't report files which don't exist
+    to_query = []
+    for dirurl in localServers + servers:
+        try:
+            dirL, rt, dt = _dirCache[dirurl]
+            cached = True
+        except KeyError:
+            cached = False
 
-            if return_first_hit and len(locs) > 0:
+        if cached and fn in dirL: #note we're using short-circuit evaluation here
+            locs.append((dirurl + fn, dt))
+            
+            if return_first_hit:
                 return locs
+        else:
+            to_query.append(dirurl)
+
+    #try data servers on the local machine first
+    for dirurl in localServers:
+        if dirurl in to_query:
+            loc = _locate_in_dir((dirurl, fn))
+            if loc is not None:
+                locs.append(loc)
+                
+                if return_first_hit:
+                    return locs
+
+    #now query all the remote servers at once, collecting the results as they come in
+    remote = [(dirurl, fn) for dirurl in servers if dirurl in to_query]
+    if len(remote) > 0:
+        for loc in thread_pools.get_pool('clusterIO-locate', LOCATE_THREADS).imap_unordered(_locate_in_dir, remote):
+            if loc is not None:
+                locs.append(loc)
+                
+                if return_first_hit:
+                    # any outstanding queries will complete in the background (and populate the directory cache)
+                    break
 
-        if len(locs) > 0:
-            #cache if we found something (this is safe due to write-once nature of fs)
-            _locateCache[cache_key] = (locs, time.time())
+    if len(locs) > 0:
+        #cache if we found something (this is safe due to write-once nature of fs)
+        _locateCache[cache_key] = (locs, time.time())
+    else:
+        _negativeLocateCache[cache_key] = time.time()
 
-        return locs
+    return locs
 
 _pool = None
 
@@ -769,6 +816,18 @@ def get_file(filename, serverfilter=local_serverfilter, numRetries=3, use_file_c
         with open(localpath, 'rb') as f:
             return f.read()
     
+    r = _get_from_cluster(filename, serverfilter, numRetries)
+
+    content = r.content
+
+    if len(content) < 1000000:
+        #cache small files
+        _fileCache[(filename, serverfilter)] = content
+
+    return content
+
+def _get_from_cluster(filename, serverfilter, numRetries, headers=None, stream=False, ok_status=(200,)):
+    """Locate a file on the cluster and GET it, with retries. Returns the requests response."""
     locs = locate_file(filename, serverfilter, return_first_hit=True)
 
     nTries = 1
@@ -793,7 +852,7 @@ def get_file(filename, serverfilter=local_serverfilter, numRetries=3, use_file_c
         try:
             nTries += 1
             s = _getSession(url)
-            r = s.get(url, timeout=.5)
+            r = s.get(url, timeout=.5, headers=headers, stream=stream)
             haveResult = True
         except (requests.Timeout, requests.ConnectionError) as e:
             # s.get sometimes raises ConnectionError instead of ReadTimeoutError
@@ -806,18 +865,114 @@ def get_file(filename, serverfilter=local_serverfilter, numRetries=3, use_file_c
     #s = _getSession(url)
     #r = s.get(url, timeout=.5)
 
-    if not r.status_code == 200:
+    if not r.status_code in ok_status:
+        r.close()
         msg = 'Request for %s failed with error: %d' % (url, r.status_code)
         logger.error(msg)
         raise RuntimeError(msg)
+    
+    return r
 
-    content = r.content
+def get_file_range(filename, start, end=None, serverfilter=local_serverfilter, numRetries=3):
+    """
+    Get part of a file from the cluster, using an HTTP Range request.
+    
+    This lets us read e.g. individual frames or table rows from large files without transferring the whole file. Ranges
+    also work on the virtual files within .h5 containers (e.g. 'series.h5/frame00010.pzf'), although these are
+    assembled in full on the server.
+    
+    Parameters
+    ----------
+    filename : string
+        filename relative to cluster root
+    start : int
+        offset of the first byte to read
+    end : int or None
+        offset one past the last byte to read (i.e. python slice semantics). If None, read to the end of the file.
+    serverfilter : string
+        cluster name (see `get_file`)
+    numRetries : int
+        The number of times to retry on failure
 
-    if len(content) < 1000000:
-        #cache small files
-        _fileCache[(filename, serverfilter)] = content
+    Returns
+    -------
+    bytes : the requested range (which may be shorter than requested if it extends past the end of the file)
+    """
+    if (end is not None) and (end <= start):
+        return b''
+    
+    localpath = get_local_path(filename, serverfilter)
+    if localpath:
+        with open(localpath, 'rb') as f:
+            f.seek(start)
+            return f.read() if end is None else f.read(end - start)
+        
+    if end is None:
+        headers = {'Range': 'bytes=%d-' % start}
+    else:
+        headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+    
+    # NB - a 416 (range not satisfiable) means the range starts after the end of the file
+    r = _get_from_cluster(filename, serverfilter, numRetries, headers=headers, ok_status=(200, 206, 416))
+    
+    if r.status_code == 416:
+        return b''
+    elif r.status_code == 200:
+        # server ignored our range request and sent the whole file
+        return r.content[start:end]
+    else:
+        return r.content
+    
+def stream_file(filename, serverfilter=local_serverfilter, chunk_size=2**20, start=0, numRetries=3):
+    """
+    Read a file from the cluster in chunks, without holding the whole file in memory.
+    
+    Parameters
+    ----------
+    filename : string
+        filename relative to cluster root
+    serverfilter : string
+        cluster name (see `get_file`)
+    chunk_size : int
+        the (maximum) size of the chunks to return
+    start : int
+        byte offset at which to start reading
+    numRetries : int
+        The number of times to retry on failure when connecting
 
-    return content
+    Returns
+    -------
+    a generator yielding chunks of the file as bytes
+    """
+    localpath = get_local_path(filename, serverfilter)
+    if localpath:
+        with open(localpath, 'rb') as f:
+            f.seek(start)
+            chunk = f.read(chunk_size)
+            while chunk:
+                yield chunk
+                chunk = f.read(chunk_size)
+        return
+    
+    headers = {'Range': 'bytes=%d-' % start} if start > 0 else None
+    
+    r = _get_from_cluster(filename, serverfilter, numRetries, headers=headers, stream=True, ok_status=(200, 206, 416))
+    try:
+        if r.status_code == 416:
+            return
+        
+        skip = start if (r.status_code == 200) else 0
+        for chunk in r.iter_content(chunk_size):
+            if skip > 0:
+                # server ignored our range request
+                n = min(skip, len(chunk))
+                chunk = chunk[n:]
+                skip -= n
+            
+            if chunk:
+                yield chunk
+    finally:
+        r.close()
 
 
 _last_access_time = {}
@@ -965,6 +1120,7 @@ def put_file(filename, data, serverfilter=local_serverfilter):
             cache_key = serverfilter + '::' + filename
             t1 = time.time()
             _locateCache[cache_key] = ([(url, .1),], t1)
+            _negativeLocateCache.pop(cache_key, None)
             
             #modify dir cache
             try:
@@ -1084,7 +1240,7 @@ if USE_RAW_SOCKETS:
         Parameters
         ----------
         files : list of tuple
-            a list of tuples of the form (<string> filepath, <bytes> data) for the files to be uploaded
+            a list of tuples of the form (<string> filepath, <bytes-like> data) for the files to be uploaded
             
         serverfilter
 
@@ -1215,7 +1371,7 @@ else:
         Parameters
         ----------
         files : list of tuple
-            a list of tuples of the form (<string> filepath, <bytes> data) for the files to be uploaded
+            a list of tuples of the form (<string> filepath, <bytes-like> data) for the files to be uploaded
             
         serverfilter
 
@@ -1231,6 +1387,10 @@ else:
         for filename, data in files:
             unifiedIO.assert_name_ok(filename)
             url = 'http://%s:%d/%s' % (socket.inet_ntoa(info.address), info.port, filename)
+            
+            if isinstance(data, memoryview):
+                # requests would treat a memoryview as an iterable (streamed) body
+                data = data.tobytes()
 
             t = time.time()
             #_last_access_time[name] = t
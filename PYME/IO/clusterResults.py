@@ -76,6 +76,11 @@ def pickResultsServer(filename, serverfilter=clusterIO.local_serverfilter):
         fn, stub = fn.split('.h5r')
         fn = fn  + '.h5r'
         prefix = '__aggregate_h5r'
+    elif filename.startswith('__aggregate_h5/'):
+        fn = filename[len('__aggregate_h5/'):]
+        fn, stub = fn.split('.h5')
+        fn = fn  + '.h5'
+        prefix = '__aggregate_h5'
     else:
         fn = filename
         stub = ''
@@ -187,3 +192,37 @@ def fileResults(URI, data_raw):
 
     fileFormattedResults(URI, data)
 
+
+
+def flushResults(URI, close=False):
+    """
+    Ask the dataserver hosting an aggregated results file (.h5r or .h5) to write all queued results to disk, and
+    optionally to close the file. Call with ``close=True`` once all results for a series have been filed to free up
+    the server-side writer without waiting for it to time out.
+
+    Parameters
+    ----------
+    URI : str
+        The results URI, as used with :func:`fileResults` (e.g. ``PYME-CLUSTER://<filter>/__aggregate_h5r/path/to/file.h5r``
+        or a direct http:// URI). Any table name following the file name is ignored.
+    close : bool
+        close the file after flushing
+
+    """
+    if URI.startswith('PYME-CLUSTER') or URI.startswith('pyme-cluster'):
+        clusterfilter = URI.split('://')[1].split('/')[0]
+        sequenceName = URI.split('://%s/' % clusterfilter)[1]
+        URI = pickResultsServer(sequenceName, clusterfilter)
+        
+    for ext, prefix in [('.h5r', '__aggregate_h5r'), ('.h5', '__aggregate_h5')]:
+        if ('/%s/' % prefix) in URI:
+            URI = URI.split(ext)[0] + ext
+            URI = URI.replace('/%s/' % prefix, '/%s/' % ('__aggregate_close' if close else '__aggregate_flush'), 1)
+            break
+    else:
+        raise RuntimeError('Can only flush aggregated .h5r or .h5 results, not %s' % URI)
+    
+    s = clusterIO._getSession(URI)
+    r = s.put(URI, data=b'', timeout=30)
+    if not r.status_code == 200:
+        raise RuntimeError('Flush failed with %d: %s' % (r.status_code, r.content))
@@ -22,9 +22,15 @@ def openH5(filename, mode='r'):
     
     with h5rFile.openLock:
         if key in h5rFile.file_cache and h5rFile.file_cache[key].is_alive:
-            return h5rFile.file_cache[key]
+            f = h5rFile.file_cache[key]
         elif key2 in h5rFile.file_cache and h5rFile.file_cache[key2].is_alive:
-            return h5rFile.file_cache[key2]
+            f = h5rFile.file_cache[key2]
+        else:
+            f = None
+            
+        if f is not None:
+            f._touch()
+            return f
         else:
             h5rFile.file_cache[key] = H5File(filename, mode)
             return h5rFile.file_cache[key]
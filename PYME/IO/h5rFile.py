@@ -26,15 +26,77 @@ def openH5R(filename, mode='r'):
             if f.mode == 'r' and not mode == 'r':
                 raise IOError('File already open in read-only mode, mode %s requested' % mode)
             else:
+                # extend the keep-alive so that the writer thread cannot decide to close the file between us
+                # returning it and the caller entering the context manager
+                f._touch()
                 return f
         else:
             file_cache[key] = H5RFile(filename, mode)
             return file_cache[key]
 
 
+def _cached_files(filename):
+    """Return all live cached (writer) instances for a given filename, irrespective of the mode they were opened in"""
+    with openLock:
+        return [f for k, f in file_cache.items() if f.filename == filename and f.is_alive]
+
+
+def flush_file(filename, timeout=10):
+    """
+    Block until any queued appends to a cached file have been written and the file has been flushed to disk.
+
+    Parameters
+    ----------
+    filename : str
+        the (local) filename of the .h5r or .h5 file
+    timeout : float
+        maximum time to wait (in s) for each writer
+
+    Returns
+    -------
+    True if a cached writer was found and flushed, False if the file was not open.
+    """
+    files = _cached_files(filename)
+    for f in files:
+        f.flush(timeout)
+        
+    return len(files) > 0
+
+
+def get_writer_metrics():
+    """
+    Metrics for all open (cached) writers, keyed by filename. See `H5RFile.get_metrics`.
+    """
+    with openLock:
+        files = [f for f in file_cache.values() if f.is_alive]
+        
+    return {f.filename: f.get_metrics() for f in files}
+
+
+def close_file(filename, timeout=10):
+    """
+    Write any queued appends, flush, and close a cached file immediately (rather than waiting for the keep-alive timeout
+    to expire).
+
+    Returns
+    -------
+    True if a cached writer was found and closed, False if the file was not open.
+    """
+    files = _cached_files(filename)
+    for f in files:
+        f.close(timeout)
+
+    return len(files) > 0
+
+
 class H5RFile(object):
-    KEEP_ALIVE_TIMEOUT = 20 #keep the file open for 20s after the last time it was used
+    KEEP_ALIVE_TIMEOUT = config.get('h5r-keep_alive_timeout', 20) #keep the file open for 20s after the last time it was used
     FLUSH_INTERVAL = config.get('h5r-flush_interval', 1)
+    POLL_INTERVAL = 0.1
+    # limits on how much queued data is combined into a single table append (bytes), and on how long (in s) we spend
+    # writing one table in a single poll cycle before moving on to other tables, flush requests, etc ...
+    MAX_BATCH_BYTES = config.get('h5r-max_batch_bytes', 32*1024*1024)
+    MAX_BATCH_TIME = config.get('h5r-max_batch_time', 0.5)
     
     def __init__(self, filename, mode='r'):
         self.filename = filename
@@ -58,6 +120,24 @@ class H5RFile(object):
         self.keepAliveTimeout = time.time() + self.KEEP_ALIVE_TIMEOUT
         self.useCount = 0
         self.is_alive = True
+        
+        # set by close() to make the poll thread exit as soon as the queues are empty
+        self._close_requested = False
+        # events for callers waiting on an explicit flush
+        self._flush_requests = []
+
+        # writer metrics (see get_metrics)
+        self._metrics_lock = threading.Lock()
+        self._open_time = time.time()
+        self._rows_written = 0
+        self._bytes_written = 0
+        self._n_appends = 0
+        self._n_flushes = 0
+        self._last_flush_latency = 0
+        self._max_flush_latency = 0
+        self._rate_time = self._open_time
+        self._rate_rows = 0
+        self._rows_per_s = 0
 
         #logging.debug('H5RFile - starting poll thread')
         self._lastFlushTime = 0
@@ -66,7 +146,7 @@ class H5RFile(object):
         self._pollThread.start()
         
         self._pzf_index = None
-
+        
         #logging.debug('H5RFile - poll thread started')
 
     def __enter__(self):
@@ -80,6 +160,36 @@ class H5RFile(object):
         with self.appendQueueLock:
             self.keepAliveTimeout = time.time() + self.KEEP_ALIVE_TIMEOUT
             self.useCount -= 1
+            
+    def _touch(self):
+        with self.appendQueueLock:
+            self.keepAliveTimeout = max(self.keepAliveTimeout, time.time() + self.KEEP_ALIVE_TIMEOUT)
+            
+    def flush(self, timeout=10):
+        """
+        Wait until all data queued before this call has been written and flushed to disk.
+        
+        Returns True on success, False if the flush did not complete within `timeout` seconds.
+        """
+        evt = threading.Event()
+        with self.appendQueueLock:
+            if not self.is_alive:
+                return True
+            
+            self._flush_requests.append(evt)
+            
+        return evt.wait(timeout)
+    
+    def close(self, timeout=10):
+        """
+        Write any queued data and close the file without waiting for the keep-alive timeout. Any users who still hold
+        the file (i.e. are inside the context manager) will be waited for.
+        """
+        with self.appendQueueLock:
+            self._close_requested = True
+            
+        if threading.current_thread() is not self._pollThread:
+            self._pollThread.join(timeout)
 
 
     @property
@@ -112,38 +222,100 @@ class H5RFile(object):
         self.appendToTable('Events', events)
 
     def _appendToTable(self, tablename, data):
+        if isinstance(data, (six.string_types, bytes)):
+            return self._appendVLRows(tablename, [data])
+        
         with tablesLock:
             try:
                 table = getattr(self._h5file.root, tablename)
                 table.append(data)
             except AttributeError:
                 # we don't have a table with that name - create one
-                if isinstance(data, six.string_types):
-                    table = self._h5file.create_vlarray(self._h5file.root, tablename, tables.VLStringAtom())
-                    table.append(data)
-                else:
-                    self._h5file.create_table(self._h5file.root, tablename, data,
-                                               filters=tables.Filters(complevel=5, shuffle=True),
-                                               expectedrows=500000)
+                self._h5file.create_table(self._h5file.root, tablename, data,
+                                           filters=tables.Filters(complevel=5, shuffle=True),
+                                           expectedrows=500000)
+                
+        self._record_write(len(data), getattr(data, 'nbytes', 0))
+                
+    def _appendVLRows(self, tablename, rows):
+        """
+        Append a list of variable length (string) rows to a table, under a single acquisition of the tables lock.
+
+        For PZF image data, also write the corresponding entries of the frame index in one append.
+        """
+        with tablesLock:
+            try:
+                table = getattr(self._h5file.root, tablename)
+            except AttributeError:
+                # we don't have a table with that name - create one
+                table = self._h5file.create_vlarray(self._h5file.root, tablename, tables.VLStringAtom())
+            
+            start_row = table.nrows
+            for r in rows:
+                table.append(r)
                     
             if (tablename == 'PZFImageData'):
                 from PYME.IO import PZFFormat
                 #special case  for pzf data - also build an index table
-                frameNum = PZFFormat.load_header(data)['FrameNum']
+                idx_entries = np.empty(len(rows), dtype=[('FrameNum', 'i4'), ('Position', 'i4')])
                 
                 #record a mapping from frame number to the row we added
-                idx_entry = np.array([frameNum, table.nrows -1], dtype='i4').view(dtype=[('FrameNum', 'i4'), ('Position', 'i4')])
+                idx_entries['FrameNum'] = [PZFFormat.load_header(r)['FrameNum'].ravel()[0] for r in rows]
+                idx_entries['Position'] = np.arange(start_row, start_row + len(rows))
                 
                 try:
                     index = getattr(self._h5file.root, 'PZFImageIndex')
-                    index.append(idx_entry)
+                    index.append(idx_entries)
                 except AttributeError:
-                    self._h5file.create_table(self._h5file.root, 'PZFImageIndex', idx_entry,
+                    self._h5file.create_table(self._h5file.root, 'PZFImageIndex', idx_entries,
                                               filters=tables.Filters(complevel=5, shuffle=True),
                                               expectedrows=50000)
                     
                 self._pzf_index = None
-                    
+                
+        self._record_write(len(rows), sum([len(r) for r in rows]))
+        
+    def _record_write(self, n_rows, n_bytes):
+        with self._metrics_lock:
+            self._rows_written += n_rows
+            self._bytes_written += n_bytes
+            self._n_appends += 1
+    
+    def get_metrics(self):
+        """
+        Writer-side metrics.
+
+        Returns
+        -------
+        dict with the following keys:
+            rows_written, bytes_written : totals since the file was opened
+            table_appends : number of (batched) appends to the underlying tables
+            rows_per_s : write rate, averaged over the last few seconds
+            queue_depth : number of entries waiting to be written, by table
+            flushes, last_flush_latency, max_flush_latency : number of flushes to disk and how long they took (in s)
+            uptime : time (in s) since the file was opened
+        """
+        with self.appendQueueLock:
+            queue_depth = {k: len(v) for k, v in self.appendQueues.items()}
+            
+        with self._metrics_lock:
+            return {'rows_written': self._rows_written,
+                    'bytes_written': self._bytes_written,
+                    'table_appends': self._n_appends,
+                    'rows_per_s': self._rows_per_s,
+                    'queue_depth': queue_depth,
+                    'flushes': self._n_flushes,
+                    'last_flush_latency': self._last_flush_latency,
+                    'max_flush_latency': self._max_flush_latency,
+                    'uptime': time.time() - self._open_time}
+    
+    def _update_rate(self, t):
+        with self._metrics_lock:
+            dt = t - self._rate_time
+            if dt >= 1.0:
+                self._rows_per_s = (self._rows_written - self._rate_rows)/dt
+                self._rate_rows = self._rows_written
+                self._rate_time = t
 
     def appendToTable(self, tablename, data):
         #logging.debug('h5rfile - append to table: %s' % tablename)
@@ -162,46 +334,119 @@ class H5RFile(object):
 
         return res
 
-    def _pollQueues(self):
-        queuesWithData = False
+    def _queued_tables(self):
+        with self.appendQueueLock:
+            # find queues with stuff to save
+            return [k for k, v in self.appendQueues.items() if len(v) > 0]
+            
+    def _should_close(self):
+        """Decide (under openLock, so that nobody can grab us from the cache in the meantime) whether to shut down"""
+        with openLock:
+            with self.appendQueueLock:
+                idle = (self.useCount <= 0) and ((time.time() > self.keepAliveTimeout) or self._close_requested)
+                queues_empty = all([len(v) == 0 for v in self.appendQueues.values()])
+                close = idle and queues_empty and (len(self._flush_requests) == 0)
+                
+            if close:
+                # mark ourselves as dead before releasing the lock so that openH5R() will create a new instance
+                self.is_alive = False
+                
+            return close
+        
+    def _write_queue(self, tablename, min_entries=0):
+        """
+        Write data waiting in a table queue.
+        
+        The queue is drained into batches - consecutive record-array appends with the same dtype are concatenated into a
+        single table append, and string rows (e.g. PZF frames) are written together under a single acquisition of the
+        global tables lock. Each batch is limited to MAX_BATCH_BYTES, and we stop after MAX_BATCH_TIME (leaving
+        anything else for the next poll cycle) so that one busy table can't hold up the others.
+        
+        Parameters
+        ----------
+        tablename : str
+        min_entries : int
+            number of queued entries which must be written regardless of MAX_BATCH_TIME (used to make sure everything
+            queued before a flush request is on disk before we signal that the flush has completed)
+        """
+        waiting = self.appendQueues[tablename]
+        t_start = time.time()
+        n_written = 0
+        
+        while (len(waiting) > 0) and ((n_written < min_entries) or ((time.time() - t_start) < self.MAX_BATCH_TIME)):
+            batch = []
+            batch_bytes = 0
+            
+            try:
+                while batch_bytes < self.MAX_BATCH_BYTES:
+                    e = waiting[0]
+                    is_vl = isinstance(e, (six.string_types, bytes))
+                    if len(batch) > 0:
+                        if is_vl != isinstance(batch[0], (six.string_types, bytes)):
+                            break
+                        if not is_vl and (not isinstance(e, np.ndarray) or (e.dtype != batch[0].dtype)):
+                            break
+                            
+                    batch.append(waiting.popleft())
+                    n_written += 1
+                    batch_bytes += len(e) if is_vl else getattr(e, 'nbytes', 0)
+                    
+                    if not (is_vl or isinstance(e, np.ndarray)):
+                        # something we don't know how to concatenate, write on it's own
+                        break
+            except IndexError:
+                pass
+            
+            if isinstance(batch[0], (six.string_types, bytes)):
+                self._appendVLRows(tablename, batch)
+            elif len(batch) == 1:
+                self._appendToTable(tablename, batch[0])
+            else:
+                self._appendToTable(tablename, np.hstack([b.ravel() for b in batch]))
 
+    def _pollQueues(self):
         # logging.debug('h5rfile - poll')
 
         try:
-            while self.useCount > 0 or queuesWithData or time.time() < self.keepAliveTimeout:
-                #logging.debug('poll - %s' % time.time())
+            while True:
                 with self.appendQueueLock:
-                    #find queues with stuff to save
-                    tablenames = [k for k, v in self.appendQueues.items() if len(v) > 0]
-
-                queuesWithData = len(tablenames) > 0
-
-                #iterate over the queues
-                # for tablename in tablenames:
-                #     with self.appendQueueLock:
-                #         entries = self.appendQueues[tablename]
-                #         self.appendQueues[tablename] = collections.deque()
-                #
-                #     #save the data - note that we can release the lock here, as we are the only ones calling this function.
-                #     rows = np.hstack(entries)
-                #     self._appendToTable(tablename, rows)
-
+                    # grab any pending flush requests *before* emptying the queues, so that the flush covers all data
+                    # which was queued before the request was made
+                    flush_requests = self._flush_requests
+                    self._flush_requests = []
+                    
+                    # if someone is waiting on a flush, everything which is currently queued must be written in this
+                    # cycle, irrespective of the batching time limit
+                    if len(flush_requests) > 0:
+                        min_entries = {k: len(v) for k, v in self.appendQueues.items()}
+                    else:
+                        min_entries = {}
+                
                 #iterate over the queues (in a threadsafe manner)
-                for tablename in tablenames:
-                    waiting = self.appendQueues[tablename]
-                    try:
-                        while len(waiting) > 0:
-                            self._appendToTable(tablename, waiting.popleft())
-                    except IndexError:
-                        pass
+                for tablename in self._queued_tables():
+                    self._write_queue(tablename, min_entries.get(tablename, 0))
 
                 curTime = time.time()
-                if (curTime - self._lastFlushTime) > self.FLUSH_INTERVAL:
+                if (len(flush_requests) > 0) or ((curTime - self._lastFlushTime) > self.FLUSH_INTERVAL):
                     with tablesLock:
                         self._h5file.flush()
                     self._lastFlushTime = curTime
+                    
+                    latency = time.time() - curTime
+                    with self._metrics_lock:
+                        self._n_flushes += 1
+                        self._last_flush_latency = latency
+                        self._max_flush_latency = max(self._max_flush_latency, latency)
+                
+                self._update_rate(curTime)
+                    
+                for evt in flush_requests:
+                    evt.set()
+                    
+                if self._should_close():
+                    break
 
-                time.sleep(0.1)
+                time.sleep(self.POLL_INTERVAL)
 
         except:
             traceback.print_exc()
@@ -210,15 +455,20 @@ class H5RFile(object):
             logging.debug('H5RFile - closing: %s' % self.filename)
             #remove ourselves from the cache
             with openLock:
-                try:
-                    file_cache.pop((self.filename, self.mode))
-                except KeyError:
-                    pass
+                for k, v in list(file_cache.items()):
+                    if v is self:
+                        file_cache.pop(k)
     
                 self.is_alive = False
                 #finally, close the file
                 with tablesLock:
                     self._h5file.close()
+                    
+            # release anyone who is still waiting on a flush
+            with self.appendQueueLock:
+                for evt in self._flush_requests:
+                    evt.set()
+                self._flush_requests = []
 
             logging.debug('H5RFile - closed: %s' % self.filename)
 
@@ -32,6 +32,8 @@ from PYME.Analysis.points.SoftRend import RenderTetrahedra
 from math import floor
 
 from PYME.IO.image import ImageBounds
+from PYME import config
+from PYME.misc import thread_pools
 
 
 
@@ -124,6 +126,166 @@ def Gauss2D(Xv,Yv, A,x0,y0,s):
     r = genGauss(Xv,Yv,A,x0,y0,s,0,0,0)
     return r
 
+# tile-parallel rendering of separable kernels (used by rendGauss and rendGauss3D)
+RENDER_TILE_SIZE = int(config.get('rendering-tile-size', 256))
+# maximum number of kernel pixels to evaluate at once (limits memory use)
+RENDER_BATCH_PIXELS = 2**20
+
+def _bin_points_to_tiles(starts, width, shape, tile_size):
+    """
+    Work out which (square) tiles of an image the footprint of each point overlaps.
+
+    Parameters
+    ----------
+    starts : list of ndarray
+        index of the first (lowest) pixel of the footprint of each point in x and y
+    width : int
+        footprint width in pixels. Must be <= tile_size, so that each footprint overlaps at most 2 tiles in each dimension
+    shape : tuple
+        (x, y) size of the image
+    tile_size : int
+
+    Returns
+    -------
+    tiles : list of ((x0, x1, y0, y1), point_indices) tuples, one for each tile with any points in it
+
+    """
+    n_tiles_y = (shape[1] + tile_size - 1) // tile_size
+    
+    tx0, ty0 = [numpy.clip(s, 0, n - 1) // tile_size for s, n in zip(starts, shape)]
+    tx1, ty1 = [numpy.clip(s + width - 1, 0, n - 1) // tile_size for s, n in zip(starts, shape)]
+    
+    tile_ids, point_ids = [], []
+    for dx in [0, 1]:
+        for dy in [0, 1]:
+            pts = numpy.flatnonzero(((tx0 + dx) <= tx1) & ((ty0 + dy) <= ty1))
+            tile_ids.append((tx0[pts] + dx) * n_tiles_y + ty0[pts] + dy)
+            point_ids.append(pts)
+    
+    tile_ids = numpy.concatenate(tile_ids)
+    point_ids = numpy.concatenate(point_ids)
+    
+    order = numpy.argsort(tile_ids, kind='stable')
+    tile_ids, point_ids = tile_ids[order], point_ids[order]
+    
+    ids, first = numpy.unique(tile_ids, return_index=True)
+    last = numpy.append(first[1:], len(tile_ids))
+    
+    tiles = []
+    for tile_id, i0, i1 in zip(ids, first, last):
+        x0 = (tile_id // n_tiles_y) * tile_size
+        y0 = (tile_id % n_tiles_y) * tile_size
+        tiles.append(((x0, min(x0 + tile_size, shape[0]), y0, min(y0 + tile_size, shape[1])), point_ids[i0:i1]))
+        
+    return tiles
+
+def _splat_kernels(out, origin, starts, kernels):
+    """
+    Add a batch of separable kernels to an image (tile).
+
+    Parameters
+    ----------
+    out : ndarray
+        the (C-contiguous) image tile to render into. This must be large enough to contain all the kernels.
+    origin : tuple
+        the index in the full image of the tile pixel out[0, 0, ...]
+    starts : list of ndarray
+        for each dimension, the index (in the full image) of the first pixel of each kernel (shape (N,))
+    kernels : list of ndarray
+        for each dimension, the 1D kernel values (shape (N, width)). The rendered kernel is the outer product
+        of these.
+
+    """
+    n_pts = len(starts[0])
+    strides = numpy.cumprod((out.shape[1:] + (1,))[::-1])[::-1]
+    
+    base = numpy.zeros(n_pts, 'i8')
+    offsets = numpy.zeros(1, 'i8')
+    weights = numpy.ones((n_pts, 1))
+    for s, k, o, stride in zip(starts, kernels, origin, strides):
+        base += (s - o) * stride
+        offsets = (offsets[:, None] + stride * numpy.arange(k.shape[1])[None, :]).ravel()
+        weights = (weights[:, :, None] * k[:, None, :]).reshape(n_pts, -1)
+    
+    if n_pts == 0:
+        return
+    
+    # only accumulate over the range of pixels the batch touches, rather than allocating a whole tile for each batch
+    idx = (base[:, None] + offsets[None, :]).ravel()
+    i0 = idx.min()
+    i1 = idx.max() + 1
+    out.ravel()[i0:i1] += numpy.bincount(idx - i0, weights.ravel(), minlength=i1 - i0)
+
+def render_separable_kernels(shape, starts, width, eval_kernels, kernel_size=None, dtype='f'):
+    """
+    Render an image as the sum of per-point separable kernels (e.g. Gaussians).
+
+    The image is divided into square tiles in x and y, points are binned into the tile(s) their footprint overlaps,
+    and the tiles are rendered in parallel, evaluating the kernels for a batch of points at a time. Tile size is set by
+    the `rendering-tile-size` config option, tiles are rendered on the shared compute pool (see PYME.misc.thread_pools).
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the output image. The first two dimensions (x, y) are tiled.
+    starts : list of ndarray
+        the index of the first pixel of the x and y footprint of each point (may lie outside the image)
+    width : int
+        the width in pixels of the kernels in x and y
+    eval_kernels : callable
+        called with an array of point indices, returns a (starts, kernels) pair as accepted by `_splat_kernels`
+        (with one entry for each dimension of the image) for those points.
+    kernel_size : int
+        the (maximum) number of pixels in a single kernel, used to choose the batch size. Defaults to width**2.
+    dtype : dtype of the output image
+
+    Returns
+    -------
+    im : ndarray
+
+    """
+    if kernel_size is None:
+        kernel_size = width * width
+    
+    batch_size = max(1, RENDER_BATCH_PIXELS // kernel_size)
+    tile_size = max(RENDER_TILE_SIZE, width)
+    
+    im = numpy.zeros(shape, dtype)
+    
+    def _render_tile(tile):
+        (x0, x1, y0, y1), pts = tile
+        # render into a tile which is padded on each side by the kernel width, so that we don't need to worry about
+        # kernels extending past the tile edges
+        out = numpy.zeros((x1 - x0 + 2*width, y1 - y0 + 2*width) + tuple(shape[2:]))
+        origin = (x0 - width, y0 - width) + (0,) * (len(shape) - 2)
+        
+        if len(pts) > batch_size:
+            # sort the points along x (the slowest varying axis of the tile) so that each batch only touches a band of
+            # the tile (see _splat_kernels)
+            pts = pts[numpy.argsort(starts[0][pts], kind='stable')]
+        
+        for i in range(0, len(pts), batch_size):
+            kstarts, kernels = eval_kernels(pts[i:(i + batch_size)])
+            _splat_kernels(out, origin, kstarts, kernels)
+            
+        # tiles don't overlap, so it's safe to write the result without locking
+        im[x0:x1, y0:y1] = out[width:-width, width:-width]
+    
+    tiles = _bin_points_to_tiles(starts, width, shape[:2], tile_size)
+    
+    thread_pools.parallel_map(_render_tile, tiles)
+            
+    return im
+
+def _nearest_pixel(X, x):
+    """Index of the nearest pixel centre in a regularly spaced (ascending) set of pixel centres X (clipped to the array)"""
+    return numpy.clip(numpy.floor((x - X[0]) / (X[1] - X[0]) + 0.5), 0, len(X) - 1).astype('i8')
+
+def _gauss_kernels_1d(X, ix, roiSize, x, sx):
+    """Evaluate 1D Gaussians exp(-(X - x)^2/(2*sx^2)) at the 2*roiSize + 1 pixel centres X around pixel ix"""
+    Xv = X[numpy.clip(ix[:, None] + numpy.arange(-roiSize, roiSize + 1)[None, :], 0, len(X) - 1)]
+    return numpy.exp(-(Xv - x[:, None]) ** 2 / (2 * sx[:, None] ** 2))
+
 def rendGauss(x, y, sx, imageBounds, pixelSize):
     """
 
@@ -148,40 +310,37 @@ def rendGauss(x, y, sx, imageBounds, pixelSize):
 
     TODOS:
     
-    - speed improvements? Parallelisation?
     - variable ROI size? We currently base our ROI size on the median localization/jitter error, with the parts of the
     Gaussians which extend past the ROI being dropped. This is usually not an issue, but could become one if we have a
     large range of localization precisions (or if we are using something else - e.g. neighbour distances - as sigma).
     
     """
+    x, y, sx = [numpy.asarray(v, 'f8') for v in (x, y, sx)]
     
-    # choose a ROI size that is appropriate, and generate a padded image to render into
+    # choose a ROI size that is appropriate
     sx = numpy.maximum(sx, pixelSize)
-    fuzz = 3*scipy.median(sx)
+    fuzz = 3*numpy.median(sx)
     roiSize = int(fuzz/pixelSize)
     fuzz = pixelSize*roiSize
 
+    # pixel centres, padded by the ROI size
     # FIXME - do we need the half pixel offset
     X = numpy.arange(imageBounds.x0 - fuzz,imageBounds.x1 + fuzz, pixelSize) + 0.5*pixelSize
     Y = numpy.arange(imageBounds.y0 - fuzz,imageBounds.y1 + fuzz, pixelSize) + 0.5*pixelSize
     
-    im = scipy.zeros((len(X), len(Y)), 'f')
+    # nearest pixel in the padded image
+    ix = _nearest_pixel(X, x)
+    iy = _nearest_pixel(Y, y)
     
-    for i in range(len(x)):
-        # FIXME - argmin() involves a search (expensive) - we should be able to get the nearest pixel as something like
-        # ix = int(np.round((x[i] - X[0])/pixelSize))
-        ix = scipy.absolute(X - x[i]).argmin()
-        iy = scipy.absolute(Y - y[i]).argmin()
-
-        sxi = sx[i]
+    def _eval_kernels(pts):
+        gx = _gauss_kernels_1d(X, ix[pts], roiSize, x[pts], sx[pts])
+        gy = _gauss_kernels_1d(Y, iy[pts], roiSize, y[pts], sx[pts])
         
-        imp = Gauss2D(X[(ix - roiSize):(ix + roiSize + 1)], Y[(iy - roiSize):(iy + roiSize + 1)],1/sxi, x[i],y[i],sxi)
-        im[(ix - roiSize):(ix + roiSize + 1), (iy - roiSize):(iy + roiSize + 1)] += imp
-
-    # clip to final image size
-    im = im[roiSize:-roiSize, roiSize:-roiSize]
+        # the first pixel of the ROI, in un-padded image coordinates
+        return [ix[pts] - 2*roiSize, iy[pts] - 2*roiSize], [gx/sx[pts][:, None], gy]
 
-    return im
+    return render_separable_kernels((len(X) - 2*roiSize, len(Y) - 2*roiSize), [ix - 2*roiSize, iy - 2*roiSize],
+                                    2*roiSize + 1, _eval_kernels)
 
 
 def rend_density_estimate(x, y, imageBounds, pixelSize, N=10):
@@ -743,48 +902,51 @@ def Gauss3d(X, Y, Z, x0, y0, z0, wxy, wz):
 
     return scipy.exp(-((X[:,None]-x0)**2 + (Y[None,:] - y0)**2)/(2*wxy**2) - ((Z-z0)**2)/(2*wz**2))/((2*scipy.pi*wxy**2)*scipy.sqrt(2*scipy.pi*wz**2))
 
+# normalisation constant used by gauss_app.genGauss3D ((2*pi)**1.5)
+TDNORM = 15.75
+
 def rendGauss3D(x,y, z, sx, sz, imageBounds, pixelSize, zb, sliceSize=100):
-    from PYME.localization.cModels.gauss_app import genGauss3D
+    x, y, z, sx, sz = [numpy.asarray(v, 'f8') for v in (x, y, z, sx, sz)]
+    
     sx = numpy.maximum(sx, pixelSize)
-    fuzz = 3*scipy.median(sx)
+    fuzz = 3*numpy.median(sx)
     roiSize = int(fuzz/pixelSize)
     fuzz = pixelSize*roiSize
 
-    #print imageBounds.x0
-    #print imageBounds.x1
-    #print fuzz
-
-    #print pixelSize
-
     X = numpy.arange(imageBounds.x0 - fuzz,imageBounds.x1 + fuzz, pixelSize)
     Y = numpy.arange(imageBounds.y0 - fuzz,imageBounds.y1 + fuzz, pixelSize)
     Z = numpy.arange(zb[0], zb[1], sliceSize)
 
-    #print X
-
-    im = scipy.zeros((len(X), len(Y), len(Z)), 'f')
-
     #record our image resolution so we can plot pts with a minimum size equal to res (to avoid missing small pts)
-    delX = scipy.absolute(X[1] - X[0])
-    delZ = scipy.absolute(Z[1] - Z[0])
-
-    #for zn in range(len(Z)):
-    for i in range(len(x)):
-        ix = scipy.absolute(X - x[i]).argmin()
-        iy = scipy.absolute(Y - y[i]).argmin()
-        iz = scipy.absolute(Z - z[i]).argmin()
+    delZ = numpy.absolute(Z[1] - Z[0])
+    
+    ix = _nearest_pixel(X, x)
+    iy = _nearest_pixel(Y, y)
+    iz = _nearest_pixel(Z, z)
+    
+    # each point is rendered into the slices within 2 sigma of it
+    dz = numpy.round(2*sz/delZ).astype('i8')
+    iz_min = numpy.maximum(iz - dz, 0)
+    iz_max = numpy.minimum(iz + dz + 1, len(Z))
+    nz = iz_max - iz_min
+    sz = numpy.maximum(sz, sliceSize)
+    
+    def _eval_kernels(pts):
+        gx = _gauss_kernels_1d(X, ix[pts], roiSize, x[pts], sx[pts])
+        gy = _gauss_kernels_1d(Y, iy[pts], roiSize, y[pts], sx[pts])
         
-        dz = int(round(2*sz[i]/delZ))
-
-        iz_min = max(iz - dz, 0)
-        iz_max = min(iz + dz + 1, len(Z))
-
-
-        imp = genGauss3D(X[(ix - roiSize):(ix + roiSize + 1)], Y[(iy - roiSize):(iy + roiSize + 1)],Z[iz_min:iz_max], 1.0e3,x[i],y[i],z[i], sx[i],max(sz[i], sliceSize))
-        #print imp.shape
-        #print im[(ix - roiSize):(ix + roiSize + 1), (iy - roiSize):(iy + roiSize + 1), zn].shape
-        im[(ix - roiSize):(ix + roiSize + 1), (iy - roiSize):(iy + roiSize + 1), iz_min:iz_max] += imp
-
-    im = im[roiSize:-roiSize, roiSize:-roiSize, :]
+        # evaluate all the z kernels in the batch on a window of the same size (which must fit within the image),
+        # zeroing the slices outside each point's own range
+        nz_max = nz[pts].max()
+        z_start = numpy.minimum(iz_min[pts], len(Z) - nz_max)
+        iz_k = z_start[:, None] + numpy.arange(nz_max)[None, :]
+        gz = numpy.exp(-(Z[iz_k] - z[pts][:, None])**2/(2*sz[pts][:, None]**2))
+        gz *= (iz_k >= iz_min[pts][:, None]) & (iz_k < iz_max[pts][:, None])
+        
+        A = 1.0e3/(sx[pts]**2*sz[pts]*TDNORM)
+        
+        return [ix[pts] - 2*roiSize, iy[pts] - 2*roiSize, z_start], [gx*A[:, None], gy, gz]
 
-    return im
+    return render_separable_kernels((len(X) - 2*roiSize, len(Y) - 2*roiSize, len(Z)),
+                                    [ix - 2*roiSize, iy - 2*roiSize], 2*roiSize + 1, _eval_kernels,
+                                    kernel_size=(2*roiSize + 1)**2*max(int(nz.max(initial=1)), 1))
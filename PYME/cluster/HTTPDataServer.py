@@ -158,6 +158,13 @@ def updateStatus():
     except ImportError:
         pass
 
+    try:
+        # writer-side metrics for files we are aggregating into
+        from PYME.IO import h5rFile
+        status['H5Writers'] = h5rFile.get_writer_metrics()
+    except ImportError:
+        pass
+
     if GPU_STATS:
         handles = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(pynvml.nvmlDeviceGetCount())]
         gpu_usage = [pynvml.nvmlDeviceGetUtilizationRates(h) for h in handles]
@@ -213,6 +220,26 @@ _listDirLock = threading.Lock()
 
 from PYME.IO import clusterListing as cl
 
+import re
+_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+class _RangeFile(object):
+    """Wraps an open file so that reads (as done by copyfile) stop at the end of a requested byte range"""
+    def __init__(self, f, length):
+        self._f = f
+        self._remaining = length
+        
+    def read(self, size=-1):
+        if (size is None) or (size < 0) or (size > self._remaining):
+            size = self._remaining
+        
+        data = self._f.read(size)
+        self._remaining -= len(data)
+        return data
+    
+    def close(self):
+        self._f.close()
+
 class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     protocol_version = "HTTP/1.0"
     bandwidthTesting = False
@@ -385,9 +412,42 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         return
 
 
+    def _aggregate_flush(self):
+        """
+        Explicitly flush (or close) an aggregated .h5r / .h5 file.
+        
+        Appends to aggregated HDF5 files are queued and written by a single, long-lived, writer thread per file (see
+        :mod:`PYME.IO.h5rFile`) which only closes the file after it has been idle for a while. A PUT to
+        `__aggregate_flush/path/to/file.h5r` blocks until all previously queued data is on disk, a PUT to
+        `__aggregate_close/path/to/file.h5r` additionally closes the file (e.g. once all results for a series are in).
+        """
+        from PYME.IO import h5rFile
+        
+        path = self.path.lstrip('/')
+        if path.startswith('__aggregate_close'):
+            filename = self.translate_path(path[len('__aggregate_close'):])
+            found = h5rFile.close_file(filename)
+        else:
+            filename = self.translate_path(path[len('__aggregate_flush'):])
+            found = h5rFile.flush_file(filename)
+            
+        if self.headers.get('Content-Length'):
+            #consume any (empty) data we have been sent
+            self._get_data()
+        
+        if not found and not os.path.exists(filename):
+            self.send_error(404, "File not found - %s, [%s]" % (self.path, filename))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
     def _doAggregate(self):
         # TODO - add authentication/checks for aggregation. Files which still allow appends should not be duplicated.
-        if self.path.lstrip('/').startswith('__aggregate_txt'):
+        if self.path.lstrip('/').startswith('__aggregate_flush') or self.path.lstrip('/').startswith('__aggregate_close'):
+            self._aggregate_flush()
+        elif self.path.lstrip('/').startswith('__aggregate_txt'):
             self._aggregate_txt()
         elif self.path.lstrip('/').startswith('__aggregate_h5r'):
             self._aggregate_h5r()
@@ -518,6 +578,62 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         self.end_headers()
         return f
 
+    def _get_range(self, size):
+        """
+        Parse a (single) Range header for a resource of the given size.
+        
+        Returns
+        -------
+        None if no range was requested (or the header was not understood - in which case RFC7233 lets us ignore it and
+        return the whole resource), False if the range is not satisfiable (we have already sent a 416 response), and
+        a (start, end) tuple, with end exclusive, otherwise.
+        """
+        range_header = self.headers.get('Range', None)
+        if not range_header:
+            return None
+        
+        m = _range_re.match(range_header.strip())
+        if m is None:
+            # malformed, or multiple ranges (which we don't support)
+            return None
+        
+        first, last = m.groups()
+        if first == '' and last == '':
+            return None
+        
+        if first == '':
+            #suffix range - the last n bytes
+            start, end = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            if (last != '') and (int(last) < start):
+                # syntactically invalid (e.g. bytes=10-5) - RFC7233 says to ignore the header
+                return None
+            
+            end = size if last == '' else min(int(last) + 1, size)
+            
+        if (start >= size) or (end <= start):
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return False
+        
+        return start, end
+    
+    def _send_content_headers(self, ctype, size, byte_range):
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, size))
+            self.send_header("Content-Length", str(end - start))
+        else:
+            self.send_response(200)
+            self.send_header("Content-Length", str(size))
+        
+        self.send_header("Content-type", ctype)
+        self.send_header("Accept-Ranges", "bytes")
+
     def send_head(self):
         """Common code for GET and HEAD commands.
 
@@ -577,12 +693,21 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             self.send_error(404, "File not found - %s, [%s]" % (self.path, path))
             return None
         try:
-            self.send_response(200)
-            self.send_header("Content-type", ctype)
             fs = os.fstat(f.fileno())
-            self.send_header("Content-Length", str(fs[6]))
+            byte_range = self._get_range(fs[6])
+            if byte_range is False:
+                f.close()
+                return None
+            
+            self._send_content_headers(ctype, fs[6], byte_range)
             self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
             self.end_headers()
+            
+            if byte_range:
+                start, end = byte_range
+                f.seek(start)
+                return _RangeFile(f, end - start)
+            
             return f
         except:
             f.close()
@@ -665,14 +790,24 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             part = part.lstrip('/').lstrip('\\')
             
             with h5File.openH5(filename + '.h5') as h5f:
-                f, length = self._string_to_file(h5f.get_file(part))
+                data = h5f.get_file(part)
+            
+            if not isinstance(data, bytes):
+                data = data.encode()
+                
+            byte_range = self._get_range(len(data))
+            if byte_range is False:
+                return None
+            
+            if byte_range:
+                f, length = self._string_to_file(data[byte_range[0]:byte_range[1]])
+            else:
+                f, length = self._string_to_file(data)
 
-                self.send_response(200)
-                self.send_header("Content-type", ctype)
-                self.send_header("Content-Length", length)
-                #self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
-                self.end_headers()
-                return f
+            self._send_content_headers(ctype, len(data), byte_range)
+            #self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+            self.end_headers()
+            return f
                 
             
         except IOError:
@@ -38,10 +38,83 @@ def template_fill(template, **kwargs):
     
     return s
 
+def frame_block_tasks(template, ruleID, taskIDs, block_size):
+    """
+    Group task IDs from a localization rule into frame-block tasks, each covering a contiguous range of at most
+    `block_size` frames.
+    
+    A frame-block task is the task for the first frame in the block, with an additional ``taskdef.frameRange``
+    entry giving the [start, end) of the block. Workers process the frames of a block sequentially and hand in
+    each frame as a separate task.
+    
+    Parameters
+    ----------
+    template : str
+        the task template for the rule
+    ruleID : str
+    taskIDs : list of int
+        the task IDs (frame numbers) we have successfully bid on
+    block_size : int
+        the maximum number of frames in a block
+
+    Returns
+    -------
+    list of task dictionaries
+    
+    """
+    tasks = []
+    
+    taskIDs = sorted(taskIDs)
+    i = 0
+    while i < len(taskIDs):
+        start = taskIDs[i]
+        j = i + 1
+        while (j < len(taskIDs)) and (taskIDs[j] == (taskIDs[j-1] + 1)) and ((j - i) < block_size):
+            j += 1
+            
+        task = json.loads(template_fill(template, taskID=start, ruleID=ruleID, taskInputs='{}'))
+        if (task['type'] == 'localization') and (j - i) > 1:
+            task['taskdef']['frameRange'] = [start, taskIDs[j-1] + 1]
+            # make sure a worker only takes one block at a time
+            task['optimal-chunk-size'] = 1
+            tasks.append(task)
+        else:
+            # not a localization task, or a block of one - fall back to individual tasks
+            tasks.append(task)
+            for taskID in taskIDs[(i+1):j]:
+                tasks.append(json.loads(template_fill(template, taskID=taskID, ruleID=ruleID, taskInputs='{}')))
+            
+        i = j
+        
+    return tasks
+
+def task_n_frames(task):
+    """The number of frames (individual tasks) covered by a task - more than 1 for frame-block tasks"""
+    frame_range = task.get('taskdef', {}).get('frameRange', None)
+    if frame_range is None:
+        return 1
+    
+    return int(frame_range[1]) - int(frame_range[0])
+
+def iter_advertised_task_ids(rule):
+    """
+    Iterate over the available task IDs in a rule advertisement.
+    
+    Adverts list the available tasks as [start, end) ranges (``availableTaskRanges``). Older rule servers send an
+    explicit list of IDs (``availableTaskIDs``), which we also accept.
+    """
+    if 'availableTaskRanges' in rule:
+        for start, end in rule['availableTaskRanges']:
+            for taskID in range(start, end):
+                yield taskID
+    else:
+        for taskID in rule['availableTaskIDs']:
+            yield taskID
+
 class Rater(object):
     def __init__(self, rule):
         self.rule = rule
-        self.taskIDs = rule['availableTaskIDs']
+        self.taskIDs = iter_advertised_task_ids(rule)
         self.template = rule['taskTemplate']
         inputs = rule.get('inputsByTask', {})
         self.inputs = {int(k):v for k, v in inputs.items()}
@@ -54,18 +127,30 @@ class Rater(object):
         
         self._non_local = []
         
+        # for localization rules (where task IDs are frame numbers and there are no per-task inputs) the filled template
+        # only differs in the frame number, so we can avoid filling and parsing the template for every task
+        self._frame_filename_stub = None
+        if len(self.inputs) == 0:
+            task = json.loads(template_fill(self.template, taskID=0, taskInputs=None))
+            if task['type'] == 'localization' and task['taskdef'].get('frameIndex') == '0':
+                filename, self._serverfilter = clusterIO.parseURL(task['inputs']['frames'])
+                self._frame_filename_stub = filename.lstrip('/') + '/frame%05d.pzf'
+        
     def __iter__(self):
         return self
     
     def __next__(self):
-        try:
-            taskID = self.taskIDs[self.n]
-            self.n += 1
-        except IndexError:
-            raise StopIteration
+        taskID = next(self.taskIDs)
+        self.n += 1
         
         #logger.debug('taskID: %s, taskInputs: %s' % (taskID, self.inputs.get(taskID)))
         
+        if self._frame_filename_stub is not None:
+            if clusterIO.is_local(self._frame_filename_stub % int(taskID), self._serverfilter):
+                return taskID, .01
+            else:
+                return taskID, 1.0
+        
         task_inputs = self.inputs.get(taskID)
         if not task_inputs is None:
             task_inputs = json.dumps(task_inputs)
@@ -123,6 +208,10 @@ class NodeServer(object):
     def __init__(self, distributor, ip_address, port, nodeID=computerName.GetComputerName()):
         self._tasks = Queue.Queue()
         self._handins = Queue.Queue()
+        
+        # the number of frames in the task queue (frame-block tasks count as more than one task)
+        self._n_queued = 0
+        self._n_queued_lock = threading.Lock()
 
         self.nodeID = nodeID
         self.distributor_url = distributor
@@ -165,11 +254,18 @@ class NodeServer(object):
               
         
 
+    def _queue_task(self, task):
+        with self._n_queued_lock:
+            self._n_queued += task_n_frames(task)
+            
+        self._tasks.put(task)
+
     def _update_tasks(self):
         """Update our task queue"""
         #logger.debug('Updating tasks')
         with self._update_tasks_lock:
-            n_tasks_to_request = self.num_tasks_to_request - self._tasks.qsize()
+            # count queued frames rather than queued tasks so that we don't over-bid when tasks are frame blocks
+            n_tasks_to_request = self.num_tasks_to_request - self._n_queued
             
             t = time.time()
             if (t - self._lastUpdateTime) < 0.5:
@@ -193,6 +289,7 @@ class NodeServer(object):
                 raters = [Rater(rule) for rule in rules]
                 templates_by_ID = {rule['ruleID']: rule['taskTemplate'] for rule in rules}
                 inputs_by_ID = {rule['ruleID']: rule.get('inputsByTask', {}) for rule in rules}
+                block_sizes_by_ID = {rule['ruleID']: int(rule.get('blockSize', 1)) for rule in rules}
                 
                 #try to get local tasks
                 for rater in raters:
@@ -247,14 +344,21 @@ class NodeServer(object):
                     template = templates_by_ID[ruleID]
                     rule_inputs = inputs_by_ID[ruleID]
                     logging.debug('rule_inputs:' + repr(rule_inputs))
+                    
+                    if (block_sizes_by_ID[ruleID] > 1) and (len(rule_inputs) == 0):
+                        for task in frame_block_tasks(template, ruleID, bid['taskIDs'], block_sizes_by_ID[ruleID]):
+                            self._queue_task(task)
+                        
+                        continue
+                    
                     for taskID in bid['taskIDs']:
                         
                         logging.debug('taskID: ' + repr(taskID) )
                         taskInputs = json.dumps(rule_inputs.get(u'%s' % taskID, {}))
                         logging.debug('taskInputs:' + repr(taskInputs))
                         
-                        self._tasks.put(json.loads(template_fill(template,taskID=taskID, ruleID=ruleID,
-                                                                 taskInputs=taskInputs)))
+                        self._queue_task(json.loads(template_fill(template,taskID=taskID, ruleID=ruleID,
+                                                                  taskInputs=taskInputs)))
                
                 
             except requests.Timeout:
@@ -294,7 +398,7 @@ class NodeServer(object):
                 elif handin['status'] == 'failure':
                     status = STATUS_FAILED
                 else:
-                    logger.error('Unknown handin status: %s, ignoring' % status)
+                    logger.error('Unknown handin status: %s, ignoring' % handin['status'])
                     continue
                 
                 taskID = int(taskID)
@@ -302,11 +406,12 @@ class NodeServer(object):
                 try:
                     h_ruleID = handins_by_rule[ruleID]
                 except KeyError:
-                    h_ruleID = {'ruleID' : ruleID, 'taskIDs' : [], 'status' : []}
+                    h_ruleID = {'ruleID' : ruleID, 'taskIDs' : [], 'status' : [], 'execTimes' : []}
                     handins_by_rule[ruleID] = h_ruleID
                     
                 h_ruleID['taskIDs'].append(taskID)
                 h_ruleID['status'].append(status)
+                h_ruleID['execTimes'].append(float(handin.get('execTime', 0)))
                 
                 
             try:
@@ -354,6 +459,9 @@ class NodeServer(object):
                 nTasks += 1
         except Queue.Empty:
             pass
+        
+        with self._n_queued_lock:
+            self._n_queued -= sum([task_n_frames(task) for task in tasks])
 
         logging.debug('Giving %d tasks to %s' % (len(tasks), workerID))
 
@@ -362,8 +470,21 @@ class NodeServer(object):
 
 
     @webframework.register_endpoint('/node/handin')
-    def _handin(self, taskID, status):
-        self._handins.put({'id': taskID, 'status':status})
+    def _handin(self, taskID=None, status=None, body=''):
+        """
+        Hand in completed tasks. Either a single task, specified by the `taskID` and `status` query parameters, or
+        a batch of tasks, specified as a JSON list of ``{'taskID' : ..., 'status' : ..., 'execTime' : ...}`` dictionaries
+        in the request body. The (optional) execTime is the time in seconds the worker spent on the task and is used
+        by the rule server to size frame-block tasks.
+        """
+        if taskID is not None:
+            self._handins.put({'id': taskID, 'status':status})
+        
+        if body:
+            for handin in json.loads(body):
+                self._handins.put({'id': handin['taskID'], 'status': handin['status'],
+                                   'execTime': handin.get('execTime', 0)})
+            
         return json.dumps({'ok' : True})
 
     @webframework.register_endpoint('/node/status')
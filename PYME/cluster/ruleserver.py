@@ -22,16 +22,40 @@ from PYME.util import webframework
 import collections
 
 import uuid
+import heapq
 
 import numpy as np
 
 class Rule(object):
     pass
 
+# target execution time for, and maximum size of, frame-block tasks
+BLOCK_DURATION = config.get('ruleserver-block-duration', 2.0) #s
+MAX_BLOCK_SIZE = config.get('ruleserver-max-block-size', 500)
+
 STATUS_UNAVAILABLE, STATUS_AVAILABLE, STATUS_ASSIGNED, STATUS_COMPLETE, STATUS_FAILED = range(5)
 
+def mask_to_ranges(mask, offset=0):
+    """
+    Run-length encode a boolean mask as a list of [start, end) ranges of the indices where it is True.
+    
+    Parameters
+    ----------
+    mask : np.ndarray of bool
+    offset : int
+        value to add to the indices (if the mask is a slice of a larger array)
+
+    Returns
+    -------
+    list of [start, end] pairs
+    
+    """
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], mask, [False]]).astype('i1')))
+    return (edges.reshape(-1, 2) + offset).tolist()
+
 class IntegerIDRule(Rule):
-    TASK_INFO_DTYPE = np.dtype([('status', 'uint8'), ('nRetries', 'uint8'), ('expiry', 'f4'), ('cost', 'f4')])
+    # NB - expiry is a unix timestamp and needs double precision (a float32 only resolves to ~2 minutes)
+    TASK_INFO_DTYPE = np.dtype([('status', 'uint8'), ('nRetries', 'uint8'), ('expiry', 'f8'), ('cost', 'f4')])
     
     
     def __init__(self, ruleID, task_template, inputs_by_task = None,
@@ -60,23 +84,73 @@ class IntegerIDRule(Rule):
         
         self.avCost = 0
         
+        # running total of the cost of all tasks which have been assigned (or completed), used to calculate avCost
+        # without re-scanning the task table
+        self._cost_total = 0.
+        self._n_costed = 0
+        
+        # the task IDs we have released so far are all < _n_released, which lets us restrict scans to the used part
+        # of the task table
+        self._n_released = 0
+        
+        # heap of (expiry time, bid #, task IDs) entries, one per successful bid, so that we only need to look at
+        # bids which have expired when polling for timeouts
+        self._expiry_heap = []
+        self._n_bids = 0
+        
+        # measured execution times, as reported by the workers
+        self._exec_time_total = 0.
+        self._n_exec_times = 0
+        
         self.expiry = time.time() + self._rule_timeout
               
         self._info_lock = threading.Lock()
         self._advert_lock = threading.Lock()
         
     def _update_nums(self):
-        self.nAvailable = int((self._task_info['status'] == STATUS_AVAILABLE).sum())
-        self.nAssigned = int((self._task_info['status'] == STATUS_ASSIGNED).sum())
+        """Recalculate the task counts from scratch (the counts are normally maintained incrementally)"""
+        counts = np.bincount(self._task_info['status'][:self._n_released], minlength=5)
+        self.nTotal = int(counts[STATUS_UNAVAILABLE+1:].sum())
+        self.nAvailable = int(counts[STATUS_AVAILABLE])
+        self.nAssigned = int(counts[STATUS_ASSIGNED])
+        
+    def _add_costs(self, costs, sign=1):
+        """Add (or, with sign=-1, remove) the costs of tasks entering (leaving) the assigned/completed states"""
+        self._cost_total += sign*float(np.sum(costs, dtype='f8'))
+        self._n_costed += sign*len(costs)
         
     def _update_cost(self):
-        av_cost = np.mean(self._task_info['cost'][self._task_info['status'] > STATUS_AVAILABLE])
-        if np.isnan(av_cost):
-            av_cost = 0
+        if self._n_costed > 0:
+            self.avCost = self._cost_total/self._n_costed
         else:
-            av_cost = float(av_cost)
-            
-        self.avCost = av_cost
+            self._cost_total = 0.
+            self.avCost = 0
+        
+    @property
+    def avExecutionTime(self):
+        """The average time (in s) taken to execute a single task on a worker, or 0 if we have not measured it yet"""
+        if self._n_exec_times == 0:
+            return 0.
+        
+        return self._exec_time_total/self._n_exec_times
+    
+    @property
+    def blockSize(self):
+        """
+        The suggested number of tasks (frames) to group into a single frame-block task (see
+        `rulenodeserver.frame_block_tasks`).
+        
+        This is chosen such that a block takes approximately `ruleserver-block-duration` seconds to execute, based on
+        the measured execution time of the tasks completed so far, and is limited to `ruleserver-max-block-size`.
+        Until we have measured the execution time, tasks are not grouped.
+        """
+        av_time = self.avExecutionTime
+        if av_time <= 0:
+            return 1
+        
+        block_size = int(BLOCK_DURATION/av_time)
+        
+        return max(1, min(block_size, MAX_BLOCK_SIZE))
         
     def make_range_available(self, start, end):
         '''Make a range of tasks available (to be called once the underlying data is available)'''
@@ -86,11 +160,18 @@ class IntegerIDRule(Rule):
         
         #TODO - check existing status - it probably makes sense to only apply this to tasks which have STATUS_UNAVAILABLE
         with self._info_lock:
-            self._task_info['status'][start:end] = STATUS_AVAILABLE
+            status = self._task_info['status'][start:end]
+            counts = np.bincount(status, minlength=5)
+            self._add_costs(self._task_info['cost'][start:end][status > STATUS_AVAILABLE], -1)
             
-            self.nTotal = int((self._task_info['status'] >0).sum())
-        
-            self._update_nums()
+            status[:] = STATUS_AVAILABLE
+            
+            self._n_released = max(self._n_released, end)
+            self.nTotal += int(counts[STATUS_UNAVAILABLE])
+            self.nAvailable += len(status) - int(counts[STATUS_AVAILABLE])
+            self.nAssigned -= int(counts[STATUS_ASSIGNED])
+            
+            self._update_cost()
 
         self.expiry = time.time() + self._rule_timeout
         
@@ -111,16 +192,28 @@ class IntegerIDRule(Rule):
         taskIDs = np.array(bid['taskIDs'], 'i')
         costs = np.array(bid['costs'], 'f4')
         with self._info_lock:
+            # only consider the first bid on any given task
+            taskIDs, first = np.unique(taskIDs, return_index=True)
+            costs = costs[first]
+            
             successful_bid_mask = self._task_info['status'][taskIDs] == STATUS_AVAILABLE
             successful_bid_ids = taskIDs[successful_bid_mask]
+            successful_costs = costs[successful_bid_mask]
+            expiry = time.time() + self._timeout
+            
             self._task_info['status'][successful_bid_ids] = STATUS_ASSIGNED
-            self._task_info['cost'][successful_bid_ids] = costs[successful_bid_mask]
-            self._task_info['expiry'][successful_bid_ids] = time.time() + self._timeout
+            self._task_info['cost'][successful_bid_ids] = successful_costs
+            self._task_info['expiry'][successful_bid_ids] = expiry
             
             nTasks = len(successful_bid_ids)
+            if nTasks > 0:
+                heapq.heappush(self._expiry_heap, (expiry, self._n_bids, successful_bid_ids))
+                self._n_bids += 1
+            
             self.nAvailable -= nTasks
             self.nAssigned += nTasks
             
+            self._add_costs(successful_costs)
             self._update_cost()
 
         self.expiry = time.time() + self._rule_timeout
@@ -131,17 +224,58 @@ class IntegerIDRule(Rule):
         return {'ruleID': bid['ruleID'], 'taskIDs':successful_bid_ids.tolist(), 'template' : self._template}
     
     def mark_complete(self, info):
+        """
+        Mark a batch of tasks as complete (or failed).
+        
+        Parameters
+        ----------
+        info : dictionary containing the following items: ruleID, taskIDs, status, and optionally execTimes. taskIDs,
+            status (and execTimes) are equal length lists. A task may appear more than once (e.g. if it timed out and was
+            handed in by two workers), in which case the last status is used. execTimes are the times (in s) the worker
+            spent on each task, with values <= 0 indicating that the time is not known.
+        
+        """
         taskIDs = np.array(info['taskIDs'], 'i')
         status = np.array(info['status'], 'uint8')
         
+        if len(taskIDs) == 0:
+            return
+        
+        exec_times = np.array(info.get('execTimes', []), 'f8')
+        if len(exec_times) == len(taskIDs):
+            measured = exec_times[(exec_times > 0) & (status == STATUS_COMPLETE)]
+        else:
+            measured = exec_times[:0]
+        
+        # only keep the last hand-in for any given task
+        _, last = np.unique(taskIDs[::-1], return_index=True)
+        last = len(taskIDs) - 1 - last
+        taskIDs, status = taskIDs[last], status[last]
+        
         with self._info_lock:
+            self._exec_time_total += float(measured.sum())
+            self._n_exec_times += len(measured)
+            
+            prev_status = self._task_info['status'][taskIDs]
+            
+            # ignore tasks which have already been handed in
+            pending = (prev_status == STATUS_ASSIGNED) | (prev_status == STATUS_AVAILABLE)
+            taskIDs, status, prev_status = taskIDs[pending], status[pending], prev_status[pending]
+            
             self._task_info['status'][taskIDs] = status
+            self._add_costs(self._task_info['cost'][taskIDs][prev_status == STATUS_AVAILABLE])
+            self._update_cost()
             
             self.nCompleted += int((status ==STATUS_COMPLETE).sum())
             self.nFailed += int((status == STATUS_FAILED).sum())
             
-            nTasks = len(taskIDs)
-            self.nAssigned -= nTasks
+            # tasks which timed out will have been made available again before being handed in
+            self.nAssigned -= int((prev_status == STATUS_ASSIGNED).sum())
+            self.nAvailable -= int((prev_status == STATUS_AVAILABLE).sum())
+            
+        if (prev_status == STATUS_AVAILABLE).any():
+            with self._advert_lock:
+                self._cached_advert = None
 
         self.expiry = time.time() + self._rule_timeout
             
@@ -149,19 +283,28 @@ class IntegerIDRule(Rule):
     def advert(self):
         with self._advert_lock:
             if not self._cached_advert:
-                availableTasks = np.where(self._task_info['status'] == STATUS_AVAILABLE)[0].tolist()
+                # tasks are generally released (and bid on) in contiguous blocks, so we advertise the available task IDs
+                # as a list of [start, end) ranges rather than as an explicit list of IDs.
+                with self._info_lock:
+                    nAvailable = self.nAvailable
+                    if nAvailable > 0:
+                        availableTaskRanges = mask_to_ranges(self._task_info['status'][:self._n_released] == STATUS_AVAILABLE)
                 
-                if len(availableTasks) == 0:
+                if nAvailable == 0:
                     self._cached_advert = None
                 else:
                     self._cached_advert = {'ruleID' : self.ruleID,
                         'taskTemplate': self._template,
-                        'availableTaskIDs': availableTasks}
+                        'availableTaskRanges': availableTaskRanges,
+                        'nAvailable' : nAvailable,
+                        'blockSize' : self.blockSize}
                     
                     #print self._inputs_by_task
                     
                     if not self._inputs_by_task is None:
-                        self._cached_advert['inputsByTask'] = {taskID: self._inputs_by_task[taskID] for taskID in availableTasks}
+                        self._cached_advert['inputsByTask'] = {taskID: self._inputs_by_task[taskID]
+                                                               for start, end in availableTaskRanges
+                                                               for taskID in range(start, end)}
                 
             return self._cached_advert
     
@@ -192,14 +335,25 @@ class IntegerIDRule(Rule):
                   'tasksCompleted': self.nCompleted,
                   'tasksFailed' : self.nFailed,
                   'averageExecutionCost' : self.avCost,
+                  'averageExecutionTime' : self.avExecutionTime,
+                  'blockSize' : self.blockSize,
                 }
     
     def poll_timeouts(self):
         t = time.time()
         
         with self._info_lock:
-            timed_out = np.where((self._task_info['status'] == STATUS_ASSIGNED)*(self._task_info['expiry'] < t))[0]
+            expired_bids = []
+            while len(self._expiry_heap) > 0 and self._expiry_heap[0][0] < t:
+                expired_bids.append(heapq.heappop(self._expiry_heap)[2])
+            
+            if len(expired_bids) == 0:
+                return
             
+            candidates = np.unique(np.concatenate(expired_bids))
+            # tasks may have been handed in, or timed out and been re-assigned with a later expiry, since the bid
+            timed_out = candidates[(self._task_info['status'][candidates] == STATUS_ASSIGNED) &
+                                   (self._task_info['expiry'][candidates] < t)]
             
             nTimedOut = len(timed_out)
             if nTimedOut > 0:
@@ -209,14 +363,18 @@ class IntegerIDRule(Rule):
                 self.nAssigned -= nTimedOut
                 self.nAvailable += nTimedOut
     
-                retry_failed = self._task_info['nRetries'] > self._n_retries
+                retry_failed = timed_out[self._task_info['nRetries'][timed_out] > self._n_retries]
                 self._task_info['status'][retry_failed] = STATUS_FAILED
-                self.nAvailable -= int(retry_failed.sum())
+                self.nAvailable -= len(retry_failed)
                 
-                #self._update_nums()
+                # tasks which are available again no longer contribute to the average cost
+                self._add_costs(self._task_info['cost'][timed_out], -1)
+                self._add_costs(self._task_info['cost'][retry_failed])
+                self._update_cost()
             
-        with self._advert_lock:
-            self._cached_advert = None
+        if nTimedOut > 0:
+            with self._advert_lock:
+                self._cached_advert = None
         
         
     
@@ -296,7 +454,7 @@ class RuleServer(object):
                     
                     if not advert is None:
                         adverts.append(advert)
-                        nTasks += len(advert['availableTaskIDs'])
+                        nTasks += advert['nAvailable']
                         
                     ruleN += 1
                     
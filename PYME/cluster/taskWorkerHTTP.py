@@ -34,6 +34,8 @@ matplotlib.use('SVG')
 
 import queue as Queue
 import threading
+import collections
+import ujson as json
 
 #import PYME.misc.pyme_zeroconf as pzc
 from PYME import config
@@ -85,6 +87,11 @@ LOCAL = False
 if 'PYME_LOCAL_ONLY' in os.environ.keys():
     LOCAL = os.environ['PYME_LOCAL_ONLY'] == '1'
     
+#coalesce completed tasks into a single hand-in (and a single results append per output file)
+BATCH_HANDIN = config.get('taskworker-batch-handin', True)
+HANDIN_WINDOW = config.get('taskworker-handin-window', 0.5) #s
+HANDIN_MAX_TASKS = config.get('taskworker-handin-max-tasks', 100)
+    
 class TaskError(object):
     template = '''===========================================================================
 Error in rule: {rule_id} running task: {task_id} on {comp_name}:{pid}
@@ -122,6 +129,10 @@ class taskWorker(object):
         self.procName = '%s_%d' % (compName, os.getpid())
 
         self._loop_alive = True
+        
+        # completed tasks which have not yet been handed in
+        self._pending_results = []
+        self._pending_since = 0
 
     def loop_forever(self):
         self.tCompute = threading.Thread(target=self.computeLoop)
@@ -138,68 +149,127 @@ class taskWorker(object):
         finally:
             self._loop_alive = False
 
-    def _return_task_results(self):
+    def _return_task_results(self, flush=False):
         """
 
         File all results that this worker has completed
 
+        When batched hand-in is enabled (the default, see the `taskworker-batch-handin` config option), completed tasks
+        are held back until either `taskworker-handin-max-tasks` tasks have accumulated, the oldest has been waiting
+        for `taskworker-handin-window` seconds, or `flush` is True. Results for the same output URI are then concatenated
+        and filed with a single append, and the tasks are handed in to the node server with a single request.
+
+        Parameters
+        ----------
+        flush : bool
+            hand in all pending tasks regardless of the batching window (used before we block waiting for new tasks)
+
         Returns
         -------
 
         """
-        while True:  # loop over results queue until it's empty
-            # print 'getting results'
-            try:
-                queueURL, taskDescr, res = self.resultsQueue.get_nowait()
-                outputs = taskDescr.get('outputs', {})
-            except Queue.Empty:
-                # queue is empty
-                return
+        try:
+            while True:  # loop over results queue until it's empty
+                self._pending_results.append(self.resultsQueue.get_nowait())
+                if len(self._pending_results) == 1:
+                    self._pending_since = time.time()
+        except Queue.Empty:
+            pass
+        
+        if len(self._pending_results) == 0:
+            return
+        
+        if (BATCH_HANDIN and not flush and (len(self._pending_results) < HANDIN_MAX_TASKS)
+                and ((time.time() - self._pending_since) < HANDIN_WINDOW)):
+            # wait for more tasks to complete
+            return
+        
+        results, self._pending_results = self._pending_results, []
+        
+        if BATCH_HANDIN:
+            self._handin(self._file_results_batched(results))
+        else:
+            for r in results:
+                self._handin(self._file_results_batched([r,]))
+                
+    def _file_results_batched(self, results):
+        """
+        File the results from a number of tasks, concatenating localization results which go to the same output URI.
 
+        Parameters
+        ----------
+        results : list of (queueURL, taskDescr, result, execTime) tuples
+
+        Returns
+        -------
+        handins : list of [queueURL, taskID, status, execTime] for each task
+
+        """
+        import numpy as np
+        
+        handins = []
+        to_file = collections.OrderedDict() # (URI, dtype) -> list of (handin, data)
+        
+        for queueURL, taskDescr, res, exec_time in results:
+            outputs = taskDescr.get('outputs', {})
+            handin = [queueURL, taskDescr['id'], 'success', exec_time]
+            handins.append(handin)
+            
             if isinstance(res, TaskError):
                 # failure
+                handin[2] = 'failure'
                 clusterResults.fileResults(res.log_url, res.to_string())
-                
-                s = clusterIO._getSession(queueURL)
-                r = s.post(queueURL + 'node/handin?taskID=%s&status=failure' % taskDescr['id'])
-                if not r.status_code == 200:
-                    logger.error('Returning task failed with error: %s' % r.status_code)
             elif res is None:
                 # failure
-                s = clusterIO._getSession(queueURL)
-                r = s.post(queueURL + 'node/handin?taskID=%s&status=failure' % taskDescr['id'])
-                if not r.status_code == 200:
-                    logger.error('Returning task failed with error: %s' % r.status_code)
-            
+                handin[2] = 'failure'
             elif res == True:  # isinstance(res, ModuleCollection): #recipe output
-                # res.save(outputs) #abuse outputs dictionary as context
-
-                s = clusterIO._getSession(queueURL)
-                r = s.post(queueURL + 'node/handin?taskID=%s&status=success' % taskDescr['id'])
-                if not r.status_code == 200:
-                    logger.error('Returning task failed with error: %s' % r.status_code)
-
-            else:
-                # success
+                pass
+            elif 'results' in outputs.keys():
+                # old style pickled results - these can't be concatenated
                 try:
-                    if 'results' in outputs.keys():
-                        # old style pickled results
-                        clusterResults.fileResults(outputs['results'], res)
-                    else:
-                        if len(res.results) > 0:
-                            clusterResults.fileResults(outputs['fitResults'], res.results)
-
-                        if len(res.driftResults) > 0:
-                            clusterResults.fileResults(outputs['driftResults'], res.driftResults)
+                    clusterResults.fileResults(outputs['results'], res)
                 except requests.Timeout:
                     logger.exception('Filing results failed on timeout.')
-                    s = clusterIO._getSession(queueURL)
-                    r = s.post(queueURL + 'node/handin?taskID=%s&status=failure' % taskDescr['id'])
-                    if not r.status_code == 200:
-                        logger.error('Returning task failed with error: %s' % r.status_code)
-                else:
-                    s = clusterIO._getSession(queueURL)
-                    r = s.post(queueURL + 'node/handin?taskID=%s&status=success' % taskDescr['id'])
+                    handin[2] = 'failure'
+            else:
+                for data, URI in [(res.results, outputs.get('fitResults')), (res.driftResults, outputs.get('driftResults'))]:
+                    if len(data) > 0:
+                        to_file.setdefault((URI, data.dtype), []).append((handin, data))
+        
+        for (URI, dtype), entries in to_file.items():
+            try:
+                clusterResults.fileResults(URI, np.hstack([data.ravel() for handin, data in entries]))
+            except Exception:
+                # make sure we still hand in (as failed) all the tasks in this batch, so that they can be retried
+                logger.exception('Filing results failed.')
+                for handin, data in entries:
+                    handin[2] = 'failure'
+                    
+        return handins
+    
+    def _handin(self, handins):
+        """
+        Hand in tasks to the node server(s). Tasks for a single node server are handed in with one request if batched
+        hand-in is enabled.
+
+        Parameters
+        ----------
+        handins : list of [queueURL, taskID, status, execTime]
+
+        """
+        by_queue = collections.OrderedDict()
+        for queueURL, taskID, status, exec_time in handins:
+            by_queue.setdefault(queueURL, []).append({'taskID': taskID, 'status': status, 'execTime': exec_time})
+            
+        for queueURL, h in by_queue.items():
+            s = clusterIO._getSession(queueURL)
+            if BATCH_HANDIN:
+                r = s.post(queueURL + 'node/handin', data=json.dumps(h), headers={'Content-Type': 'application/json'})
+                if not r.status_code == 200:
+                    logger.error('Returning tasks failed with error: %s' % r.status_code)
+            else:
+                for t in h:
+                    r = s.post(queueURL + 'node/handin?taskID=%s&status=%s' % (t['taskID'], t['status']))
                     if not r.status_code == 200:
                         logger.error('Returning task failed with error: %s' % r.status_code)
 
@@ -287,10 +357,20 @@ class taskWorker(object):
 
             # if our queue for computing is empty, try to get more tasks
             if self.inputQueue.empty():
+                # hand in anything we are holding back before (potentially) blocking on the node server
+                try:
+                    self._return_task_results(flush=True)
+                except:
+                    import traceback
+                    logger.exception(traceback.format_exc())
+                
                 # if we don't have any new tasks, sleep to avoid constant polling
                 if not self._get_tasks(localQueueName):
                     # no queues had tasks
                     time.sleep(0.1)
+            elif len(self._pending_results) > 0:
+                # we are waiting on the batching window - don't spin
+                time.sleep(0.01)
 
 
     def computeLoop(self):
@@ -300,24 +380,52 @@ class taskWorker(object):
 
             queueURL, taskDescr = self.inputQueue.get()
             if taskDescr['type'] == 'localization':
+                frame_range = taskDescr['taskdef'].get('frameRange', None)
+                ruleID = taskDescr['id'].split('~')[0]
+                
+                def _frame_descr(frameIndex):
+                    if frame_range is None:
+                        return taskDescr
+                    
+                    # frame-block task - results are filed and handed in per frame
+                    frameDescr = dict(taskDescr)
+                    frameDescr['id'] = '%s~%d' % (ruleID, frameIndex)
+                    return frameDescr
+                
                 try:
-                    task = remFitBuf.createFitTaskFromTaskDef(taskDescr)
-                    res = task()
-
-                    self.resultsQueue.put((queueURL, taskDescr, res))
-
+                    tasks = remFitBuf.createFitTasksFromTaskDef(taskDescr)
                 except:
                     import traceback
                     traceback.print_exc()
                     tb = traceback.format_exc()
                     logger.exception(tb)
-                    self.resultsQueue.put((queueURL, taskDescr, TaskError(taskDescr, tb)))
-                    #self.resultsQueue.put((queueURL, taskDescr, None))
+                    frames = [None,] if frame_range is None else range(*frame_range)
+                    for frameIndex in frames:
+                        frameDescr = _frame_descr(frameIndex)
+                        self.resultsQueue.put((queueURL, frameDescr, TaskError(frameDescr, tb), 0))
+                    continue
+                
+                for task in tasks:
+                    frameDescr = _frame_descr(task.index)
+                    try:
+                        t_start = time.time()
+                        res = task()
+
+                        self.resultsQueue.put((queueURL, frameDescr, res, time.time() - t_start))
+
+                    except:
+                        import traceback
+                        traceback.print_exc()
+                        tb = traceback.format_exc()
+                        logger.exception(tb)
+                        self.resultsQueue.put((queueURL, frameDescr, TaskError(frameDescr, tb), 0))
+                        #self.resultsQueue.put((queueURL, taskDescr, None))
 
             elif taskDescr['type'] == 'recipe':
                 from PYME.recipes.modules import ModuleCollection
 
                 try:
+                    t_start = time.time()
                     taskdefRef = taskDescr.get('taskdefRef', None)
                     if taskdefRef: #recipe is defined in a file - go find it
                         recipe_yaml = unifiedIO.read(taskdefRef)
@@ -363,14 +471,14 @@ class taskWorker(object):
                     #print context, context['input_dir']
                     recipe.save(context)
 
-                    self.resultsQueue.put((queueURL, taskDescr, True))
+                    self.resultsQueue.put((queueURL, taskDescr, True, time.time() - t_start))
 
                 except Exception:
                     import traceback
                     traceback.print_exc()
                     tb = traceback.format_exc()
                     logger.exception(tb)
-                    self.resultsQueue.put((queueURL, taskDescr, TaskError(taskDescr, tb)))
+                    self.resultsQueue.put((queueURL, taskDescr, TaskError(taskDescr, tb), 0))
 
         
 def on_SIGHUP(signum, frame):
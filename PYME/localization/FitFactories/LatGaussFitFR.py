@@ -26,7 +26,7 @@ from .fitCommon import fmtSlicesUsed
 from . import FFBase 
 
 from PYME.localization.cModels.gauss_app import genGauss,genGaussJac, genGaussJacW
-from PYME.Analysis._fithelpers import FitModelWeighted, FitModelWeightedJac
+from PYME.Analysis._fithelpers import FitModelWeighted, FitModelWeightedJac, FitModelWeightedBatched
 
 
 ##################
@@ -70,6 +70,47 @@ def f_J_gauss2d(p,X,Y):
 
 f_gauss2d.D = f_J_gauss2d
 
+def f_gauss2d_batch(p, X, Y):
+    """
+    Vectorised 2D Gaussian model function and jacobian for fitting many ROIs at once (see FitModelWeightedBatched).
+    
+    Parameters
+    ----------
+    p : array, shape (N, 7)
+        parameters [A, x0, y0, sigma, background, lin_x, lin_y] for each ROI
+    X : array, shape (N, nx)
+        x coordinates of the pixels in each ROI
+    Y : array, shape (N, ny)
+        y coordinates of the pixels in each ROI
+
+    Returns
+    -------
+    model : array, shape (N, nx*ny)
+    jacobian : array, shape (N, nx*ny, 7)
+    """
+    A, x0, y0, s, b, b_x, b_y = [p[:, i][:, None, None] for i in range(7)]
+    dx = X[:, :, None] - x0
+    dy = Y[:, None, :] - y0
+    dx, dy = np.broadcast_arrays(dx, dy)
+    
+    r2 = dx*dx + dy*dy
+    E = np.exp(-r2/(2*s*s))
+    AE = A*E
+    
+    model = AE + b + b_x*dx + b_y*dy
+    
+    jac = np.empty(model.shape + (7,), dtype=model.dtype)
+    jac[..., 0] = E
+    jac[..., 1] = AE*dx/(s*s) - b_x
+    jac[..., 2] = AE*dy/(s*s) - b_y
+    jac[..., 3] = AE*r2/(s*s*s)
+    jac[..., 4] = 1
+    jac[..., 5] = dx
+    jac[..., 6] = dy
+    
+    n = model.shape[0]
+    return model.reshape(n, -1), jac.reshape(n, -1, 7)
+
 #####################
 
 #define the data type we're going to return
@@ -122,6 +163,9 @@ def GaussianFitResultR(fitResults, metadata, slicesUsed=None, resultCode=-1, fit
 		
 
 class GaussianFitFactory(FFBase.FitFactory):
+    # FromPoints fits all the points in a frame at once (see remFitBuf.fitTask)
+    BATCH_FIT = True
+    
     def __init__(self, data, metadata, fitfcn=f_gauss2d, background=None, noiseSigma=None, **kwargs):
         """Create a fit factory which will operate on image data (data), potentially using voxel sizes etc contained in
         metadata. """
@@ -172,6 +216,119 @@ class GaussianFitFactory(FFBase.FitFactory):
         #package results
         return GaussianFitResultR(res, self.metadata, (xslice, yslice, zslice), resCode, fitErrors, bgm, nchi2)
 
+    def FromPoints(self, ofd, roiHalfSize=5):
+        """
+        Fit all the points in `ofd` (typically all the candidates in a frame) at once, using a vectorised
+        Levenberg-Marquardt solver rather than a separate `leastsq` call per point.
+        
+        Returns the same records as calling `FromPoint` for each point would (up to solver tolerance).
+        """
+        nPoints = len(ofd)
+        if nPoints == 0:
+            return np.empty(0, fresultdtype)
+        
+        if self.data.shape[2] > 1:
+            # the batched path does not implement the axial averaging in getROIAtPoint - fall back to single point fits
+            return np.hstack([self.FromPoint(p.x, p.y, roiHalfSize=roiHalfSize) for p in ofd])
+        
+        roiHalfSize = int(roiHalfSize)
+        roiSize = 2*roiHalfSize + 1
+        
+        vx = 1e3*self.metadata.voxelsize.x
+        vy = 1e3*self.metadata.voxelsize.y
+        
+        x = np.array([p.x for p in ofd], dtype='f8')
+        y = np.array([p.y for p in ofd], dtype='f8')
+        
+        #pixel coordinates of the ROIs (as in getROIAtPoint), which can extend past the edge of the frame
+        xp = np.round(x).astype('i')[:, None] + np.arange(-roiHalfSize, roiHalfSize + 1)[None, :]
+        yp = np.round(y).astype('i')[:, None] + np.arange(-roiHalfSize, roiHalfSize + 1)[None, :]
+        
+        x_valid = (xp >= 0) & (xp < self.data.shape[0])
+        y_valid = (yp >= 0) & (yp < self.data.shape[1])
+        valid = x_valid[:, :, None] & y_valid[:, None, :]
+        
+        xi = np.clip(xp, 0, self.data.shape[0] - 1)[:, :, None]
+        yi = np.clip(yp, 0, self.data.shape[1] - 1)[:, None, :]
+        
+        data = self.data[:, :, 0][xi, yi].astype('f8')
+        
+        if self.noiseSigma is None:
+            md = self.metadata
+            sigma = np.sqrt(md.Camera.ReadNoise**2 + (md.Camera.NoiseFactor**2)*md.Camera.ElectronsPerCount*md.Camera.TrueEMGain*(np.maximum(data, 1) + 1))/md.Camera.ElectronsPerCount
+        else:
+            sigma = np.asarray(self.noiseSigma)[:, :, 0][xi, yi]
+            
+        if not self.background is None and len(np.shape(self.background)) > 1 and not ('Analysis.subtractBackground' in self.metadata.getEntryNames() and self.metadata.Analysis.subtractBackground == False):
+            background = np.asarray(self.background)[:, :, 0][xi, yi]
+            bgm = (background*valid).sum(2).sum(1)/valid.sum(2).sum(1)
+        else:
+            background = 0
+            bgm = np.zeros(nPoints)
+        
+        dataMean = data - background
+        
+        #padding pixels get zero weight
+        weights = valid/sigma
+        
+        X = vx*(xp + self.roi_offset[0])
+        Y = vy*(yp + self.roi_offset[1])
+        
+        #estimate some start parameters...
+        A = np.where(valid, data, -np.inf).max(2).max(1) - np.where(valid, data, np.inf).min(2).min(1)
+        
+        startParameters = np.zeros((nPoints, 7))
+        startParameters[:, 0] = A
+        startParameters[:, 1] = vx*x
+        startParameters[:, 2] = vy*y
+        startParameters[:, 3] = 250/2.35
+        
+        fitBackground = self.metadata.getOrDefault('Analysis.FitBackground', True)
+        if fitBackground:
+            startParameters[:, 4] = np.where(valid, dataMean, np.inf).min(2).min(1)
+            startParameters[:, 5:] = .001
+            fitWhich = np.ones(7, dtype=bool)
+        else:
+            fitWhich = np.array([1, 1, 1, 1, 0, 0, 0], dtype=bool)
+        
+        res, cov_x, chi2, resCode = FitModelWeightedBatched(f_gauss2d_batch, startParameters,
+                                                            dataMean.reshape(nPoints, -1),
+                                                            weights.reshape(nPoints, -1), X, Y, fitWhich=fitWhich)
+        
+        nFit = int(fitWhich.sum())
+        nPixels = valid.sum(2).sum(1)
+        
+        #package results
+        results = np.zeros(nPoints, dtype=fresultdtype)
+        results['tIndex'] = self.metadata.tIndex
+        results['fitResults'].view('7f4')[:, :nFit] = res[:, fitWhich]
+        
+        fitErrors = np.zeros((nPoints, 7))
+        with np.errstate(invalid='ignore'):
+            fitErrors[:, :nFit] = np.sqrt(np.diagonal(cov_x, axis1=1, axis2=2)*(chi2/(nPixels - nFit))[:, None])
+        #flag failed error estimates in the same way as FromPoint
+        fitErrors[~np.isfinite(fitErrors).all(1)] = -5e3
+        results['fitError'].view('7f4')[:] = fitErrors
+        
+        results['resultCode'] = resCode
+        
+        #slices used, as they would have been reported by getROIAtPoint
+        xp0 = np.round(x).astype('i') - roiHalfSize
+        yp0 = np.round(y).astype('i') - roiHalfSize
+        for sl, start, size in [(results['slicesUsed']['x'], xp0, self.data.shape[0]),
+                                (results['slicesUsed']['y'], yp0, self.data.shape[1])]:
+            sl['start'] = np.maximum(start, 0)
+            sl['stop'] = np.minimum(start + roiSize, size)
+            sl['step'] = 1
+        results['slicesUsed']['z']['start'] = 0
+        results['slicesUsed']['z']['stop'] = 1
+        results['slicesUsed']['z']['step'] = 1
+        
+        results['subtractedBackground'] = bgm
+        results['nchi2'] = chi2/(nPixels - nFit)
+        
+        return results
+
     @classmethod
     def evalModel(cls, params, md, x=0, y=0, roiHalfSize=5):
         """Evaluate the model that this factory fits - given metadata and fitted parameters.
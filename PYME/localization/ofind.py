@@ -60,6 +60,40 @@ weightsHighpass = calc_gauss_weights(filtRadHighpass)
 
 #print weightsLowpass.dtype
 
+def _bbox_centroids(im, objSlices):
+    """
+    Calculate the intensity weighted centroid of im within the bounding box of each object (as returned by
+    ndimage.find_objects) and the number of pixels in each bounding box.
+    
+    NB - the centroids are NOT vectorised: this is a python loop over objects, and only the pixel counts are computed
+    with array operations. The sums are deliberately taken over each bounding box separately, at the precision of the
+    input, so that the positions are bit-for-bit identical to those of the original per-object code. Vectorised
+    alternatives (integral images, or ndimage.sum / bincount over the labels) sum at a different precision or in a
+    different order. That moves the centroids by ~1e-5 pixels, which is enough to change the pixel that __Debounce
+    looks up for some candidates, and hence which candidates are kept.
+    
+    Returns
+    -------
+    x, y, nPixels : ndarrays
+    """
+    if len(objSlices) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    
+    x0, x1, y0, y1 = np.array([(sl[0].start, sl[0].stop, sl[1].start, sl[1].stop) for sl in objSlices]).T
+    
+    X = np.arange(im.shape[0])[:, None]
+    Y = np.arange(im.shape[1])[None, :]
+    
+    x = np.zeros(len(objSlices))
+    y = np.zeros(len(objSlices))
+    for i, sl in enumerate(objSlices):
+        imO = im[sl]
+        I = imO.sum()
+        x[i] = (X[sl[0]]*imO).sum()/I
+        y[i] = (Y[:, sl[1]]*imO).sum()/I
+    
+    return x, y, (x1 - x0)*(y1 - y0)
+
 class OfindPoint:
     def __init__(self, x, y, z=None, detectionThreshold=None):
         """Creates a point object, potentially with an undefined z-value."""
@@ -185,36 +219,36 @@ class ObjectIdentifier(list):
         if len(xs) < 2:
             return xs, ys
         
+        xs = np.asarray(xs)
+        ys = np.asarray(ys)
+        
         kdt = ckdtree.cKDTree(np.array([xs,ys]).T)
-
-        xsd = []
-        ysd = []
-        visited = 0*xs
-
-        for i in xrange(len(xs)):
+        
+        # query the 5 nearest neighbours (including the point itself) of all points in one go
+        dn, neigh = kdt.query(np.array([xs, ys]).T, 5)
+        valid = dn < radius
+        n_neigh = valid.sum(1)
+        
+        # the brightest neighbour of each point (the first one, in order of distance, in the case of ties)
+        neigh_c = np.minimum(neigh, len(xs) - 1)
+        In = np.where(valid, self.filteredData[xs[neigh_c].astype('i'), ys[neigh_c].astype('i')], -np.inf)
+        brightest = neigh_c[np.arange(len(xs)), In.argmax(1)]
+        
+        # points without any neighbours can't be 'visited' by another point and are always kept. For clumps of points
+        # we keep the brightest point in the neighbourhood of each point which has not already been visited - this
+        # depends on the order in which we visit points, so is done sequentially.
+        clumped = n_neigh > 1
+        keep = np.where(clumped, -1, np.arange(len(xs)))
+        visited = np.zeros(len(xs), 'bool')
+        
+        for i in np.flatnonzero(clumped):
             if not visited[i]:
-                xi = xs[i]
-                yi = ys[i]
-                #neigh = kdt.query_ball_point([xi,yi], radius)
-            
-                dn, neigh = kdt.query(np.array([xi,yi]), 5)
-
-                neigh = neigh[dn < radius]
-
-                if len(neigh) > 1:
-                    In = self.filteredData[xs[neigh].astype('i'),ys[neigh].astype('i')]
-                    mi = In.argmax()
-    
-                    xsd.append(xs[neigh[mi]])
-                    ysd.append(ys[neigh[mi]])
-                    visited[neigh] = 1
-                        
-
-                else:
-                    xsd.append(xi)
-                    ysd.append(yi)
+                keep[i] = brightest[i]
+                visited[neigh[i, valid[i]]] = True
+        
+        keep = keep[keep >= 0]
 
-        return xsd, ysd
+        return xs[keep], ys[keep]
         
     
     def __discardClumped(self, xs, ys, radius=4):
@@ -223,28 +257,11 @@ class ObjectIdentifier(list):
         
         kdt = ckdtree.cKDTree(np.array([xs,ys]).T)
 
-        xsd = []
-        ysd = []
-
-        for i in xrange(len(xs)):
-            xi = xs[i]
-            yi = ys[i]
-            #neigh = kdt.query_ball_point([xi,yi], radius)
-        
-            dn, neigh = kdt.query(np.array([xi,yi]), 2)
-            #print dn
-
-            if (dn[1] > radius):
-                xsd.append(xi)
-                ysd.append(yi)
-                
-        #print len(xsd)
-
-        return np.array(xsd), np.array(ysd)
-
-
-
+        # keep points whose nearest neighbour (other than themselves) is further away than radius
+        dn, neigh = kdt.query(np.array([xs,ys]).T, 2)
+        isolated = dn[:, 1] > radius
 
+        return np.asarray(xs)[isolated], np.asarray(ys)[isolated]
 
     def FindObjects(self, thresholdFactor, numThresholdSteps="default", blurRadius=1.5, mask=None, splitter=None, debounceRadius=4, maskEdgeWidth=5, upperThreshFactor = 0.5, discardClumpRadius=0):
         """Finds point-like objects by subjecting the data to a band-pass filtering (as defined when 
@@ -322,10 +339,6 @@ class ObjectIdentifier(list):
                 self.lowerThreshold = self.thresholdFactor
 
         
-        X,Y = np.mgrid[0:maskedFilteredData.shape[0], 0:maskedFilteredData.shape[1]]
-        #X = X.astype('f')
-        #Y = Y.astype('f')
-
         #store x, y, and thresholds
         xs = []
         ys = []
@@ -339,19 +352,12 @@ class ObjectIdentifier(list):
             
             objSlices = ndimage.find_objects(labeledPoints)
             
-            #loop over objects
-            for i in range(nLabeled):
-                #measure position
-                #x,y = ndimage.center_of_mass(im, labeledPoints, i)
-                imO = im[objSlices[i]]
-                x = (X[objSlices[i]]*imO).sum()/imO.sum()
-                y = (Y[objSlices[i]]*imO).sum()/imO.sum()
-
-                #and add to list
-                #self.append(OfindPoint(x,y,detectionThreshold=self.lowerThreshold))
-                xs.append(x)
-                ys.append(y)
-                ts.append(self.lowerThreshold)
+            #measure positions (centroid within the bounding box of each object)
+            x, y, nPixels = _bbox_centroids(im, objSlices)
+            
+            xs.extend(x)
+            ys.extend(y)
+            ts.extend([self.lowerThreshold]*nLabeled)
         else: #do threshold scan (default)
 
             #generate threshold range - note slightly awkard specification of lowwer and upper bounds as the stop bound is excluded from arange
@@ -362,43 +368,33 @@ class ObjectIdentifier(list):
 
         
 
-            #use for quickly deterimining the number of pixels in a slice (there must be a better way)
-            corrWeightRef = np.ones(im.shape)
-            
-
-        
             for threshold in self.thresholdRange:
                 #apply threshold and label regions
                 (labeledPoints, nLabeled) = ndimage.label(im > threshold)
-
-                #initialise correction weighting mask
-                corrWeights = np.zeros(im.shape, 'f')
             
                 #get 'adress' of each object
-                objSlices = ndimage.find_objects(labeledPoints)
-
-                #loop over objects
-                for i in range(1, nLabeled):
-                    #measure position
-                    #x,y = ndimage.center_of_mass(im, labeledPoints, i)
-                    nPixels = corrWeightRef[objSlices[i]].sum()
-                    imO = im[objSlices[i]]
-                    x = (X[objSlices[i]]*imO).sum()/imO.sum()
-                    y = (Y[objSlices[i]]*imO).sum()/imO.sum()
-                    #and add to list
-                    #self.append(OfindPoint(x,y,detectionThreshold=threshold))
-                    xs.append(x)
-                    ys.append(y)
-                    ts.append(threshold)
-
+                # NB - the first object is skipped
+                objSlices = ndimage.find_objects(labeledPoints)[1:]
+                
+                if len(objSlices) > 0:
+                    #measure positions (centroid within the bounding box of each object)
+                    x, y, nPixels = _bbox_centroids(im, objSlices)
+                    
+                    xs.extend(x)
+                    ys.extend(y)
+                    ts.extend([threshold]*len(objSlices))
+    
                     #now work out weights for correction image (N.B. this is somewhat emperical)
-                    corrWeights[objSlices[i]] = 1.0/np.sqrt(nPixels)
-
-                #calculate correction matrix
-                corr = ndimage.gaussian_filter(2*self.blurRadius*np.sqrt(2*np.pi)*1.7*im*corrWeights, self.blurRadius)
-
-                #subtract from working image
-                im -= corr
+                    corrWeights = np.zeros(im.shape, 'f')
+                    for sl, w in zip(objSlices, 1.0/np.sqrt(nPixels)):
+                        corrWeights[sl] = w
+    
+                    #calculate correction matrix
+                    corr = ndimage.gaussian_filter(2*self.blurRadius*np.sqrt(2*np.pi)*1.7*im*corrWeights, self.blurRadius)
+    
+                    #subtract from working image
+                    im -= corr
+                # if nothing was found at this threshold the correction would be zero, so we can skip it
 
                 #pylab.figure()
                 #pylab.imshow(corr)
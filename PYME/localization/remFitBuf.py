@@ -249,28 +249,12 @@ class CameraInfoManager(object):
 
 cameraMaps = CameraInfoManager()
 
-def createFitTaskFromTaskDef(task):
+def _metadataFromTaskDef(task):
     """
-    Creates a fit task from a new-style json task definition
-    Parameters
-    ----------
-    task : dict
-        The parsed task definition. As the task definition will need to be parsed by the worker before we get here,
-        we expect this to take the form of a python dictionary.
-
-    Returns
-    -------
-
-    a fitTask instance
-
+    Extract the analysis metadata from a json task definition (see `createFitTaskFromTaskDef`)
     """
     from PYME.IO import MetaDataHandler
-
-    dataSourceID = task['inputs']['frames']
-    frameIndex = int(task['taskdef']['frameIndex'])
-
-    #logger.debug('Creating a task for %s - frame %d' % (dataSourceID, frameIndex))
-
+    
     md = task['taskdef']['metadata']
 
     #sort out our metadata
@@ -292,8 +276,62 @@ def createFitTaskFromTaskDef(task):
                 mdh.update(json.loads(unifiedIO.read(md)))
             else:
                 raise NotImplementedError('Loading metadata from a URI in task description is not yet supported')
+            
+    return mdh
 
-    return fitTask(dataSourceID=dataSourceID, frameIndex=frameIndex, metadata=mdh)
+def createFitTaskFromTaskDef(task):
+    """
+    Creates a fit task from a new-style json task definition
+    Parameters
+    ----------
+    task : dict
+        The parsed task definition. As the task definition will need to be parsed by the worker before we get here,
+        we expect this to take the form of a python dictionary.
+
+    Returns
+    -------
+
+    a fitTask instance
+
+    """
+    dataSourceID = task['inputs']['frames']
+    frameIndex = int(task['taskdef']['frameIndex'])
+
+    #logger.debug('Creating a task for %s - frame %d' % (dataSourceID, frameIndex))
+
+    return fitTask(dataSourceID=dataSourceID, frameIndex=frameIndex, metadata=_metadataFromTaskDef(task))
+
+def createFitTasksFromTaskDef(task):
+    """
+    Creates fit tasks for all the frames covered by a json task definition. This is either a single frame (given
+    by `taskdef.frameIndex`), or, for frame-block tasks, a contiguous range of frames given by `taskdef.frameRange`
+    (a [start, end) pair, as for python's range).
+    
+    The task definition (and metadata) is only parsed once for the whole block, and the resulting fit tasks are
+    intended to be run sequentially on the same worker so that the data and background buffers are re-used.
+    
+    Parameters
+    ----------
+    task : dict
+        The parsed task definition.
+
+    Returns
+    -------
+    
+    a list of fitTask instances, ordered by frame index
+
+    """
+    dataSourceID = task['inputs']['frames']
+    frame_range = task['taskdef'].get('frameRange', None)
+    
+    if frame_range is None:
+        frame_indices = [int(task['taskdef']['frameIndex']),]
+    else:
+        frame_indices = range(int(frame_range[0]), int(frame_range[1]))
+        
+    mdh = _metadataFromTaskDef(task)
+    
+    return [fitTask(dataSourceID=dataSourceID, frameIndex=frameIndex, metadata=mdh) for frameIndex in frame_indices]
 
 class fitTask(taskDef.Task):
     def __init__(self, dataSourceID, frameIndex, metadata, dataSourceModule=None, resultsURI=None):
@@ -409,6 +447,11 @@ class fitTask(taskDef.Task):
         #make sure we're buffering the right data stream
         bufferManager.updateBuffers(md, self.dataSourceModule, self.bufferLen)
         
+        ds = bufferManager.dBuffer.dataSource
+        if hasattr(ds, 'prefetch'):
+            # let data sources which support it fetch the frames we are going to need in parallel
+            ds.prefetch([self.index, ] + list(self.bgindices))
+        
         self.data = bufferManager.dBuffer.getSlice(self.index)
         #if logger.isEnabledFor(logging.DEBUG):
         #    logger.debug('data: min - %3.2f, max - %3.2f, mean - %3.2f' % (self.data.min(), self.data.max(), self.data.mean()))
@@ -523,6 +566,9 @@ class fitTask(taskDef.Task):
         #perform fit for each point that we detected
         if 'FromPoints' in dir(self.fitMod):
             self.res = self.fitMod.FromPoints(self.ofd)
+        elif getattr(fitFac, 'BATCH_FIT', False) and md.getOrDefault('Analysis.BatchFit', True):
+            #fit factory can fit all points in the frame at once
+            self.res = fitFac.FromPoints(self.ofd, roiHalfSize=md.getOrDefault('Analysis.ROISize', 5))
         elif 'FitResultsDType' in dir(self.fitMod): #legacy fit modules
             self.res = numpy.empty(len(self.ofd), self.fitMod.FitResultsDType)
             if 'Analysis.ROISize' in md.getEntryNames():
@@ -0,0 +1,78 @@
+"""
+Process-wide thread pools.
+
+CPU-bound work which is parallelised over threads (filtering, rendering, neighbour queries, PZF compression, etc ...)
+should go through :func:`parallel_map`, which uses a single compute pool shared across PYME, rather than creating a
+pool of its own. Separate pools per module would each be sized to the number of CPUs, and oversubscribe the machine as
+soon as two of them are busy at once (e.g. rendering a tile pyramid from compressed data). Work which spends most of
+its time waiting on IO should use its own named pool (see :func:`get_pool`) so that it doesn't tie up compute threads.
+
+The number of compute threads can be set with the ``compute-threads`` config option (defaults to the number of CPUs).
+"""
+import atexit
+import threading
+from multiprocessing import cpu_count
+
+from PYME import config
+
+COMPUTE_THREADS = int(config.get('compute-threads', cpu_count()))
+
+_pools = {}
+_poolsLock = threading.Lock()
+
+# records which pool (if any) the current thread belongs to
+_worker = threading.local()
+
+def _init_worker(name):
+    _worker.pool = name
+
+def get_pool(name='compute', n_threads=None):
+    """
+    Get a named thread pool, creating it on first use.
+
+    Parameters
+    ----------
+    name : str
+        the name of the pool. Code doing IO should use a name of its own, CPU-bound code should use the default
+        ('compute') pool - preferably via :func:`parallel_map`.
+    n_threads : int
+        the number of threads to create the pool with (defaults to COMPUTE_THREADS). Ignored if the pool already
+        exists.
+
+    Returns
+    -------
+    pool : multiprocessing.pool.ThreadPool
+    """
+    with _poolsLock:
+        pool = _pools.get(name, None)
+        if pool is None:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(COMPUTE_THREADS if n_threads is None else n_threads, _init_worker, (name,))
+            _pools[name] = pool
+
+        return pool
+
+@atexit.register
+def _close_pools():
+    # close (rather than join) so that exit isn't held up by running tasks. This also stops the pools complaining
+    # when they are garbage collected during interpreter shutdown.
+    with _poolsLock:
+        for pool in _pools.values():
+            pool.close()
+
+def in_pool(name='compute'):
+    """Is the current thread one of the threads of the named pool?"""
+    return getattr(_worker, 'pool', None) == name
+
+def parallel_map(func, iterable):
+    """
+    Equivalent to ``list(map(func, iterable))``, but run on the shared compute pool.
+
+    If called from one of the compute threads (i.e. parallel code calling other parallel code) the map is performed
+    serially on the calling thread, as waiting on the pool from inside the pool can deadlock once all the threads are
+    waiting. The map is also serial if there is only one compute thread.
+    """
+    if (COMPUTE_THREADS < 2) or in_pool('compute'):
+        return list(map(func, iterable))
+
+    return get_pool('compute').map(func, iterable)
@@ -23,11 +23,19 @@ from PYME.recipes.traits import HasTraits, Float, List, Bool, Int, CStr, Enum, F
     #   from PYME.misc.mock_traitsui import *
 
 from PYME.IO.image import ImageStack
+from PYME.recipes import result_cache
+from PYME import config
+from PYME.misc import thread_pools
 import numpy as np
+import threading
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Return the output of frame-by-frame filters as a data source which filters frames on demand, rather than filtering
+# the whole stack up front.
+LAZY_FILTERS = config.get('recipes-lazy-filters', False)
+
 all_modules = {}
 _legacy_modules = {}
 module_names = {}
@@ -80,6 +88,11 @@ class ModuleBase(HasTraits):
     """
     _invalidate_parent = True
     
+    # Whether the outputs of this module may be stored in, and retrieved from, the on-disk result cache (see
+    # PYME.recipes.result_cache). Modules whose output does not depend solely on their inputs and parameters (e.g.
+    # because they read files named by a parameter, or are stochastic) should set this to False.
+    _cache_results = True
+    
     def __init__(self, parent=None, invalidate_parent = True, **kwargs):
         self._parent = parent
         self._invalidate_parent = invalidate_parent
@@ -494,20 +507,62 @@ class ModuleCollection(HasTraits):
         self.namespace.update(kwargs)
         
         exec_order = self.resolveDependencies()
+        
+        cache = result_cache.get_cache()
+        hashes = {}
 
         for m in exec_order:
-            if isinstance(m, ModuleBase) and not m.outputs_in_namespace(self.namespace):
+            if isinstance(m, ModuleBase):
+                key = self._module_cache_key(m, hashes) if cache is not None else None
+                
+                if m.outputs_in_namespace(self.namespace) or (key is not None and cache.load(m, key, self.namespace)):
+                    continue
+                
                 try:
                     m.execute(self.namespace)
                 except:
                     logger.exception("Error in recipe module: %s" % m)
                     raise
+                
+                if key is not None:
+                    cache.store(m, key, self.namespace)
         
         self.recipe_executed.send_robust(self)
         
         if 'output' in self.namespace.keys():
             return self.namespace['output']
             
+    def _module_cache_key(self, mod, hashes):
+        """
+        Work out the result cache key for a module, and record the hashes of its outputs in `hashes` so that they can
+        be used for downstream modules. Data which is not generated by a module is hashed on its contents (see
+        result_cache.data_hash).
+        
+        Returns None if the module should not be cached.
+        """
+        inputs, outputs, params = mod.get_params()
+        
+        key = None
+        if mod._cache_results and len(outputs) > 0:
+            input_hashes = {}
+            for tn in inputs:
+                name = getattr(mod, tn)
+                if not name in hashes:
+                    if name in self.namespace:
+                        hashes[name] = result_cache.data_hash(self.namespace[name])
+                    else:
+                        # not a namespace key (e.g. a column name)
+                        hashes[name] = result_cache.data_hash(name)
+                        
+                input_hashes[tn] = hashes[name]
+            
+            key = result_cache.module_key(mod, input_hashes)
+        
+        for tn in outputs:
+            hashes[getattr(mod, tn)] = None if key is None else result_cache.output_hash(key, tn)
+            
+        return key
+        
     @classmethod
     def fromMD(cls, md):
         c = cls()
@@ -807,6 +862,54 @@ class ModuleCollection(HasTraits):
         
 
         
+def _filter_frames(inputs, func, chanNum, parallel=True):
+    """
+    Filter all the frames of one channel of a set of images, in parallel (on the shared compute pool, see
+    PYME.misc.thread_pools).
+    
+    Parameters
+    ----------
+    inputs : list
+        the input image data (e.g. `ImageStack.data`)
+    func : callable
+        called as ``func(frames, chanNum, frameNum)`` where ``frames`` is a list of the (float32) input frames, and
+        returning the filtered frame.
+    chanNum : int
+    parallel : bool
+        filter frames in parallel (func must be thread safe)
+
+    Returns
+    -------
+    filtered : ndarray
+        the filtered frames, stacked along the 3rd dimension
+
+    """
+    n_frames = inputs[0].shape[2]
+    # data sources are not necessarily safe to read from multiple threads, so we only parallelise the filtering
+    read_lock = threading.Lock()
+    
+    def _filter_frame(i):
+        with read_lock:
+            frames = [d[:, :, i, chanNum].squeeze().astype('f') for d in inputs]
+        return np.atleast_3d(func(frames, chanNum, i))
+    
+    # filter the first frame to find the output size and type, then fill in the rest directly
+    first = _filter_frame(0)
+    depth = first.shape[2]
+    out = np.empty(first.shape[:2] + (depth*n_frames,), first.dtype)
+    out[:, :, :depth] = first
+    
+    def _fill(i):
+        out[:, :, (i*depth):((i+1)*depth)] = _filter_frame(i)
+        
+    if parallel and n_frames > 2:
+        thread_pools.parallel_map(_fill, range(1, n_frames))
+    else:
+        for i in range(1, n_frames):
+            _fill(i)
+    
+    return out
+
 class Filter(ModuleBase):
     """Module with one image input and one image output"""
     inputName = Input('input')
@@ -814,14 +917,25 @@ class Filter(ModuleBase):
     
     processFramesIndividually = Bool(True)
     
+    # can applyFilter be called on multiple frames at once (from different threads)? Off by default, as filters which
+    # keep state between calls (e.g. cached deconvolution objects) would give corrupt results. Set to True on filters
+    # whose applyFilter is known to be thread safe.
+    _parallel_frames = False
+    
     def filter(self, image):
-        #from PYME.util.shmarray import shmarray
-        #import multiprocessing
-        
         if self.processFramesIndividually:
-            filt_ims = []
-            for chanNum in range(image.data.shape[3]):
-                filt_ims.append(np.concatenate([np.atleast_3d(self.applyFilter(image.data[:,:,i,chanNum].squeeze().astype('f'), chanNum, i, image)) for i in range(image.data.shape[2])], 2))
+            # NB - when filtering lazily we use a copy of this module, so that the frames don't change if our parameters do
+            mod = self.clone_traits() if LAZY_FILTERS else self
+            
+            def _apply(frames, chanNum, frameNum):
+                return mod.applyFilter(frames[0], chanNum, frameNum, image)
+            
+            if LAZY_FILTERS:
+                from PYME.IO.DataSources import FilterDataSource
+                filt_ims = FilterDataSource.DataSource([image.data], _apply)
+            else:
+                filt_ims = [_filter_frames([image.data], _apply, chanNum, self._parallel_frames)
+                            for chanNum in range(image.data.shape[3])]
         else:
             filt_ims = [np.atleast_3d(self.applyFilter(image.data[:,:,:,chanNum].squeeze().astype('f'), chanNum, 0, image)) for chanNum in range(image.data.shape[3])]
             
@@ -876,16 +990,25 @@ class ArithmaticFilter(ModuleBase):
     
     processFramesIndividually = Bool(False)
     
+    # can applyFilter be called on multiple frames at once (from different threads)? Off by default, as filters which
+    # keep state between calls (e.g. cached deconvolution objects) would give corrupt results. Set to True on filters
+    # whose applyFilter is known to be thread safe.
+    _parallel_frames = False
+    
     def filter(self, image0, image1):
         if self.processFramesIndividually:
-            filt_ims = []
-            for chanNum in range(image0.data.shape[3]):
-                out = []
-                for i in range(image0.data.shape[2]):
-                    d0 = image0.data[:,:,i,chanNum].squeeze().astype('f')
-                    d1 = image1.data[:,:,i,chanNum].squeeze().astype('f')
-                    out.append(np.atleast_3d(self.applyFilter(d0, d1, chanNum, i, image0)))
-                filt_ims.append(np.concatenate(out, 2))
+            # NB - when filtering lazily we use a copy of this module, so that the frames don't change if our parameters do
+            mod = self.clone_traits() if LAZY_FILTERS else self
+            
+            def _apply(frames, chanNum, frameNum):
+                return mod.applyFilter(frames[0], frames[1], chanNum, frameNum, image0)
+            
+            if LAZY_FILTERS:
+                from PYME.IO.DataSources import FilterDataSource
+                filt_ims = FilterDataSource.DataSource([image0.data, image1.data], _apply)
+            else:
+                filt_ims = [_filter_frames([image0.data, image1.data], _apply, chanNum, self._parallel_frames)
+                            for chanNum in range(image0.data.shape[3])]
         else:
             filt_ims = []
             for chanNum in range(image0.data.shape[3]):
@@ -976,6 +1099,8 @@ class JoinChannels(ModuleBase):
 class Add(ArithmaticFilter):
     """Add two images"""
     
+    _parallel_frames = True
+    
     def applyFilter(self, data0, data1, chanNum, i, image0):
         
         return data0 + data1
@@ -984,6 +1109,8 @@ class Add(ArithmaticFilter):
 class Subtract(ArithmaticFilter):
     """Subtract two images"""
     
+    _parallel_frames = True
+    
     def applyFilter(self, data0, data1, chanNum, i, image0):
         
         return data0 - data1
@@ -992,6 +1119,8 @@ class Subtract(ArithmaticFilter):
 class Multiply(ArithmaticFilter):
     """Multiply two images"""
     
+    _parallel_frames = True
+    
     def applyFilter(self, data0, data1, chanNum, i, image0):
         
         return data0*data1
@@ -1000,6 +1129,8 @@ class Multiply(ArithmaticFilter):
 class Divide(ArithmaticFilter):
     """Divide two images"""
     
+    _parallel_frames = True
+    
     def applyFilter(self, data0, data1, chanNum, i, image0):
         
         return data0/data1
@@ -1009,6 +1140,8 @@ class Pow(Filter):
     "Raise an image to a given power (can be fractional for sqrt)"
     power = Float(2)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, i, image0):
         return np.power(data, self.power)
         
@@ -1018,6 +1151,8 @@ class Scale(Filter):
     
     scale = Float(1)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, i, image0):
         
         return self.scale*data
@@ -1028,6 +1163,8 @@ class Normalize(Filter):
     
     #scale = Float(1)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, i, image0):
         
         return data/float(data.max())
@@ -1038,6 +1175,8 @@ class NormalizeMean(Filter):
     
     offset = Float(0)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, i, image0):
         
         data = data - self.offset
@@ -1055,6 +1194,8 @@ class Invert(Filter):
     
     #scale = Float(1)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, i, image0):
         
         return 1 - data
@@ -1069,6 +1210,8 @@ class BinaryOr(ArithmaticFilter):
     This is actually implemented as :math:`(A + B) > .5`
     """
     
+    _parallel_frames = True
+    
     def applyFilter(self, data0, data1, chanNum, i, image0):
         
         return (data0 + data1) > .5
@@ -1078,6 +1221,8 @@ class BinaryOr(ArithmaticFilter):
 class LogicalAnd(ArithmaticFilter):
     """Perform a logical AND on images"""
 
+    _parallel_frames = True
+    
     def applyFilter(self, data0, data1, chanNum, i, image0):
         return np.logical_and(data0, data1)
 
@@ -1101,6 +1246,8 @@ class IsClose(ArithmaticFilter):
     """
     abs_tolerance = Float(1e-8)
     rel_tolerance = Float(1e-5)
+    _parallel_frames = True
+    
     def applyFilter(self, data0, data1, chanNum, i, image0):
         return np.isclose(data0, data1, atol=self.abs_tolerance, rtol=self.rel_tolerance)
         
@@ -8,31 +8,170 @@ Created on Sat May  9 12:23:57 2015
 from PYME.recipes import runRecipe
 from PYME.recipes import modules
 import os
+import sys
 import glob
 from argparse import ArgumentParser
 import traceback
 
 import multiprocessing
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
 
 NUM_PROCS = multiprocessing.cpu_count()
 
-def runRec(args):
-    #print args
+#: number of times to retry a file which fails before giving up on it
+NUM_RETRIES = 1
+
+#: how many files ahead of the last completed file to read ahead into the OS file cache
+PREFETCH_DEPTH = 2
+
+# The recipe used by a worker process. This is set once when the worker starts (see _init_worker), rather than
+# pickling the recipe into every task.
+_worker_recipe = None
+
+def _init_worker(recipe):
+    global _worker_recipe
+    import matplotlib.pyplot as plt
+    
+    plt.switch_backend('SVG')
+    _worker_recipe = recipe
+
+def _run_task(task):
+    """
+    Run the worker recipe on a single set of inputs.
+    
+    Returns
+    -------
+    (index, error, elapsed) where error is None on success, or a formatted traceback on failure
+    """
+    index, in_d, out_d, cntxt = task
+    t0 = time.time()
     try:
-        import matplotlib.pyplot as plt
+        runRecipe.runRecipe(_worker_recipe, in_d, out_d, cntxt)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+        
+    return index, error, time.time() - t0
+
+
+class _Prefetcher(object):
+    """
+    Reads input files ahead of the task which is currently being processed so that they are in the OS file cache
+    by the time a worker gets to them, overlapping disk (or network filesystem) IO with computation.
     
-        old_backend = plt.get_backend()
-        plt.switch_backend('SVG')
+    Only local files are prefetched - cluster URIs are fetched by the workers themselves.
+    """
+    def __init__(self, filenames, depth, blocksize=4*1024*1024):
+        self._filenames = filenames
+        self._blocksize = blocksize
+        self._depth = depth
+        
+        self._limit = depth
+        self._cond = threading.Condition()
+        self._alive = True
+        
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def advance(self, n_done):
+        """Tell the prefetcher that n_done files have been processed so it can read further ahead"""
+        with self._cond:
+            self._limit = n_done + self._depth
+            self._cond.notify()
+            
+    def stop(self):
+        with self._cond:
+            self._alive = False
+            self._cond.notify()
+            
+    def _read(self, filename):
+        if not os.path.exists(filename):
+            return
+        
+        try:
+            with open(filename, 'rb') as f:
+                while self._alive and f.read(self._blocksize):
+                    pass
+        except (IOError, OSError):
+            pass
+    
+    def _run(self):
+        for i, fns in enumerate(self._filenames):
+            with self._cond:
+                while self._alive and i >= self._limit:
+                    self._cond.wait()
+                    
+                if not self._alive:
+                    return
+                
+            for fn in fns:
+                self._read(fn)
+
+
+class _ProgressLog(object):
+    """
+    Keeps track of (and logs) the progress and throughput of a batch run. If a filename is given, a tab separated
+    line is also appended to it for every completed task.
+    """
+    def __init__(self, n_tasks, filename=None):
+        self.n_tasks = n_tasks
+        self.n_done = 0
+        self.n_failed = 0
+        self._t_start = time.time()
+        
+        self._f = None
+        if filename is not None:
+            new_file = not os.path.exists(filename)
+            self._f = open(filename, 'a')
+            if new_file:
+                self._f.write('#time\tinputs\tstatus\tattempt\tduration [s]\tcompleted\ttotal\tthroughput [files/s]\n')
+                self._f.flush()
+        
+    def record(self, in_d, error, attempt, elapsed, final=True):
+        if final:
+            self.n_done += 1
+            if error is not None:
+                self.n_failed += 1
         
-        runRecipe.runRecipe(*args)
+        t = time.time() - self._t_start
+        throughput = self.n_done / t if t > 0 else 0
+        remaining = (self.n_tasks - self.n_done) / throughput if throughput > 0 else float('nan')
         
-        plt.switch_backend(old_backend)
-    except:
-        traceback.print_exc()
+        status = 'ok' if error is None else ('failed' if final else 'retrying')
+        
+        inputs = ', '.join(in_d.values())
+        if error is None:
+            logger.info('[%d/%d] %s done in %3.1fs (%3.2f files/s, ~%3.0fs remaining)' % (self.n_done, self.n_tasks, inputs,
+                                                                                     elapsed, throughput, remaining))
+        elif final:
+            logger.error('[%d/%d] %s failed after %3.1fs:\n%s' % (self.n_done, self.n_tasks, inputs, elapsed, error))
+        else:
+            logger.warning('[%d/%d] %s failed after %3.1fs, retrying:\n%s' % (self.n_done, self.n_tasks, inputs, elapsed, error))
+        
+        if self._f is not None:
+            self._f.write('%s\t%s\t%s\t%d\t%3.3f\t%d\t%d\t%3.4f\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), inputs, status,
+                                                                    attempt, elapsed, self.n_done, self.n_tasks,
+                                                                    throughput))
+            self._f.flush()
+            
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
     
-def bake(recipe, inputGlobs, output_dir, num_procs = NUM_PROCS):
+def bake(recipe, inputGlobs, output_dir, num_procs = NUM_PROCS, num_retries = NUM_RETRIES, prefetch = PREFETCH_DEPTH,
+         log_filename = 'bake_progress.log'):
     """Run a given recipe over using multiple proceses.
     
+    Tasks are streamed to a pool of workers (each of which is sent the recipe once, when it starts) and results are
+    processed as they complete, in whatever order they finish. A failure on one file does not affect the others - failed
+    files are re-queued up to `num_retries` times, and then reported in the return value.
+    
     Arguments:
     ----------
       recipe:       The recipe to run
@@ -41,6 +180,13 @@ def bake(recipe, inputGlobs, output_dir, num_procs = NUM_PROCS):
                     input.
       output_dir:   The directory to save the output in
       num_procs:    The number of worker processes to launch (defaults to the number of CPUs)
+      num_retries:  The number of times to retry a file which fails
+      prefetch:     How many files ahead of the current one to read into the OS file cache (0 to disable)
+      log_filename: The name of a progress log, written to the output directory as files complete. None to disable.
+      
+    Returns:
+    --------
+      failed:       A list of (inputs, traceback) tuples for the files which could not be processed
       
     """
     
@@ -63,17 +209,74 @@ def bake(recipe, inputGlobs, output_dir, num_procs = NUM_PROCS):
 
         cntxt = {'output_dir' : output_dir, 'file_stub': file_stub}
 
-        taskParams.append((recipe, in_d, out_d, cntxt))
+        taskParams.append((i, in_d, out_d, cntxt))
+        
+    if log_filename and os.path.isdir(output_dir):
+        progress = _ProgressLog(len(taskParams), os.path.join(output_dir, log_filename))
+    else:
+        progress = _ProgressLog(len(taskParams))
+    
+    prefetcher = None
+    if prefetch > 0:
+        prefetcher = _Prefetcher([list(t[1].values()) for t in taskParams], prefetch + max(num_procs, 1))
 
+    pool = None
     if num_procs == 1:
-        # map(runRec, taskParams)  # map now returns iterator, which means this never runs unless we convert to list
-        [runRec(task) for task in taskParams]  # skip the map and just make the list we need anyway
+        import matplotlib.pyplot as plt
+        old_backend = plt.get_backend()
+        
+        _init_worker(recipe)
+        run = lambda tasks: (_run_task(task) for task in tasks)
     else:
-        pool = multiprocessing.Pool(num_procs)
+        pool = multiprocessing.Pool(num_procs, initializer=_init_worker, initargs=(recipe,))
+        run = lambda tasks: pool.imap_unordered(_run_task, tasks)
     
-        pool.map(runRec, taskParams)
+    failed = {}
+    try:
+        tasks = taskParams
+        for attempt in range(num_retries + 1):
+            retry = []
+            for index, error, elapsed in run(tasks):
+                task = taskParams[index]
+                final = (error is None) or (attempt == num_retries)
+                
+                progress.record(task[1], error, attempt, elapsed, final)
+                if prefetcher is not None:
+                    prefetcher.advance(progress.n_done)
+                    
+                if error is None:
+                    failed.pop(index, None)
+                else:
+                    failed[index] = error
+                    retry.append(task)
+                    
+            if len(retry) == 0:
+                break
+                
+            # retry failed tasks in their original order
+            tasks = sorted(retry, key=lambda t: t[0])
+        
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        else:
+            plt.switch_backend(old_backend)
+            
+        if prefetcher is not None:
+            prefetcher.stop()
+            
+        progress.close()
+        
+    if len(failed) > 0:
+        logger.error('%d of %d files failed' % (len(failed), len(taskParams)))
+        
+    return [(taskParams[i][1], failed[i]) for i in sorted(failed.keys())]
 
 def bake_recipe(recipe_filename, inputGlobs, output_dir, *args, **kwargs):
+    """Load a recipe from a YAML file and run it using `bake` (see there for arguments), returning any failed files"""
     with open(recipe_filename) as f:
         s = f.read()
     
@@ -82,7 +285,7 @@ def bake_recipe(recipe_filename, inputGlobs, output_dir, *args, **kwargs):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
         
-    bake(recipe, inputGlobs, output_dir, *args, **kwargs)
+    return bake(recipe, inputGlobs, output_dir, *args, **kwargs)
     
 
 def main():
@@ -94,7 +297,7 @@ def main():
     ap = ArgumentParser()#usage = 'usage: %(prog)s [options] recipe.yaml')
     ap.add_argument('recipe')
     ap.add_argument('output_dir')
-    ap.add_argument('-n', '--num-processes', default=NUM_PROCS)
+    ap.add_argument('-n', '--num-processes', default=NUM_PROCS, type=int)
     args, remainder = ap.parse_known_args()
     
     #load the recipe
@@ -119,7 +322,11 @@ def main():
     
     inputGlobs = {k: glob.glob(getattr(args, k)) for k in recipe.inputs}
     
-    bake(recipe, inputGlobs, output_dir, num_procs)
+    failed = bake(recipe, inputGlobs, output_dir, num_procs)
+    
+    if len(failed) > 0:
+        # let scripts calling us know that not everything was processed (details are in the log)
+        sys.exit(1)
         
         
 if __name__ == '__main__':
@@ -15,6 +15,8 @@ from PYME.IO.image import ImageStack
 class svmSegment(Filter):
     classifier = File('')
     
+    _parallel_frames = False
+    
     def _loadClassifier(self):
         from PYME.Analysis import svmSegment
         if not '_cf' in dir(self):
@@ -45,6 +47,9 @@ class CNNFilter(Filter):
     model = File('')
     step_size = Int(14)
     
+    # keras models can't safely be used from multiple threads
+    _parallel_frames = False
+    
     def _load_model(self):
         from keras.models import load_model
         if not getattr(self, '_model_name', None) == self.model:
@@ -319,15 +319,11 @@ class MeanNeighbourDistances(ModuleBase):
     key = CStr('neighbourDists')
     
     def execute(self, namespace):
-        from matplotlib import delaunay
-        from PYME.LMVis import visHelpers
+        from PYME.Analysis.points import neighbours
         pos = namespace[self.inputPositions]
         
-        x, y = pos['x'], pos['y']
-        #triangulate the data
-        T = delaunay.Triangulation(x + .1*np.random.normal(size=len(x)), y + .1*np.random.normal(size=len(x)))
-        #find the average edge lengths leading away from a given point
-        res = np.array(visHelpers.calcNeighbourDists(T))
+        #find the average edge lengths leading away from a given point in a Delaunay triangulation
+        res = neighbours.mean_neighbour_distances(np.vstack([pos['x'], pos['y']]).T)
         
         res = pd.DataFrame({self.key:res})
         if 'mdh' in dir(pos):
@@ -346,27 +342,17 @@ class NearestNeighbourDistances(ModuleBase):
     key = CStr('neighbourDists')
 
     def execute(self, namespace):
-        from scipy.spatial import cKDTree
+        from PYME.Analysis.points import neighbours
         pos = namespace[self.inputChan0]
+        p1 = np.vstack([pos[k] for k in self.columns]).T
         
         if self.inputChan1 == '':
-            pos1 = pos
-            singleChan = True  # flag to not pair molecules with themselves
+            # single channel - nearest neighbour which isn't the point itself
+            d = neighbours.nearest_neighbour_distances(p1)
         else:
             pos1 = namespace[self.inputChan1]
-            singleChan = False
-
-        #create a kdtree
-        p1 = np.vstack([pos[k] for k in self.columns]).T
-        p2 = np.vstack([pos1[k] for k in self.columns]).T
-        kdt = cKDTree(p1)
-
-        if singleChan:
-            #query the two closest entries - the closest entry will be the orig point paired with itself, so ignore it
-            d, i = kdt.query(p2, 2)
-            d = d[:, 1]
-        else:
-            d, i = kdt.query(p2, 1)
+            p2 = np.vstack([pos1[k] for k in self.columns]).T
+            d = neighbours.nearest_neighbour_distances(p1, p2)
 
         res = pd.DataFrame({self.key: d})
         if 'mdh' in dir(pos):
@@ -67,6 +67,10 @@ class ShiftCorrect(ModuleBase):
     Notes
     -----
     """
+    # the shift map can be named in the input metadata rather than by a parameter, in which case changes to the file
+    # would not be picked up by the result cache
+    _cache_results = False
+    
     input_name = Input('folded')
     shift_map_path = CStr('')
     output_name = Output('registered')
@@ -239,6 +243,10 @@ class MapAstigZ(ModuleBase):
     -----
 
     """
+    # the calibration can be named in the input metadata rather than by a parameter, in which case changes to the file
+    # would not be picked up by the result cache
+    _cache_results = False
+    
     input_name = Input('merged')
 
     astigmatism_calibration_location = CStr('')
@@ -44,26 +44,8 @@ class LocalPointDensity(ModuleBase):
     n_nearest_neighbours = Int(10)
     three_d = Bool(True)
     
-    def _dn2d(self, pt, kdt, N, n):
-        """
-        Find the local density by fitting a quadratic to the distance between a point and it's neighbours
-        
-        TODO = scaling factors?
-        """
-        d, _ = kdt.query(pt, N)
-        return float(np.linalg.lstsq(np.atleast_2d(d**2).T, n, rcond=None)[0])
-
-    def _dn3d(self, pt, kdt, N, n):
-        """
-        Find the local density by fitting a cubic to the distance between a point and it's neighbours
-
-        TODO = scaling factors?
-        """
-        d, _ = kdt.query(pt, N)
-        return float(np.linalg.lstsq(np.atleast_2d(d**3).T, n, rcond=None)[0])
-    
     def execute(self, namespace):
-        from scipy.spatial import cKDTree
+        from PYME.Analysis.points import neighbours
         from PYME.IO import tabular
         
         inp = namespace[self.input]
@@ -73,21 +55,16 @@ class LocalPointDensity(ModuleBase):
         else:
             locs = namespace[self.input_sample_locations]
         
-        N = int(self.n_nearest_neighbours)
-        n_ = np.arange(N)
-        
         if self.three_d:
-            pts = np.vstack([inp['x'], inp['y'], inp['z']]).T
-            kdt = cKDTree(pts)
-        
-            q_pts = np.array([locs['x'], locs['y'], locs['z']]).T
-            d_ = np.array([self._dn3d(p, kdt, N, n_) for p in q_pts])
+            keys = ['x', 'y', 'z']
         else:
-            pts = np.vstack([inp['x'], inp['y']]).T
-            kdt = cKDTree(pts)
-
-            q_pts = np.array([locs['x'], locs['y']]).T
-            d_ = np.array([self._dn2d(p, kdt, N, n_) for p in q_pts])
+            keys = ['x', 'y']
+        
+        pts = np.vstack([inp[k] for k in keys]).T
+        q_pts = np.vstack([locs[k] for k in keys]).T
+        
+        # fit N ~ r^2 (2D) or N ~ r^3 (3D) to the distances to the nearest neighbours of each point
+        d_ = neighbours.local_density(pts, q_pts, int(self.n_nearest_neighbours), n_dim=len(keys))
             
         t = tabular.MappingFilter(locs)
         t.addColumn('dn', d_)
@@ -26,6 +26,8 @@ logger=logging.getLogger(__name__)
 class SimpleThreshold(Filter):
     threshold = Float(0.5)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         mask = data > self.threshold
         return mask
@@ -40,6 +42,8 @@ class FractionalThreshold(Filter):
     """
     fractionThreshold = Float(0.5)
 
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         N, bins = np.histogram(data, bins=5000)
         #calculate bin centres
@@ -64,6 +68,8 @@ class Threshold(Filter):
     n_histogram_bins = Int(255)
     bin_spacing = Enum(['linear', 'log', 'adaptive'])
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         from PYME.Analysis import thresholding
         
@@ -83,6 +89,8 @@ class Label(Filter):
     """
     minRegionPixels = Int(10)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         mask = data > 0.5
         labs, nlabs = ndimage.label(mask)
@@ -110,6 +118,8 @@ class SelectLabel(Filter):
     """Creates a mask corresponding to all pixels with the given label"""
     label = Int(1)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         mask = (data == self.label)
         return mask
@@ -122,6 +132,8 @@ class LocalMaxima(Filter):
     threshold = Float(.3)
     minDistance = Int(10)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         import skimage.feature
         im = data.astype('f')/data.max()
@@ -1058,6 +1070,9 @@ class Deconvolve(Filter):
     zPadding = Int(0) # padding along the z axis
     
     _psfCache = {}
+    # the cached dec objects hold per-call state, so frames must be deconvolved one at a time
+    _parallel_frames = False
+    
     _decCache = {}
 
     def default_traits_view(self):
@@ -1327,6 +1342,8 @@ class DeconvolveMotionCompensating(Deconvolve):
     
 @register_module('DistanceTransform')     
 class DistanceTransform(Filter):    
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         mask = 1.0*(data > 0.5)
         voxelsize = np.array(im.voxelsize)[:mask.ndim]
@@ -1339,6 +1356,8 @@ class BinaryDilation(Filter):
     iterations = Int(1)
     radius = Float(1)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         import skimage.morphology
         
@@ -1353,6 +1372,8 @@ class BinaryErosion(Filter):
     iterations = Int(1)
     radius = Float(1)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         import skimage.morphology
         
@@ -1366,6 +1387,8 @@ class BinaryErosion(Filter):
 class BinaryFillHoles(Filter):
     radius = Float(1)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         import skimage.morphology
         
@@ -1379,6 +1402,8 @@ class BinaryFillHoles(Filter):
 class GreyDilation(Filter):
     radius = Float(1)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         import skimage.morphology
         
@@ -1392,6 +1417,8 @@ class GreyDilation(Filter):
 class GreyErosion(Filter):
     radius = Float(1)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         import skimage.morphology
         
@@ -1405,6 +1432,8 @@ class GreyErosion(Filter):
 class WhiteTophat(Filter):
     radius = Float(1)
     
+    _parallel_frames = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         import skimage.morphology
         
@@ -0,0 +1,378 @@
+"""
+On-disk cache of recipe module outputs.
+
+Modules are keyed on a hash of their class, their parameters, and the hashes of their inputs. Inputs which come from
+other modules are hashed by the key of the module which generated them (so a key identifies the full chain of
+processing which led to a result without having to hash intermediate data) and external inputs (e.g. the image or
+localisations a recipe is run on) are hashed based on their contents, or on the file they were loaded from. This means
+that re-running a recipe after changing a downstream parameter can re-use the results of the expensive upstream
+modules, both within a session and across runs / processes.
+
+The cache is disabled by default and is controlled by the following config options:
+
+- ``recipes-result-cache`` : enable the cache (default False)
+- ``recipes-cache-dir`` : directory to store cached results in (default ``~/.PYME/recipe_cache``)
+- ``recipes-cache-size-mb`` : maximum size of the cache, after which the least recently used results are evicted
+  (default 2048)
+
+Only results which can be rebuilt without reference to the original inputs are cached - images are stored as their
+raw channel data and metadata, and tabular data as a dictionary of columns. Results which cannot be serialised are
+silently not cached.
+
+.. note::
+
+    The cache key includes the PYME version, but not the source of the module. If you are editing a module, disable
+    the cache or call :meth:`ResultCache.clear`.
+"""
+import os
+import hashlib
+import json
+import threading
+import logging
+
+import numpy as np
+import six
+from six.moves import cPickle as pickle
+
+from PYME import config
+from PYME import version
+
+logger = logging.getLogger(__name__)
+
+CACHE_ENABLED = config.get('recipes-result-cache', False)
+CACHE_DIR = config.get('recipes-cache-dir', os.path.join(config.user_config_dir, 'recipe_cache'))
+CACHE_SIZE_MB = float(config.get('recipes-cache-size-mb', 2048))
+
+
+def _sha(*parts):
+    h = hashlib.sha1()
+    for p in parts:
+        if not isinstance(p, (bytes, memoryview)):
+            p = str(p).encode('utf8')
+        h.update(p)
+        h.update(b'\0')
+
+    return h.hexdigest()
+
+def _array_hash(a):
+    a = np.ascontiguousarray(a)
+    if a.dtype == 'O':
+        return None
+
+    return _sha(a.dtype.str, a.shape, memoryview(a.reshape(-1).view('u1')))
+
+def _md_hash(mdh):
+    """Hash of a metadata handler (or None), or None if the metadata can't be serialised"""
+    try:
+        return _sha(json.dumps(_md_dict(mdh), sort_keys=True, default=repr))
+    except Exception:
+        return None
+
+def data_hash(value):
+    """
+    Hash an (external) value in the recipe namespace, returning None if we don't know how to hash it reliably.
+
+    Images which were loaded from disk are hashed on the filename, size, and modification time of the file they
+    were loaded from, anything else which is array-like is hashed on its content. The metadata of images and tabular
+    data is also included, as modules may depend on it.
+    """
+    from PYME.IO.image import ImageStack
+    from PYME.IO import tabular
+
+    if isinstance(value, (ImageStack, tabular.TabularBase)):
+        md_hash = _md_hash(getattr(value, 'mdh', None))
+        if md_hash is None:
+            return None
+
+    if isinstance(value, ImageStack):
+        fn = value.filename
+        if fn and os.path.exists(fn):
+            st = os.stat(fn)
+            return _sha('file', os.path.abspath(fn), st.st_size, st.st_mtime, md_hash)
+
+        try:
+            chan_hashes = [_array_hash(np.asarray(value.data[:, :, :, c])) for c in range(value.data.shape[3])]
+        except Exception:
+            return None
+
+        if None in chan_hashes:
+            return None
+
+        return _sha('image', md_hash, *chan_hashes)
+
+    elif isinstance(value, tabular.TabularBase):
+        hashes = []
+        for k in sorted(value.keys()):
+            h = _array_hash(value[k])
+            if h is None:
+                return None
+            hashes.extend([k, h])
+
+        return _sha('tabular', md_hash, *hashes)
+
+    elif isinstance(value, np.ndarray):
+        return _array_hash(value)
+
+    elif isinstance(value, (six.string_types, int, float, bool)) or value is None:
+        return _sha('scalar', repr(value))
+
+    return None
+
+
+def _param_values(mod):
+    inputs, outputs, params = mod.get_params()
+    values = {}
+    for p in params:
+        v = getattr(mod, p)
+        if isinstance(v, six.string_types) and v and os.path.isfile(v):
+            # parameters which refer to files (e.g. classifiers) should invalidate the cache when the file changes
+            st = os.stat(v)
+            v = (v, st.st_size, st.st_mtime)
+        values[p] = v
+
+    return values
+
+def module_key(mod, input_hashes):
+    """
+    Generate a cache key for a module.
+
+    Parameters
+    ----------
+    mod : ModuleBase instance
+    input_hashes : dict
+        a mapping of the module's input traits (e.g. 'inputName') to the hash of the value they refer to in the namespace
+
+    Returns
+    -------
+    a hex digest, or None if any of the inputs could not be hashed (in which case the module should not be cached)
+    """
+    if None in input_hashes.values():
+        return None
+
+    try:
+        params = json.dumps(_param_values(mod), sort_keys=True, default=repr)
+    except (TypeError, ValueError):
+        return None
+
+    cls = mod.__class__
+    return _sha(version.version, cls.__module__, cls.__name__, params,
+                json.dumps(input_hashes, sort_keys=True))
+
+def output_hash(key, output_trait):
+    """Hash for an output generated by a module - depends only on the module key and which output it is"""
+    return _sha(key, output_trait)
+
+
+def _md_dict(mdh):
+    if mdh is None:
+        return None
+
+    return {k: mdh[k] for k in mdh.getEntryNames()}
+
+def _pack(value):
+    from PYME.IO.image import ImageStack
+    from PYME.IO import tabular
+
+    if isinstance(value, ImageStack):
+        return ('image', [np.asarray(value.data[:, :, :, c]) for c in range(value.data.shape[3])], _md_dict(value.mdh))
+    elif isinstance(value, tabular.TabularBase):
+        return ('tabular', {k: np.asarray(value[k]) for k in value.keys()}, _md_dict(getattr(value, 'mdh', None)))
+    else:
+        return ('object', value, None)
+
+def _unpack(packed):
+    from PYME.IO.image import ImageStack
+    from PYME.IO import tabular, MetaDataHandler
+
+    kind, value, mdh = packed
+
+    if mdh is not None:
+        md = MetaDataHandler.NestedClassMDHandler()
+        for k, v in mdh.items():
+            md[k] = v
+        mdh = md
+
+    if kind == 'image':
+        return ImageStack(value, mdh=mdh, haveGUI=False)
+    elif kind == 'tabular':
+        ds = tabular.DictSource(value)
+        if mdh is not None:
+            ds.mdh = mdh
+        return ds
+    else:
+        return value
+
+
+class ResultCache(object):
+    def __init__(self, cache_dir=CACHE_DIR, max_size_mb=CACHE_SIZE_MB):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb*1024*1024)
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        # running total of the size of the cache, so we don't need to list the cache directory after every store.
+        # Initialised on first use, and re-synchronised with the disk (which other processes might also be writing
+        # to) whenever we exceed the maximum size.
+        self._size = None
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.pkl')
+
+    def load(self, mod, key, namespace):
+        """
+        Load cached outputs for a module into the namespace.
+
+        Returns
+        -------
+        True if the module outputs were found in the cache, False otherwise.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                outputs = pickle.load(f)
+
+            values = {getattr(mod, ot): _unpack(v) for ot, v in outputs.items()}
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return False
+        except Exception:
+            logger.exception('Error loading cached result for %s, ignoring cache' % mod)
+            with self._lock:
+                self.misses += 1
+            return False
+
+        try:
+            #mark as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        namespace.update(values)
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, mod, key, namespace):
+        """
+        Save the outputs of a module to the cache. Failures (e.g. outputs which can't be pickled) are logged and ignored.
+        """
+        inputs, outputs, params = mod.get_params()
+
+        try:
+            data = pickle.dumps({ot: _pack(namespace[getattr(mod, ot)]) for ot in outputs}, protocol=2)
+        except Exception:
+            logger.debug('Could not serialise outputs of %s, not caching' % mod)
+            return
+
+        if len(data) > self.max_size:
+            return
+
+        path = self._path(key)
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            #write to a temporary file and rename so that concurrent readers never see a partial result
+            tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            if os.path.exists(path):
+                #another process got there first
+                os.remove(tmp)
+            else:
+                os.rename(tmp, path)
+        except (IOError, OSError):
+            logger.exception('Error writing to recipe result cache')
+            return
+
+        with self._lock:
+            self.stores += 1
+            if self._size is not None:
+                self._size += len(data)
+
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        if not os.path.exists(self.cache_dir):
+            return entries
+
+        for d in os.listdir(self.cache_dir):
+            dp = os.path.join(self.cache_dir, d)
+            if not os.path.isdir(dp):
+                continue
+            for fn in os.listdir(dp):
+                if fn.endswith('.pkl'):
+                    fp = os.path.join(dp, fn)
+                    try:
+                        st = os.stat(fp)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, fp))
+
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until the cache is below its maximum size"""
+        with self._lock:
+            size = self._size
+            
+        if (size is not None) and (size <= self.max_size):
+            return
+        
+        entries = self._entries()
+        total = sum([e[1] for e in entries])
+
+        if total <= self.max_size:
+            with self._lock:
+                self._size = total
+            return
+
+        for mtime, size, fp in sorted(entries):
+            try:
+                os.remove(fp)
+            except OSError:
+                continue
+
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+            if total <= self.max_size:
+                break
+                
+        with self._lock:
+            self._size = total
+
+    def clear(self):
+        for mtime, size, fp in self._entries():
+            try:
+                os.remove(fp)
+            except OSError:
+                pass
+            
+        with self._lock:
+            self._size = None
+
+    def stats(self):
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores, 'evictions': self.evictions,
+                'entries': len(entries), 'size': sum([e[1] for e in entries])}
+
+
+_cache = None
+def get_cache():
+    """Return the shared result cache, or None if caching is disabled"""
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+
+    if _cache is None:
+        _cache = ResultCache()
+
+    return _cache
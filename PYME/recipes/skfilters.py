@@ -20,6 +20,8 @@ class SKFilter(Filter):
         #def __init__(self, **kwargs):
         #    pass
         
+        _parallel_frames = True
+        
         def applyFilter(self, data, chanNum, frNum, im):
             ret =  getattr(skf, self._filtName)(data, **self.kwargs())
             if 'threshold' in self._filtName and np.isscalar(ret):
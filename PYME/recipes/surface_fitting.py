@@ -48,6 +48,9 @@ class FitSurfaceWithPatches(ModuleBase):
         viewing.
 
     """
+    # the fits use random starting parameters, so the output is not a pure function of the inputs and parameters
+    _cache_results = False
+    
     input = Input('localizations')
 
     fit_influence_radius = Float(100, desc=('The region around each localization to include in the surface fit [nm]. ' 
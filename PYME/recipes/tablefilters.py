@@ -231,6 +231,9 @@ class SelectTableColumns(ModuleBase):
 @register_module('RandomSubset')
 class RandomSubset(ModuleBase):
     """Select a random subset of rows from a table"""
+    # the subset changes every time the module is run, so don't re-use results from the result cache
+    _cache_results = False
+    
     input = Input('input')
     output = Output('output')
     numToSelect = Int(100)
@@ -77,12 +77,8 @@ class TrackFeatures(ModuleBase):
             L = self._tracker.calcLinkages(i,i-1)
             self._tracker.updateTrack(i, L)
             
-        clumpSizes = np.zeros_like(self._tracker.clumpIndex)
-        
-        for i in set(self._tracker.clumpIndex):
-            ind = (self._tracker.clumpIndex == i)
-            
-            clumpSizes[ind] = ind.sum()
+        _, clumpInv, clumpCounts = np.unique(self._tracker.clumpIndex, return_inverse=True, return_counts=True)
+        clumpSizes = clumpCounts[clumpInv.ravel()].astype(self._tracker.clumpIndex.dtype)
             
         trackVelocities = trackUtils.calcTrackVelocity(objects['x'], objects['y'], self._tracker.clumpIndex, objects['t'])
         
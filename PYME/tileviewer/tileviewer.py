@@ -5,11 +5,14 @@ import numpy as np
 import cherrypy
 from io import BytesIO
 import os
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import threading
+import hashlib
 
 Location = namedtuple('Location', 'x, y')
 
 from PYME.IO import MetaDataHandler
+from PYME import config
 import logging
 logger = logging.getLogger(__name__)
 
@@ -19,6 +22,85 @@ logger = logging.getLogger(__name__)
 from PIL import Image
 import time
 
+# size of the cache of encoded tiles
+TILE_CACHE_SIZE_MB = float(config.get('tileviewer-cache-size-mb', 256))
+# zlib compression level for PNG tiles (0-9). Low levels are much faster to encode, at the expense of slightly larger
+# tiles.
+PNG_COMPRESS_LEVEL = int(config.get('tileviewer-png-compress-level', 1))
+# number of the lowest resolution pyramid levels to render into the tile cache when a tile source is opened
+PRERENDER_LEVELS = int(config.get('tileviewer-prerender-levels', 3))
+
+EncodedTile = namedtuple('EncodedTile', 'version, data, etag, last_modified')
+
+class EncodedTileCache(object):
+    """
+    Thread-safe LRU cache of encoded tiles, limited by the total size of the encoded data.
+    """
+    def __init__(self, max_size_mb=TILE_CACHE_SIZE_MB):
+        self._max_size = int(max_size_mb * 1024 * 1024)
+        self._size = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        
+    def get(self, key, version):
+        """Return the cached tile for key if it matches version, otherwise None"""
+        with self._lock:
+            tile = self._cache.get(key, None)
+            if tile is None or tile.version != version:
+                self.misses += 1
+                return None
+            
+            #move to most recently used
+            self._cache[key] = self._cache.pop(key)
+            self.hits += 1
+            return tile
+        
+    def put(self, key, tile):
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self._size -= len(old.data)
+            
+            self._cache[key] = tile
+            self._size += len(tile.data)
+            
+            while self._size > self._max_size and len(self._cache) > 1:
+                k, t = self._cache.popitem(last=False)
+                self._size -= len(t.data)
+                
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._size = 0
+
+
+def _scale_tile(im, scaling='sqrt', vmin=0, vmax=255):
+    """Convert a (floating point) tile to uint8 for display"""
+    if scaling == 'sqrt':
+        return np.sqrt(im).astype('uint8')
+    elif scaling == 'linear':
+        return np.clip((255 * (im - float(vmin))) / (float(vmax) - float(vmin)), 0, 255).astype('uint8')
+    else:
+        raise ValueError('Unknown scaling: %s' % scaling)
+
+def _encode_tile(im, fmt='png'):
+    """Encode a uint8 tile for serving. Returns encoded data and content type"""
+    if fmt == 'png':
+        out = BytesIO()
+        Image.fromarray(im.T).save(out, 'PNG', compress_level=PNG_COMPRESS_LEVEL)
+        s = out.getvalue()
+        out.close()
+        return s, 'image/png'
+    elif fmt == 'raw':
+        # transposed to match the png orientation, row major, 1 byte per pixel
+        return np.ascontiguousarray(im.T).tobytes(), 'application/octet-stream'
+    else:
+        raise ValueError('Unknown format: %s' % fmt)
+    
+
 env = jinja2.Environment(
     loader=jinja2.PackageLoader('PYME.tileviewer', 'templates'),
     autoescape=jinja2.select_autoescape(['html', 'xml'])
@@ -26,7 +108,10 @@ env = jinja2.Environment(
 
 
 class TileServer(object):
-    def __init__(self, tile_dir, tile_size=256):
+    def __init__(self, tile_dir, tile_size=256, prerender_levels=PRERENDER_LEVELS):
+        self._tile_cache = EncodedTileCache()
+        self._prerender_levels = prerender_levels
+        
         self._set_tile_source(tile_dir)
         self.roi_locations = []
         
@@ -35,6 +120,62 @@ class TileServer(object):
         self.mdh = MetaDataHandler.load_json(os.path.join(tile_dir, 'metadata.json'))
         self._pyramid = tile_pyramid.ImagePyramid(tile_dir, pyramid_tile_size=self.mdh['Pyramid.TileSize'])
         
+        self._tile_cache.clear()
+        if self._prerender_levels > 0:
+            t = threading.Thread(target=self.prerender, args=(self._pyramid, self._prerender_levels))
+            t.daemon = True
+            t.start()
+        
+    def prerender(self, pyramid, n_levels, scaling='sqrt', fmt='png'):
+        """
+        Render the tiles from the n_levels lowest resolution levels of the pyramid (which are requested whenever someone
+        looks at the whole dataset) into the tile cache.
+        """
+        top = self.mdh['Pyramid.Depth'] + 1
+        for layer in range(top, max(top - n_levels, -1), -1):
+            for x, y in pyramid.get_layer_tile_coords(layer):
+                if not pyramid is self._pyramid:
+                    # tile source has changed
+                    return
+                
+                try:
+                    self._get_encoded_tile(layer, x, y, scaling, 0, 255, fmt)
+                except Exception:
+                    logger.exception('Error pre-rendering tile (%d, %d, %d)' % (layer, x, y))
+                    
+        logger.debug('Pre-rendered %d pyramid levels' % n_levels)
+        
+    def _get_encoded_tile(self, layer, x, y, scaling, vmin, vmax, fmt):
+        """
+        Get an encoded tile, from the cache if it is up to date, otherwise by reading from the pyramid.
+        
+        Returns an EncodedTile, or None if the tile does not exist.
+        """
+        pyramid = self._pyramid
+        version = pyramid.get_tile_version(layer, x, y)
+        if version is None:
+            return None
+        
+        if scaling == 'linear':
+            key = (layer, x, y, scaling, float(vmin), float(vmax), fmt)
+        else:
+            key = (layer, x, y, scaling, fmt)
+            
+        tile = self._tile_cache.get(key, version)
+        if tile is not None:
+            return tile
+        
+        im = pyramid.read_tile(layer, x, y)
+        if im is None:
+            return None
+        
+        data, content_type = _encode_tile(_scale_tile(im, scaling, vmin, vmax), fmt)
+        etag = '"%s"' % hashlib.md5(repr((self.tile_dir, key, version)).encode()).hexdigest()
+        tile = EncodedTile(version, data, etag, version[0])
+        
+        self._tile_cache.put(key, tile)
+        return tile
+        
     @cherrypy.expose
     def set_tile_source(self, tile_dir):
         self._set_tile_source(tile_dir)
@@ -132,21 +273,47 @@ class TileServer(object):
         return self.set_roi_locations(os.path.join(output_dir, 'roi_locations.hdf'))
 
     @cherrypy.expose
-    def get_tile(self, layer, x, y, vmin=0, vmax=255):
-        cherrypy.response.headers["Content-Type"] = "image/png"
+    def get_tile(self, layer, x, y, vmin=0, vmax=255, scaling='sqrt', fmt='png'):
+        """
+        Get an encoded tile.
         
-        im = self._pyramid.get_tile(int(layer), int(x), int(y))
+        Tiles are cached after encoding, and ETag and Last-Modified headers are sent so that clients only need to
+        re-fetch tiles which have changed.
         
-        #scale data
-        #im = np.clip((255*(im - float(vmin)))/(float(vmax)-float(vmin)), 0, 255).astype('uint8')
+        Parameters
+        ----------
+        layer, x, y : int
+            the tile position in the pyramid
+        vmin, vmax : float
+            display range, used with `scaling='linear'`
+        scaling : str
+            'sqrt' (the default) or 'linear'
+        fmt : str
+            'png', or 'raw' for the unencoded uint8 tile data
+        """
+        from cherrypy.lib import cptools, httputil
         
-        im = np.sqrt(im).astype('uint8')
-
-        out = BytesIO()
-        Image.fromarray(im.T).save(out, 'PNG')
-        s = out.getvalue()
-        out.close()
-        return s
+        if not scaling in ['sqrt', 'linear'] or not fmt in ['png', 'raw']:
+            raise cherrypy.HTTPError(400, 'Unknown scaling or format')
+        
+        tile = self._get_encoded_tile(int(layer), int(x), int(y), scaling, vmin, vmax, fmt)
+        if tile is None:
+            raise cherrypy.NotFound()
+        
+        cherrypy.response.headers['Content-Type'] = 'image/png' if fmt == 'png' else 'application/octet-stream'
+        cherrypy.response.headers['ETag'] = tile.etag
+        cherrypy.response.headers['Last-Modified'] = httputil.HTTPDate(tile.last_modified)
+        # tiles can change during live tiling, so make browsers check (cheaply, using the ETag) before re-using them
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        
+        # respond with 304 Not Modified if the client already has this version of the tile. The ETag is the stronger
+        # validator (Last-Modified only has 1s resolution), so only fall back on the modification time if the client
+        # didn't send an ETag.
+        cptools.validate_etags()
+        if not cherrypy.request.headers.get('If-None-Match'):
+            cptools.validate_since()
+        
+        return tile.data
     
     @cherrypy.expose
     def index(self):
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+N_FLUORS = 20000
+N_FRAMES = 20
+N_SUBSTEPS = 10
+LASER_POWERS = np.array([1., 10.])
+EXP_TIME = .1
+
+
+def _make_fluors(pPA, pOnDark, pDarkOn, pOnBleach):
+    from PYME.Acquire.Hardware.Simulator import fluor
+
+    M = fluor.createSimpleTransitionMatrix(pPA=pPA, pOnDark=pOnDark, pDarkOn=pDarkOn, pOnBleach=pOnBleach)
+    x = np.zeros(N_FLUORS)
+    return fluor.fluors(x, x, x, M, [1., 1.], initialState=fluor.states.caged)
+
+
+def _occupancies(fl):
+    from PYME.Acquire.Hardware.Simulator import fluor
+    return np.bincount(fl.fl['state'], minlength=fluor.states.n)/float(N_FLUORS)
+
+
+@pytest.mark.parametrize('rates', [
+    # activation and blinking (per-sub-step probabilities of a few percent)
+    dict(pPA=[0, 2., 0], pOnDark=[0, 0, .5], pDarkOn=[5., 0, 0], pOnBleach=[0, 0, 0]),
+    # activation, blinking and bleaching, with per-sub-step transition probabilities of up to 30%
+    dict(pPA=[0, 10., 0], pOnDark=[0, 0, 3.], pDarkOn=[20., 0, 0], pOnBleach=[0, 0, .02]),
+])
+def test_illuminate_substeps(rates):
+    """illuminate_substeps should be statistically equivalent to summing N_SUBSTEPS calls to illuminate"""
+    np.random.seed(42)
+
+    ref = _make_fluors(**rates)
+    fast = _make_fluors(**rates)
+
+    for frame in range(N_FRAMES):
+        A_ref = np.zeros(N_FLUORS, 'f')
+        for i in range(N_SUBSTEPS):
+            A_ref += ref.illuminate(LASER_POWERS, EXP_TIME/N_SUBSTEPS)
+
+        A_fast = fast.illuminate_substeps(LASER_POWERS, EXP_TIME, N_SUBSTEPS)
+
+        # mean photons per fluorophore, to within 5 standard errors
+        tol = 5*np.sqrt((A_ref.var() + A_fast.var())/N_FLUORS) + 1e-6
+        assert abs(A_ref.mean() - A_fast.mean()) < tol
+
+        # state occupancies, to within 5 standard errors
+        p_ref, p_fast = _occupancies(ref), _occupancies(fast)
+        tol = 5*np.sqrt((p_ref*(1 - p_ref) + p_fast*(1 - p_fast))/N_FLUORS) + 1e-6
+        assert np.all(np.abs(p_ref - p_fast) < tol)
+
+    # make sure we actually tested something - fluorophores were activated and are switching
+    assert p_ref[1] > .05 and p_ref[2] > .05
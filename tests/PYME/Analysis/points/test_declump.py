@@ -0,0 +1,41 @@
+import numpy as np
+from PYME.Analysis.points.DeClump import pyDeClump
+
+
+def test_find_clumps_long_chain():
+    # a single emitter which is on for longer than the recursion limit
+    n = 5000
+    t = np.arange(n).astype('int32')
+    assigned = pyDeClump.findClumps(t, np.zeros(n), np.zeros(n), np.ones(n), 2)
+
+    assert np.all(assigned == 1)
+
+def test_find_clumps():
+    # two emitters, one of which has a gap of 2 frames, and a point which is too far away to link
+    t = np.array([0, 0, 1, 3, 4, 4], 'int32')
+    x = np.array([0, 100, 1, 0, 101, 200], 'f')
+    y = np.zeros(6, 'f')
+    delta_x = np.ones(6, 'f')
+
+    np.testing.assert_array_equal(pyDeClump.findClumps(t, x, y, delta_x, 3), [1, 2, 1, 1, 3, 4])
+    np.testing.assert_array_equal(pyDeClump.findClumps(t, x, y, delta_x, 5), [1, 2, 1, 1, 2, 3])
+
+def test_coalesce_clumps():
+    dt = [('tIndex', '<i4'), ('fitResults', [('A', '<f4'), ('x0', '<f4')]), ('fitError', [('A', '<f4'), ('x0', '<f4')]),
+          ('resultCode', '<i4')]
+    fr = np.zeros(4, dt)
+    fr['tIndex'] = [0, 1, 2, 5]
+    fr['fitResults']['x0'] = [0, 2, 10, 20]
+    fr['fitResults']['A'] = 1
+    fr['fitError']['x0'] = [1, 1, 1, 2]
+    fr['fitError']['A'] = 1
+
+    res = pyDeClump.coalesceClumps(fr, np.array([1, 1, 2, 1]), nphotons=np.array([1., 2, 3, 3]))
+
+    np.testing.assert_array_equal(res['nFrames'], [3, 1])
+    np.testing.assert_array_equal(res['tIndex'], [0, 2])
+    np.testing.assert_array_equal(res['burstDuration'], [6, 1])
+    np.testing.assert_array_almost_equal(res['fitResults']['x0'], [(0 + 2 + 20/4.)/2.25, 10])
+    np.testing.assert_array_almost_equal(res['fitError']['x0'], [np.sqrt(1/2.25), 1])
+    np.testing.assert_array_almost_equal(res['nPhotons'], [6, 3])
+    np.testing.assert_array_almost_equal(res['photonRate'], [2, 3])
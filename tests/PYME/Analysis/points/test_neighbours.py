@@ -0,0 +1,43 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from PYME.Analysis.points import neighbours
+
+
+def test_query_neighbours_chunked():
+    pts = np.random.rand(1000, 3)
+    kdt = cKDTree(pts)
+
+    chunk_size = neighbours.QUERY_CHUNK_SIZE
+    try:
+        neighbours.QUERY_CHUNK_SIZE = 97
+        d, i = neighbours.query_neighbours(kdt, pts, 5)
+    finally:
+        neighbours.QUERY_CHUNK_SIZE = chunk_size
+
+    d0, i0 = kdt.query(pts, 5)
+    np.testing.assert_array_almost_equal(d, d0)
+
+def test_local_density_matches_lstsq():
+    pts = np.random.rand(200, 3)
+    N = 10
+    n = np.arange(N)
+
+    for n_dim in [2, 3]:
+        p = pts[:, :n_dim]
+        kdt = cKDTree(p)
+        ref = [float(np.linalg.lstsq(np.atleast_2d(kdt.query(pt, N)[0]**n_dim).T, n, rcond=None)[0][0]) for pt in p]
+
+        np.testing.assert_array_almost_equal(neighbours.local_density(p, n_neighbours=N), ref)
+
+def test_nearest_neighbour_distances():
+    pts = np.array([[0, 0], [1, 0], [3, 0]], dtype='f')
+    np.testing.assert_array_almost_equal(neighbours.nearest_neighbour_distances(pts), [1, 1, 2])
+    np.testing.assert_array_almost_equal(neighbours.nearest_neighbour_distances(pts, [[2.5, 0]]), [.5])
+
+def test_mean_neighbour_distances():
+    # square with a point in the middle - the corners connect to 2 sides and the centre
+    pts = np.array([[0, 0], [0, 2], [2, 0], [2, 2], [1, 1]], dtype='f')
+    d = neighbours.mean_neighbour_distances(pts)
+
+    np.testing.assert_almost_equal(d[4], np.sqrt(2), 4)
+    np.testing.assert_array_almost_equal(d[:4], (4 + np.sqrt(2))/3, 4)
@@ -0,0 +1,134 @@
+import os
+import numpy as np
+
+
+def test_tile_cache(tmpdir):
+    from PYME.Analysis.tile_pyramid import TileCache
+    
+    cache = TileCache(max_size=4)
+    fns = [os.path.join(str(tmpdir), 'sub', '%d.npy' % i) for i in range(10)]
+    
+    for i, fn in enumerate(fns):
+        cache.save(fn, np.ones(4)*i)
+        # keep the first tile hot
+        cache.load(fns[0])
+        
+    assert fns[0] in cache._cache
+    assert len(cache._cache) == 4
+    
+    # evicted tiles are still visible (either pending or written)
+    for i, fn in enumerate(fns):
+        assert cache.exists(fn)
+        assert np.all(cache.load(fn) == i)
+    
+    cache.flush()
+    for i, fn in enumerate(fns):
+        assert np.all(np.load(fn) == i)
+        
+    cache.remove(fns[3])
+    assert not cache.exists(fns[3])
+    assert not os.path.exists(fns[3])
+    
+
+def test_image_pyramid(tmpdir):
+    from PYME.Analysis.tile_pyramid import ImagePyramid, NumpyTileIO
+    
+    P = ImagePyramid(str(tmpdir), 64)
+    P._imgs, P._acc, P._occ = [NumpyTileIO(str(tmpdir), suff) for suff in ['img', 'acc', 'occ']]
+    
+    frame = np.random.rand(100, 100)
+    weights = np.ones_like(frame)
+    P.add_base_tile(10, 20, frame, weights)
+    P.update_pyramid()
+    
+    assert np.allclose(P.get_tile(0, 0, 0)[10:, 20:], frame[:54, :44])
+    
+    # adding a new frame must invalidate the pyramid tiles which overlap it
+    P.add_base_tile(10, 20, frame, weights)
+    assert not P._imgs.tile_exists(0, 0, 0)
+    assert not P._imgs.tile_exists(1, 0, 0)
+    
+    P.update_pyramid()
+    assert np.allclose(P.get_tile(0, 0, 0)[10:, 20:], frame[:54, :44])
+    
+    
+def test_tiles_written_by_another_pyramid(tmpdir):
+    from PYME.Analysis.tile_pyramid import ImagePyramid
+    
+    frame = np.random.rand(50, 50)
+    weights = np.ones_like(frame)
+    
+    P0 = ImagePyramid(str(tmpdir), 32)
+    P1 = ImagePyramid(str(tmpdir), 32)
+    
+    P0.add_base_tile(0, 0, frame, weights)
+    P0.update_pyramid()
+    P0._imgs.flush()
+    # reading a layer populates P1's record of which tiles exist
+    assert sorted(P1.get_layer_tile_coords(0)) == sorted(P0.get_layer_tile_coords(0))
+    assert P1.get_tile(0, 2, 2) is None
+    
+    # tiles written after P1 read the layer must still be found
+    P0.add_base_tile(64, 64, frame, weights)
+    P0.update_pyramid()
+    P0._imgs.flush()
+    assert np.allclose(P1.get_tile(0, 2, 2), P0.get_tile(0, 2, 2))
+
+
+def test_incremental_update(tmpdir):
+    from PYME.Analysis.tile_pyramid import ImagePyramid
+    
+    frames = [(x, y, np.random.rand(50, 50)) for x, y in [(0, 0)] + np.random.randint(0, 200, (19, 2)).tolist()]
+    weights = np.ones((50, 50))
+    
+    P0 = ImagePyramid(str(tmpdir.mkdir('once')), 32)
+    P1 = ImagePyramid(str(tmpdir.mkdir('incremental')), 32)
+    
+    for i, (x, y, f) in enumerate(frames):
+        P0.add_base_tile(x, y, f, weights)
+        P1.add_base_tile(x, y, f, weights)
+        if i % 5 == 4:
+            P1.update_pyramid()
+            
+    P0.update_pyramid()
+    P1.update_pyramid()
+    
+    assert P0.depth == P1.depth
+    for level in range(P0.depth + 2):
+        coords = sorted(P0.get_layer_tile_coords(level))
+        assert coords == sorted(P1.get_layer_tile_coords(level))
+        for xc, yc in coords:
+            assert np.allclose(P0.get_tile(level, xc, yc), P1.get_tile(level, xc, yc), atol=1e-5)
+        
+    # layers above the base are 2x2 block means of the layer below
+    t1 = P0.get_tile(1, 0, 0)
+    t0 = P0.get_tile(0, 0, 0)
+    assert np.allclose(t1[:16, :16], 0.25*(t0[::2, ::2] + t0[1::2, ::2] + t0[::2, 1::2] + t0[1::2, 1::2]))
+
+
+def test_incremental_update_deeper(tmpdir):
+    from PYME.Analysis.tile_pyramid import ImagePyramid
+    
+    frame = np.random.rand(50, 50)
+    weights = np.ones_like(frame)
+    
+    P0 = ImagePyramid(str(tmpdir.mkdir('once')), 32)
+    P1 = ImagePyramid(str(tmpdir.mkdir('incremental')), 32)
+    
+    # the first update only has a single tile in layer 1, so the pyramid stops there
+    P1.add_base_tile(0, 0, frame, weights)
+    P1.update_pyramid()
+    
+    # a distant tile makes the pyramid deeper, so the upper layers need to be built above the old data too
+    for P in [P0, P1]:
+        P.add_base_tile(300, 0, frame, weights)
+    P0.add_base_tile(0, 0, frame, weights)
+    
+    P0.update_pyramid()
+    P1.update_pyramid()
+    
+    assert P1.depth == P0.depth == 3
+    for level in range(P0.depth + 2):
+        assert sorted(P1.get_layer_tile_coords(level)) == sorted(P0.get_layer_tile_coords(level))
+    
+    assert np.allclose(P0.get_tile(4, 0, 0), P1.get_tile(4, 0, 0), atol=1e-5)
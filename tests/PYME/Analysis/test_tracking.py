@@ -0,0 +1,54 @@
+import numpy as np
+from PYME.Analysis.Tracking import tracking
+
+
+def _track(t, xvs, **kwargs):
+    tr = tracking.Tracker(t, xvs, **kwargs)
+    for i in range(1, t.max() + 1):
+        tr.updateTrack(i, tr.calcLinkages(i, i - 1))
+    
+    return tr.clumpIndex
+
+def test_tracks():
+    # two particles moving in opposite directions, with frames given out of order
+    t = np.array([0, 0, 1, 1, 2, 2, 3])
+    x = np.array([0, 1000, 50, 950, 100, 900, 150.])
+    y = np.zeros(7)
+    I = np.array([6, 3, 0, 5, 1, 4, 2])
+    
+    ci = _track(t[I].astype('i'), np.vstack([x[I], y[I]]), r0=100)
+    
+    ci_ = np.zeros_like(ci)
+    ci_[I] = ci
+    np.testing.assert_array_equal(ci_ == ci_[0], [True, False, True, False, True, False, True])
+    np.testing.assert_array_equal(ci_ == ci_[1], [False, True, False, True, False, True, False])
+
+def test_sparse_linkage_matrix():
+    # linkages computed with a distance cutoff should be close to those computed with all pairs
+    np.random.seed(0)
+    t = np.repeat([0, 1], 50).astype('i')
+    x = np.random.rand(2, 100)*5000
+    
+    tr = tracking.Tracker(t, x, r0=200)
+    m, j = tr.calcLinkageMatrix(1, 0)
+    m_all, j_all = tracking.Tracker(t, x, r0=200, maxLinkDistance=np.inf).calcLinkageMatrix(1, 0)
+    
+    np.testing.assert_array_equal(j, np.arange(50))
+    np.testing.assert_allclose(m, m_all, atol=1e-2)
+    np.testing.assert_allclose(m.sum(0), 1)
+
+def test_linkages_by_object():
+    t = np.array([0, 0, 1, 1], 'i')
+    x = np.array([[0, 1000, 50, 950.], [0, 0, 0, 0]])
+    tr = tracking.Tracker(t, x, r0=100)
+    
+    k, lj, lp = tr.calcLinkages(1, 0)
+    links = tracking.linkages_by_object((k, lj, lp))
+    
+    assert sorted(links.keys()) == sorted(set(k.tolist()))
+    for ki, (lji, lpi) in links.items():
+        np.testing.assert_array_equal(lji, lj[k == ki])
+        # most probable candidate first
+        assert np.all(np.diff(lpi) <= 0)
+        
+    assert tracking.linkages_by_object((np.zeros(0, 'i8'), np.zeros(0, 'i8'), np.zeros(0))) == {}
@@ -0,0 +1,42 @@
+"""
+Benchmark the rolling percentile (Analysis.PCTBackground) background buffers.
+
+Compares the incremental order statistic buffer (buffers.bgFrameBufferR, used by backgroundBufferM) with the older
+rank based bgFrameBuffer for a sliding window running over a series. Run directly, or with pytest -s.
+"""
+import time
+import numpy as np
+from PYME.IO import buffers
+
+
+def _run(bfb, frames, window, pctile=0.25):
+    t = time.time()
+    for i in range(len(frames)):
+        if i >= window:
+            bfb.removeFrame(i - window)
+        bfb.addFrame(i, frames[i])
+        
+        if i >= window - 1:
+            if hasattr(bfb, 'getPercentiles'):
+                bfb.getPercentiles([pctile, 0.5])
+            else:
+                bfb.getPercentile(pctile)
+                bfb.getPercentile(0.5)
+    
+    return (time.time() - t)/len(frames)
+
+
+def test_percentile_buffer_speed(windows=(10, 20, 50, 100, 200), shape=(256, 256), n_frames=300):
+    r = np.random.RandomState(0)
+    frames = r.poisson(100, size=(n_frames,) + shape).astype('uint16')
+    
+    for window in windows:
+        t_old = _run(buffers.bgFrameBuffer(initialSize=window), frames, window)
+        t_new = _run(buffers.bgFrameBufferR(initialSize=window), frames, window)
+        print('window=%d: bgFrameBuffer %3.2f ms/frame, bgFrameBufferR %3.2f ms/frame (%3.1fx)' % (window, 1e3*t_old,
+                                                                                                    1e3*t_new,
+                                                                                                    t_old/t_new))
+
+
+if __name__ == '__main__':
+    test_percentile_buffer_speed()
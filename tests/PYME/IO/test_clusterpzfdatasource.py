@@ -0,0 +1,151 @@
+import json
+import time
+
+import numpy as np
+import pytest
+
+from PYME.IO import clusterIO, PZFFormat
+
+
+class _FakeCluster(object):
+    """A cluster holding files in a dictionary, which records the requests made of it"""
+    def __init__(self):
+        self.files = {'seq/metadata.json': json.dumps({}).encode()}
+        self.gets = []
+        self.probes = []
+
+    def add_frames(self, frames, start=0, compression=PZFFormat.DATA_COMP_RAW):
+        for i, f in enumerate(frames):
+            self.files['seq/frame%05d.pzf' % (start + i)] = PZFFormat.dumps(f, compression=compression)
+
+    def get_file(self, filename, serverfilter=None, *args, **kwargs):
+        self.gets.append(filename)
+        try:
+            return self.files[filename]
+        except KeyError:
+            raise IOError('File not found: %s' % filename)
+
+    def locate_file(self, filename, serverfilter=None, return_first_hit=False):
+        self.probes.append(filename)
+        if filename in self.files:
+            return [('http://127.0.0.1:1234/' + filename, 0)]
+        return []
+
+    def exists(self, filename, serverfilter=None):
+        return filename in self.files
+
+    def listdir(self, dirname, serverfilter=None):
+        raise AssertionError('the series directory should not be listed')
+
+
+@pytest.fixture
+def cluster(monkeypatch):
+    cluster = _FakeCluster()
+    for name in ['get_file', 'locate_file', 'exists', 'listdir']:
+        monkeypatch.setattr(clusterIO, name, getattr(cluster, name))
+    return cluster
+
+
+def _wait_for_prefetch(ds, timeout=10):
+    t = time.time()
+    while len(ds._pending) > 0:
+        assert (time.time() - t) < timeout
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize('compression', [PZFFormat.DATA_COMP_RAW, PZFFormat.DATA_COMP_HUFFCODE])
+def test_getSlice(cluster, compression, monkeypatch):
+    from PYME.IO.DataSources import ClusterPZFDataSource
+    monkeypatch.setattr(ClusterPZFDataSource, 'READAHEAD', 0)
+
+    data = np.random.randint(0, 2**12, (20, 16, 24)).astype('uint16')
+    cluster.add_frames(data, compression=compression)
+
+    ds = ClusterPZFDataSource.DataSource('pyme-cluster://TEST/seq')
+    assert ds.getNumSlices() == 20
+    assert ds.getSliceShape() == (16, 24)
+
+    for i in [3, 0, 19, 3]:
+        sl = ds.getSlice(i)
+        assert np.array_equal(sl, data[i])
+
+        # returned frames should be safe to modify, and should not change the cached copy
+        sl[:] = 0
+        assert np.array_equal(ds.getSlice(i), data[i])
+
+
+def test_cache(cluster, monkeypatch):
+    from PYME.IO.DataSources import ClusterPZFDataSource
+    monkeypatch.setattr(ClusterPZFDataSource, 'READAHEAD', 0)
+    monkeypatch.setattr(ClusterPZFDataSource, 'CACHE_SIZE', 3)
+
+    data = np.random.randint(0, 2**12, (10, 8, 8)).astype('uint16')
+    cluster.add_frames(data)
+    ds = ClusterPZFDataSource.DataSource('pyme-cluster://TEST/seq')
+
+    for i in [0, 1, 2, 0, 3]:
+        ds.getSlice(i)
+
+    # frame 1 was the least recently used when frame 3 was loaded
+    assert list(ds._cache.keys()) == [2, 0, 3]
+
+    del cluster.gets[:]
+    ds.getSlice(0)
+    assert cluster.gets == []
+
+    ds.getSlice(1)
+    assert cluster.gets == ['seq/frame00001.pzf']
+
+
+def test_prefetch(cluster, monkeypatch):
+    from PYME.IO.DataSources import ClusterPZFDataSource
+    monkeypatch.setattr(ClusterPZFDataSource, 'READAHEAD', 5)
+
+    data = np.random.randint(0, 2**12, (8, 8, 8)).astype('uint16')
+    cluster.add_frames(data)
+    ds = ClusterPZFDataSource.DataSource('pyme-cluster://TEST/seq')
+
+    assert np.array_equal(ds.getSlice(0), data[0])
+    _wait_for_prefetch(ds)
+    assert sorted(ds._cache.keys()) == list(range(6))
+
+    # prefetched frames are served from the cache, and frames which haven't been spooled yet are not requested
+    del cluster.gets[:]
+    for i in range(1, 6):
+        assert np.array_equal(ds.getSlice(i), data[i])
+    _wait_for_prefetch(ds)
+    assert sorted(cluster.gets) == ['seq/frame%05d.pzf' % i for i in [6, 7]]
+
+    ds.prefetch([-1, 8, 100])
+    assert len(ds._pending) == 0
+
+
+def test_num_frames_live(cluster, monkeypatch):
+    from PYME.IO.DataSources import ClusterPZFDataSource
+
+    data = np.zeros((1000, 4, 4), 'uint16')
+    cluster.add_frames(data[:5])
+    ds = ClusterPZFDataSource.DataSource('pyme-cluster://TEST/seq')
+    assert ds.getNumSlices() == 5
+
+    # more frames are spooled - should be found without listing the directory or probing every frame
+    cluster.add_frames(data[5:], start=5)
+    ds.lastShapeTime = 0
+    del cluster.probes[:]
+    assert ds.getNumSlices() == 1000
+    assert len(cluster.probes) < 25
+
+    # no new frames
+    ds.lastShapeTime = 0
+    del cluster.probes[:]
+    assert ds.getNumSlices() == 1000
+    assert cluster.probes == ['seq/frame01000.pzf']
+
+    # once the series is complete we stop checking
+    cluster.files['seq/events.json'] = b'[]'
+    ds.lastShapeTime = 0
+    ds.getNumSlices()
+    del cluster.probes[:]
+    ds.lastShapeTime = 0
+    assert ds.getNumSlices() == 1000
+    assert cluster.probes == []
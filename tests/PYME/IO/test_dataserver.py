@@ -100,4 +100,21 @@ def test_dircache_purge():
     
         listing = clusterIO.listdir('_testing/lots_of_folders/test_%d/' % i, 'TEST')
     
-    #assert (len(listing) == 10)
\ No newline at end of file
+    #assert (len(listing) == 10)
+
+def test_get_file_range():
+    testdata = b''.join([b'%05d' % i for i in range(1000)])
+    clusterIO.put_file('_testing/test_range.bin', testdata, 'TEST')
+    
+    assert clusterIO.get_file_range('_testing/test_range.bin', 100, 150, 'TEST') == testdata[100:150]
+    assert clusterIO.get_file_range('_testing/test_range.bin', 4990, None, 'TEST') == testdata[4990:]
+    assert clusterIO.get_file_range('_testing/test_range.bin', 4990, 6000, 'TEST') == testdata[4990:]
+    assert clusterIO.get_file_range('_testing/test_range.bin', 6000, 7000, 'TEST') == b''
+    
+    
+def test_stream_file():
+    testdata = b''.join([b'%05d' % i for i in range(1000)])
+    clusterIO.put_file('_testing/test_stream.bin', testdata, 'TEST')
+    
+    assert b''.join(clusterIO.stream_file('_testing/test_stream.bin', 'TEST', chunk_size=1000)) == testdata
+    assert b''.join(clusterIO.stream_file('_testing/test_stream.bin', 'TEST', start=1234)) == testdata[1234:]
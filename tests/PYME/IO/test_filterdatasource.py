@@ -0,0 +1,38 @@
+import numpy as np
+
+
+def test_filter_datasource():
+    from PYME.IO.DataSources import FilterDataSource
+    
+    data = np.random.rand(16, 24, 10, 2).astype('f')
+    calls = []
+    
+    def _filter(frames, chanNum, frameNum):
+        calls.append((chanNum, frameNum))
+        return frames[0] + frames[1] + chanNum
+    
+    ds = FilterDataSource.DataSource([data, data], _filter, cache_size=5)
+    
+    assert ds.getSliceShape() == (16, 24)
+    assert ds.getNumSlices() == 20
+    assert list(ds.shape[:4]) == [16, 24, 10, 2]
+    
+    for c in range(2):
+        for i in range(10):
+            assert np.allclose(ds.getSlice(i + c*10), 2*data[:, :, i, c] + c)
+            
+    # cached frames are not recomputed
+    n_calls = len(calls)
+    ds.getSlice(19)
+    assert len(calls) == n_calls
+    
+    # but the cache is bounded
+    ds.getSlice(0)
+    assert len(calls) == n_calls + 1
+    assert len(ds._cache) == 5
+    
+    # returned frames should be safe to modify, and should not change the cached copy
+    sl = ds.getSlice(19)
+    sl[:] = 0
+    assert np.allclose(ds.getSlice(19), 2*data[:, :, 9, 1] + 1)
+    assert len(calls) == n_calls + 1
@@ -0,0 +1,49 @@
+import pytest
+
+from PYME.cluster import HTTPDataServer
+
+
+class _Handler(HTTPDataServer.PYMEHTTPRequestHandler):
+    """A request handler which isn't connected to anything, and records the responses it sends"""
+    def __init__(self, range_header=None):
+        self.headers = {} if range_header is None else {'Range': range_header}
+        self.responses = []
+        
+    def send_response(self, code, message=None):
+        self.responses.append(code)
+        
+    def send_header(self, keyword, value):
+        pass
+    
+    def end_headers(self):
+        pass
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, None),
+    ('bytes=0-99', (0, 100)),
+    ('bytes=10-19', (10, 20)),
+    ('bytes=10-5000', (10, 100)), # clipped to the resource size
+    ('bytes=90-', (90, 100)), # open ended
+    ('bytes=-10', (90, 100)), # suffix
+    ('bytes=-500', (0, 100)), # suffix longer than the resource
+])
+def test_get_range(header, expected):
+    h = _Handler(header)
+    assert h._get_range(100) == expected
+    assert h.responses == []
+    
+    
+@pytest.mark.parametrize('header', ['bytes=10-5', 'bytes=-', 'bytes=a-b', 'bytes=0-5,10-15', 'lines=0-5'])
+def test_get_range_invalid(header):
+    # invalid (or unsupported) ranges are ignored, and the whole resource is returned
+    h = _Handler(header)
+    assert h._get_range(100) is None
+    assert h.responses == []
+    
+    
+@pytest.mark.parametrize('header', ['bytes=100-', 'bytes=200-300', 'bytes=-0'])
+def test_get_range_unsatisfiable(header):
+    h = _Handler(header)
+    assert h._get_range(100) is False
+    assert h.responses == [416]
@@ -0,0 +1,103 @@
+import numpy as np
+import tempfile
+import threading
+import os
+
+TEST_DTYPE = np.dtype([('x', 'f4'), ('y', 'f4')])
+
+def test_concurrent_append_flush_close():
+    from PYME.IO import h5rFile
+    import tables
+    
+    filename = os.path.join(tempfile.mkdtemp(), 'test_pool.h5r')
+    
+    def writer():
+        for j in range(50):
+            with h5rFile.openH5R(filename, 'a') as f:
+                f.appendToTable('FitResults', np.zeros(3, TEST_DTYPE))
+                
+    threads = [threading.Thread(target=writer) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+        
+    assert h5rFile.flush_file(filename)
+    with h5rFile.openH5R(filename, 'a') as f:
+        assert len(f.getTableData('FitResults', slice(None))) == 8*50*3
+    
+    assert h5rFile.close_file(filename)
+    assert len(h5rFile._cached_files(filename)) == 0
+    
+    with tables.open_file(filename) as h5f:
+        assert h5f.root.FitResults.nrows == 8*50*3
+
+
+def test_batched_appends_and_metrics():
+    from PYME.IO import h5rFile
+    
+    filename = os.path.join(tempfile.mkdtemp(), 'test_batch.h5r')
+    
+    with h5rFile.openH5R(filename, 'a') as f:
+        # queue up lots of small appends - these should be written in a few batches, not one at a time
+        for j in range(1000):
+            d = np.zeros(2, TEST_DTYPE)
+            d['x'] = j
+            f.appendToTable('FitResults', d)
+        
+    assert f.flush()
+    metrics = f.get_metrics()
+    assert metrics['rows_written'] == 2000
+    assert metrics['table_appends'] < 100
+    assert metrics['queue_depth']['FitResults'] == 0
+    assert metrics['flushes'] >= 1
+    assert filename in h5rFile.get_writer_metrics()
+    
+    res = f.getTableData('FitResults', slice(None))
+    np.testing.assert_array_equal(res['x'][::2], np.arange(1000))
+    
+    f.close()
+
+
+def test_pzf_index():
+    from PYME.IO import h5File, PZFFormat
+    import tables
+    
+    filename = os.path.join(tempfile.mkdtemp(), 'test_pzf.h5')
+    
+    with h5File.openH5(filename, 'a') as f:
+        for i in [2, 0, 1]:
+            f.put_file('frame%05d.pzf' % i, PZFFormat.dumps(i*np.ones((10, 10), 'u2'), sequenceID=0, frameNum=i))
+    
+    f.close()
+    
+    with tables.open_file(filename) as h5f:
+        idx = h5f.root.PZFImageIndex[:]
+        np.testing.assert_array_equal(idx['FrameNum'], [2, 0, 1])
+        np.testing.assert_array_equal(idx['Position'], [0, 1, 2])
+    
+    with h5File.openH5(filename, 'r') as f:
+        assert PZFFormat.loads(f.get_frame(1))[0].max() == 1
+        
+    f.close()
+
+
+def test_flush_waits_for_time_limited_batches():
+    from PYME.IO import h5rFile
+    
+    filename = os.path.join(tempfile.mkdtemp(), 'test_flush_batch.h5r')
+    
+    f = h5rFile.openH5R(filename, 'a')
+    try:
+        with f:
+            # make batches small and the time limit tiny so that a single poll cycle can't write everything
+            f.MAX_BATCH_BYTES = 8*TEST_DTYPE.itemsize
+            f.MAX_BATCH_TIME = 1e-4
+            
+            for j in range(5000):
+                f.appendToTable('FitResults', np.zeros(4, TEST_DTYPE))
+            
+            assert f.flush(30)
+            assert len(f.getTableData('FitResults', slice(None))) == 5000*4
+    finally:
+        f.close()
@@ -0,0 +1,66 @@
+import numpy as np
+import tempfile
+import os
+
+import pytest
+
+
+def _make_h5(complevel, chunkshape=None):
+    import tables
+    
+    filename = os.path.join(tempfile.mkdtemp(), 'test_%d.h5' % complevel)
+    data = np.random.randint(0, 2**16, (50, 32, 48)).astype('uint16')
+    
+    with tables.open_file(filename, 'w') as h5f:
+        image_data = h5f.create_earray(h5f.root, 'ImageData', tables.UInt16Atom(), (0, 32, 48),
+                                       filters=tables.Filters(complevel, 'zlib', shuffle=True), chunkshape=chunkshape)
+        image_data.append(data)
+        
+    return filename, data
+
+
+@pytest.mark.parametrize('complevel,chunkshape', [(0, (1, 32, 48)), (0, (4, 32, 48)), (6, (1, 32, 48))])
+def test_getSlice(complevel, chunkshape):
+    from PYME.IO.DataSources import HDFDataSource
+    
+    filename, data = _make_h5(complevel, chunkshape)
+    ds = HDFDataSource.DataSource(filename)
+    try:
+        assert ds.getNumSlices() == 50
+        assert ds.getSliceShape() == (32, 48)
+        
+        # read out of order to exercise the block reads and cache
+        for i in list(range(20, 50)) + list(range(20)) + [-1]:
+            assert np.array_equal(ds.getSlice(i), data[i])
+            
+        # uncompressed data should be memory mapped, compressed data cached
+        assert (ds._mmap is not None) == (complevel == 0)
+        assert (len(ds._cache) > 0) == (complevel > 0)
+    finally:
+        ds.release()
+
+
+@pytest.mark.parametrize('have_chunk_info', [True, False])
+def test_getSlice_mmap_fallback(have_chunk_info, monkeypatch):
+    import tables
+    from PYME.IO.DataSources import HDFDataSource
+    
+    if not have_chunk_info:
+        # simulate pytables < 3.8, which has no way of finding chunk offsets
+        monkeypatch.delattr(tables.leaf.Leaf, 'chunk_info', raising=False)
+    
+    filename, data = _make_h5(0, (1, 32, 48))
+    ds = HDFDataSource.DataSource(filename)
+    try:
+        for i in [3, 0, 49, 3]:
+            sl = ds.getSlice(i)
+            assert np.array_equal(sl, data[i])
+            
+            # returned frames should be safe to modify
+            sl[:] = 0
+            assert np.array_equal(ds.getSlice(i), data[i])
+            
+        assert (ds._mmap is not None) == have_chunk_info
+        assert (len(ds._cache) > 0) == (not have_chunk_info)
+    finally:
+        ds.release()
@@ -0,0 +1,82 @@
+import socket
+import uuid
+
+import pytest
+
+from PYME.IO import clusterIO
+
+
+class _Info(object):
+    address = socket.inet_aton('127.0.0.1')
+    port = 1234
+    
+    
+class _Response(object):
+    status_code = 200
+    
+    def close(self):
+        pass
+    
+    
+class _Session(object):
+    def put(self, url, data=None, timeout=None):
+        return _Response()
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """Replace the cluster with a single (remote) server which doesn't have any files, recording the queries made"""
+    queries = []
+    
+    def _locate_in_dir(args):
+        queries.append(args)
+        return None
+    
+    monkeypatch.setattr(clusterIO, '_dir_urls', lambda dirname, serverfilter: ([], ['http://127.0.0.1:1234/' + dirname]))
+    monkeypatch.setattr(clusterIO, '_locate_in_dir', _locate_in_dir)
+    monkeypatch.setattr(clusterIO, '_chooseServer', lambda serverfilter: ('server', _Info()))
+    monkeypatch.setattr(clusterIO, '_getSession', lambda url: _Session())
+    monkeypatch.setattr(clusterIO, 'LOCATE_NEGATIVE_CACHE_TIME', 60)
+    
+    return queries
+
+
+def _filename():
+    return '_test_locate_cache/%s' % uuid.uuid4().hex
+
+
+def test_negative_cache_hit(queries):
+    fn = _filename()
+    
+    assert clusterIO.locate_file(fn, 'TEST') == []
+    assert len(queries) == 1
+    
+    # a recent miss is not queried again
+    assert clusterIO.locate_file(fn, 'TEST') == []
+    assert len(queries) == 1
+    
+    
+def test_negative_cache_expiry(queries):
+    fn = _filename()
+    
+    assert clusterIO.locate_file(fn, 'TEST') == []
+    assert len(queries) == 1
+    
+    # age the cached miss past the cache time
+    clusterIO._negativeLocateCache['TEST::' + fn] -= 61
+    assert clusterIO.locate_file(fn, 'TEST') == []
+    assert len(queries) == 2
+    
+    
+def test_negative_cache_cleared_on_put(queries):
+    fn = _filename()
+    
+    assert clusterIO.locate_file(fn, 'TEST') == []
+    
+    clusterIO.put_file(fn, b'data', 'TEST')
+    assert not ('TEST::' + fn) in clusterIO._negativeLocateCache
+    
+    # the file we have just written is found, even though the miss had not expired
+    locs = clusterIO.locate_file(fn, 'TEST')
+    assert len(locs) == 1
+    assert locs[0][0].endswith(fn.encode())
@@ -120,4 +120,64 @@ def test_PZFFormat_lossless_uint8():
 
     #print result.squeeze(), test_data, result.shape, test_data.shape
 
-    assert np.allclose(result.squeeze(), test_data.squeeze())
\ No newline at end of file
+    assert np.allclose(result.squeeze(), test_data.squeeze())
+
+
+def test_PZFFormat_loads_view_raw():
+    from PYME.IO import PZFFormat
+    test_data = np.random.poisson(100, 10000).reshape(100,100).astype('uint16')
+    
+    pzf = PZFFormat.dumps(test_data, frameNum=5)
+    result, header = PZFFormat.loads_view(pzf)
+    
+    assert np.allclose(result.squeeze(), test_data)
+    assert header['FrameNum'] == 5
+    # raw data should be a view onto the encoded buffer, not a copy
+    assert np.shares_memory(result, np.frombuffer(pzf, 'u1'))
+
+
+def test_PZFFormat_dumps_into():
+    from PYME.IO import PZFFormat
+    frames = [np.random.poisson(100, 10000).reshape(100,100).astype('uint16') for i in range(3)]
+    frames[1] = frames[1].copy(order='F')
+    
+    # deliberately too small, so that the buffer has to grow
+    buf = bytearray(100)
+    spans = []
+    end = 0
+    for i, f in enumerate(frames):
+        start = end
+        end = PZFFormat.dumps_into(buf, f, offset=start, frameNum=i)
+        spans.append((start, end))
+        
+        assert bytes(buf[start:end]) == PZFFormat.dumps(f, frameNum=i)
+    
+    bv = memoryview(buf)
+    for i, (start, end) in enumerate(spans):
+        result, header = PZFFormat.loads_view(bv[start:end])
+        assert np.allclose(result.squeeze(), frames[i])
+        assert header['FrameNum'] == i
+
+
+def test_PZFFormat_chunked_lossless_uint16():
+    from PYME.IO import PZFFormat
+    test_data = np.random.poisson(100, 10000).reshape(100,100).astype('uint16')
+    
+    for num_chunks in [None, 1, 3]:
+        result, header = PZFFormat.loads(PZFFormat.dumps(test_data, compression=PZFFormat.DATA_COMP_HUFFCODE_CHUNKS,
+                                                         numChunks=num_chunks))
+    
+        assert np.allclose(result.squeeze(), test_data.squeeze())
+
+def test_PZFFormat_chunked_lossy_uint16():
+    from PYME.IO import PZFFormat
+    test_data = np.random.poisson(100, 10000).reshape(100,100).astype('uint16').copy(order='F')
+
+    result, header = PZFFormat.loads(PZFFormat.dumps(test_data,
+                                                     compression = PZFFormat.DATA_COMP_HUFFCODE_CHUNKS,
+                                                     quantization = PZFFormat.DATA_QUANT_SQRT,
+                                                     quantizationOffset=0, quantizationScale=1, numChunks=3))
+
+    test_quant = (np.floor(np.sqrt(test_data.astype('f')-.1)).astype('i'))**2
+
+    assert np.allclose(result.squeeze(), test_quant.squeeze())
@@ -0,0 +1,79 @@
+import numpy as np
+
+from PYME.IO.image import ImageBounds
+from PYME.LMVis import visHelpers
+
+
+def _rendGauss_reference(x, y, sx, imageBounds, pixelSize):
+    """Point-by-point rendering, as rendGauss used to do it"""
+    sx = np.maximum(sx, pixelSize)
+    roiSize = int(3 * np.median(sx) / pixelSize)
+    fuzz = pixelSize * roiSize
+    
+    X = np.arange(imageBounds.x0 - fuzz, imageBounds.x1 + fuzz, pixelSize) + 0.5 * pixelSize
+    Y = np.arange(imageBounds.y0 - fuzz, imageBounds.y1 + fuzz, pixelSize) + 0.5 * pixelSize
+    
+    im = np.zeros((len(X), len(Y)))
+    for i in range(len(x)):
+        ix = np.absolute(X - x[i]).argmin()
+        iy = np.absolute(Y - y[i]).argmin()
+        Xi, Yi = X[(ix - roiSize):(ix + roiSize + 1)], Y[(iy - roiSize):(iy + roiSize + 1)]
+        
+        im[(ix - roiSize):(ix + roiSize + 1), (iy - roiSize):(iy + roiSize + 1)] += np.exp(
+            -((Xi[:, None] - x[i]) ** 2 + (Yi[None, :] - y[i]) ** 2) / (2 * sx[i] ** 2)) / sx[i]
+    
+    return im[roiSize:-roiSize, roiSize:-roiSize]
+
+
+def _random_points(n=2000):
+    np.random.seed(42)
+    # keep points away from the edges, where the old implementation dropped parts of the ROI
+    x = np.random.uniform(100, 3900, n)
+    y = np.random.uniform(100, 2900, n)
+    sx = np.random.uniform(5, 30, n)
+    
+    return x, y, sx
+
+
+def test_rendGauss():
+    x, y, sx = _random_points()
+    imb = ImageBounds(0, 0, 4000, 3000)
+    
+    im = visHelpers.rendGauss(x, y, sx, imb, 10.)
+    ref = _rendGauss_reference(x, y, sx, imb, 10.)
+    
+    assert im.shape == ref.shape
+    assert np.allclose(im, ref, atol=1e-6)
+
+
+def test_rendGauss_tile_size():
+    x, y, sx = _random_points()
+    imb = ImageBounds(0, 0, 4000, 3000)
+    
+    old_tile_size = visHelpers.RENDER_TILE_SIZE
+    try:
+        visHelpers.RENDER_TILE_SIZE = 16
+        im_small = visHelpers.rendGauss(x, y, sx, imb, 10.)
+        visHelpers.RENDER_TILE_SIZE = 1024
+        im_large = visHelpers.rendGauss(x, y, sx, imb, 10.)
+    finally:
+        visHelpers.RENDER_TILE_SIZE = old_tile_size
+    
+    assert np.allclose(im_small, im_large, atol=1e-6)
+
+
+def test_rendGauss_batch_size():
+    x, y, sx = _random_points()
+    imb = ImageBounds(0, 0, 4000, 3000)
+    
+    im = visHelpers.rendGauss(x, y, sx, imb, 10.)
+    
+    old_batch_pixels = visHelpers.RENDER_BATCH_PIXELS
+    try:
+        # small batches, so that each tile is rendered in many batches
+        visHelpers.RENDER_BATCH_PIXELS = 2000
+        im_batched = visHelpers.rendGauss(x, y, sx, imb, 10.)
+    finally:
+        visHelpers.RENDER_BATCH_PIXELS = old_batch_pixels
+    
+    assert np.allclose(im, im_batched, atol=1e-6)
@@ -0,0 +1,125 @@
+import json
+
+import numpy as np
+import pytest
+
+from PYME.cluster.rulenodeserver import frame_block_tasks
+
+TEMPLATE = json.dumps({'id': '{{ruleID}}~{{taskID}}',
+                       'type': 'localization',
+                       'taskdef': {'frameIndex': '{{taskID}}',
+                                   'metadata': {'Analysis.FitModule': 'LatGaussFitFR',
+                                                'Analysis.DetectionThreshold': 1.0,
+                                                'Analysis.BGRange': [0, 0]}},
+                       'inputs': {'frames': 'PYME-CLUSTER://TEST/test.pcs'},
+                       'outputs': {}})
+
+
+def _task_frames(task):
+    if 'frameRange' in task['taskdef']:
+        return list(range(*task['taskdef']['frameRange']))
+    
+    return [int(task['taskdef']['frameIndex'])]
+
+
+@pytest.mark.parametrize('block_size', [1, 3, 7, 100])
+def test_frame_block_tasks(block_size):
+    # a random subset of frames, with gaps, in random order
+    np.random.seed(0)
+    taskIDs = np.random.permutation(np.flatnonzero(np.random.rand(200) > 0.2)).tolist()
+    
+    tasks = frame_block_tasks(TEMPLATE, 'rule', taskIDs, block_size)
+    frames = [_task_frames(t) for t in tasks]
+    
+    # every frame is covered exactly once (no gaps, no overlaps)
+    all_frames = sum(frames, [])
+    assert sorted(all_frames) == sorted(taskIDs)
+    assert len(all_frames) == len(taskIDs)
+    
+    for t, f in zip(tasks, frames):
+        assert len(f) <= block_size
+        # blocks are identified by their first frame, and only cover frames we bid on
+        assert t['id'] == 'rule~%d' % f[0]
+        assert int(t['taskdef']['frameIndex']) == f[0]
+        
+        
+def test_frame_block_tasks_partial_last_block():
+    tasks = frame_block_tasks(TEMPLATE, 'rule', list(range(10, 20)), 4)
+    
+    assert [_task_frames(t) for t in tasks] == [[10, 11, 12, 13], [14, 15, 16, 17], [18, 19]]
+    
+    # a last block of a single frame is an ordinary task
+    tasks = frame_block_tasks(TEMPLATE, 'rule', list(range(10, 19)), 4)
+    assert [_task_frames(t) for t in tasks] == [[10, 11, 12, 13], [14, 15, 16, 17], [18]]
+    assert 'frameRange' not in tasks[-1]['taskdef']
+    
+    
+def test_fit_tasks_from_frame_block():
+    from PYME.localization import remFitBuf
+    
+    task = frame_block_tasks(TEMPLATE, 'rule', list(range(10, 20)), 4)[-1]
+    fit_tasks = remFitBuf.createFitTasksFromTaskDef(task)
+    assert [t.index for t in fit_tasks] == [18, 19]
+    
+    task = frame_block_tasks(TEMPLATE, 'rule', [5], 4)[0]
+    assert [t.index for t in remFitBuf.createFitTasksFromTaskDef(task)] == [5]
+
+
+class _Response(object):
+    def __init__(self, content):
+        self.content = content
+        
+
+class _DistributorSession(object):
+    """Advertises frames 0-999 of a single localization rule, and accepts all bids"""
+    def __init__(self):
+        self.bids = []
+        
+    def get(self, url, json=None, timeout=None):
+        import json as json_
+        if url.endswith('task_advertisements'):
+            return _Response(json_.dumps([{'ruleID': 'rule', 'taskTemplate': TEMPLATE, 'nAvailable': 1000,
+                                           'availableTaskRanges': [[0, 1000]], 'blockSize': 10}]))
+        
+        self.bids.append(json)
+        return _Response(json_.dumps([{'ruleID': b['ruleID'], 'taskIDs': b['taskIDs']} for b in json]))
+    
+
+def test_node_bids_count_queued_frames(monkeypatch):
+    import threading
+    from PYME.cluster import rulenodeserver
+    from PYME.IO import clusterIO
+    
+    monkeypatch.setattr(clusterIO, 'is_local', lambda filename, serverfilter: True)
+    monkeypatch.setattr(rulenodeserver.NodeServer, 'num_tasks_to_request', 30)
+    
+    # a node server without its polling threads
+    node = rulenodeserver.NodeServer.__new__(rulenodeserver.NodeServer)
+    node._tasks = rulenodeserver.Queue.Queue()
+    node._n_queued = 0
+    node._n_queued_lock = threading.Lock()
+    node._update_tasks_lock = threading.Lock()
+    node._lastUpdateTime = 0
+    node.workerIDs = set()
+    node.distributor_url = 'http://distributor/'
+    node.taskSession = _DistributorSession()
+    
+    node._update_tasks()
+    assert sum([len(b['taskIDs']) for b in node.taskSession.bids[0]]) == 30
+    # 3 frame-block tasks
+    assert node._tasks.qsize() == 3
+    assert node._n_queued == 30
+    
+    # the queue is full (in frames), so we don't bid on any more
+    node._lastUpdateTime = 0
+    node._update_tasks()
+    assert sum([len(b['taskIDs']) for b in node.taskSession.bids[1]]) == 0
+    
+    # a worker takes a block, leaving room for one more
+    tasks = json.loads(node._get_tasks('worker', numWant=1))['result']
+    assert len(tasks) == 1
+    assert node._n_queued == 20
+    
+    node._lastUpdateTime = 0
+    node._update_tasks()
+    assert sum([len(b['taskIDs']) for b in node.taskSession.bids[2]]) == 10
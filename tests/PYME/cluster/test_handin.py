@@ -0,0 +1,102 @@
+import json
+
+from PYME.cluster import ruleserver
+
+
+class _Response(object):
+    status_code = 200
+    
+    def __init__(self, data):
+        self._data = data
+        
+    def json(self):
+        return json.loads(self._data)
+    
+    
+class _Session(object):
+    """Records posts, optionally passing them on to a handler"""
+    def __init__(self, handler=None):
+        self.posts = []
+        self._handler = handler
+        
+    def post(self, url, data=None, json=None, headers=None):
+        self.posts.append((url, data if json is None else json))
+        if self._handler is not None:
+            return _Response(self._handler(url, data, json))
+        
+        return _Response('{"ok": true}')
+    
+    
+def test_return_task_results_batching(monkeypatch):
+    from PYME.cluster import taskWorkerHTTP
+    
+    session = _Session()
+    monkeypatch.setattr(taskWorkerHTTP.clusterIO, '_getSession', lambda url: session)
+    monkeypatch.setattr(taskWorkerHTTP, 'BATCH_HANDIN', True)
+    monkeypatch.setattr(taskWorkerHTTP, 'HANDIN_MAX_TASKS', 3)
+    monkeypatch.setattr(taskWorkerHTTP, 'HANDIN_WINDOW', 1e3)
+    
+    worker = taskWorkerHTTP.taskWorker()
+    
+    def _complete(taskID, res=True):
+        # recipe tasks return True on success, and None on failure
+        worker.resultsQueue.put(('http://node/', {'id': 'rule~%d' % taskID}, res, 0.5))
+    
+    _complete(0)
+    _complete(1, None)
+    worker._return_task_results()
+    assert len(session.posts) == 0 # held back until we have a full batch
+    
+    _complete(2)
+    worker._return_task_results()
+    assert len(session.posts) == 1
+    url, data = session.posts[0]
+    assert url == 'http://node/node/handin'
+    assert json.loads(data) == [{'taskID': 'rule~0', 'status': 'success', 'execTime': 0.5},
+                                {'taskID': 'rule~1', 'status': 'failure', 'execTime': 0.5},
+                                {'taskID': 'rule~2', 'status': 'success', 'execTime': 0.5}]
+    
+    _complete(3)
+    worker._return_task_results()
+    assert len(session.posts) == 1
+    
+    # flushing hands in a partial batch
+    worker._return_task_results(flush=True)
+    assert len(session.posts) == 2
+    assert [h['taskID'] for h in json.loads(session.posts[1][1])] == ['rule~3']
+    
+    
+def test_bulk_handin_counters():
+    from PYME.cluster.rulenodeserver import NodeServer
+    
+    rule_server = ruleserver.RuleServer()
+    try:
+        rule = ruleserver.IntegerIDRule('rule', '{}', max_task_ID=100)
+        rule_server._rules['rule'] = rule
+        rule.make_range_available(0, 10)
+        rule.bid({'ruleID': 'rule', 'taskIDs': list(range(6)), 'costs': [1.]*6})
+        
+        # a node server without its distributor polling thread, passing hand-ins straight to the rule server
+        node_server = NodeServer.__new__(NodeServer)
+        node_server._handins = ruleserver.Queue.Queue()
+        node_server.distributor_url = 'http://distributor/'
+        node_server.handinSession = _Session(lambda url, data, js: rule_server._handin(json.dumps(js)))
+        
+        # a mixed batch, including a duplicate hand-in, and a task (7) which timed out and was made available again
+        # before being handed in
+        handins = ([{'taskID': 'rule~%d' % i, 'status': 'success', 'execTime': 2.0} for i in [0, 1, 2, 5, 7]] +
+                   [{'taskID': 'rule~%d' % i, 'status': 'failure', 'execTime': 0} for i in [3, 4]] +
+                   [{'taskID': 'rule~0', 'status': 'success', 'execTime': 2.0}])
+        node_server._handin(body=json.dumps(handins))
+        node_server._do_handins()
+        
+        # all the hand-ins go to the rule server in a single request
+        assert len(node_server.handinSession.posts) == 1
+        
+        assert rule.nCompleted == 5
+        assert rule.nFailed == 2
+        assert rule.nAssigned == 0
+        assert rule.nAvailable == 3
+        assert rule.avExecutionTime == 2.0
+    finally:
+        rule_server.stop()
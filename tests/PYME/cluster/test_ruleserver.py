@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from PYME.cluster import ruleserver
+from PYME.cluster.rulenodeserver import iter_advertised_task_ids
+
+
+def _check_counts(rule):
+    # the incrementally maintained counts must match a full recount of the task table
+    counts = (rule.nTotal, rule.nAvailable, rule.nAssigned)
+    rule._update_nums()
+    assert (rule.nTotal, rule.nAvailable, rule.nAssigned) == counts
+    
+
+@pytest.mark.parametrize('mask', [np.zeros(0, bool), np.zeros(10, bool), np.ones(10, bool),
+                                  np.array([1, 0, 0, 1, 1, 0, 1], bool), np.random.rand(1000) > 0.5])
+def test_task_range_round_trip(mask):
+    for offset in [0, 17]:
+        ranges = ruleserver.mask_to_ranges(mask, offset)
+        
+        # ranges are ordered, non-empty and separated by at least one missing ID
+        assert all([(start < end) for start, end in ranges])
+        assert all([(r0[1] < r1[0]) for r0, r1 in zip(ranges[:-1], ranges[1:])])
+        
+        taskIDs = list(iter_advertised_task_ids({'availableTaskRanges': ranges}))
+        assert taskIDs == (np.flatnonzero(mask) + offset).tolist()
+        
+        
+def test_advert_round_trip():
+    rule = ruleserver.IntegerIDRule('rule', '{}', max_task_ID=1000)
+    rule.make_range_available(0, 100)
+    rule.make_range_available(200, 300)
+    rule.bid({'ruleID': 'rule', 'taskIDs': list(range(10, 20)) + [50, 250], 'costs': [1.]*12})
+    
+    available = set(range(0, 100)) | set(range(200, 300))
+    available -= set(range(10, 20)) | {50, 250}
+    
+    advert = rule.advert
+    assert advert['nAvailable'] == len(available)
+    assert list(iter_advertised_task_ids(advert)) == sorted(available)
+    # old style adverts are still understood
+    assert list(iter_advertised_task_ids({'availableTaskIDs': sorted(available)})) == sorted(available)
+    _check_counts(rule)
+    
+    
+def test_expired_tasks_become_available():
+    # a negative timeout, so that assignments expire as soon as they are made
+    rule = ruleserver.IntegerIDRule('rule', '{}', max_task_ID=100, task_timeout=-1)
+    rule._n_retries = 1
+    rule.make_range_available(0, 10)
+    
+    rule.bid({'ruleID': 'rule', 'taskIDs': list(range(6)), 'costs': [1.]*6})
+    rule.mark_complete({'ruleID': 'rule', 'taskIDs': [0], 'status': [ruleserver.STATUS_COMPLETE]})
+    assert (rule.nAvailable, rule.nAssigned) == (4, 5)
+    
+    rule.poll_timeouts()
+    assert (rule.nAvailable, rule.nAssigned) == (9, 0)
+    _check_counts(rule)
+    assert list(iter_advertised_task_ids(rule.advert)) == list(range(1, 10))
+    
+    # handing in a task which has already timed out still counts it (once)
+    rule.mark_complete({'ruleID': 'rule', 'taskIDs': [1], 'status': [ruleserver.STATUS_COMPLETE]})
+    assert (rule.nAvailable, rule.nAssigned, rule.nCompleted) == (8, 0, 2)
+    _check_counts(rule)
+    
+    # tasks which time out more than the allowed number of retries fail
+    rule.bid({'ruleID': 'rule', 'taskIDs': [2, 3], 'costs': [1.]*2})
+    rule.poll_timeouts()
+    assert (rule.nAvailable, rule.nAssigned) == (6, 0)
+    assert np.all(rule._task_info['status'][[2, 3]] == ruleserver.STATUS_FAILED)
+    _check_counts(rule)
@@ -41,6 +41,45 @@ def test_LatGaussFitFR():
     assert errors_over_pred_IQR < 2.5
 
 
+def test_LatGaussFitFR_batched():
+    """Check that fitting all the points in a frame at once (FromPoints) gives the same results as fitting them one
+    at a time (FromPoint)"""
+    import numpy as np
+    from PYME.IO.MetaDataHandler import NestedClassMDHandler
+    from PYME.localization.FitFactories import LatGaussFitFR
+    
+    md = NestedClassMDHandler()
+    md['voxelsize.x'] = .1
+    md['voxelsize.y'] = .1
+    md['voxelsize.z'] = .2
+    md['Camera.ReadNoise'] = 1.
+    md['Camera.NoiseFactor'] = 1.
+    md['Camera.ElectronsPerCount'] = 1.
+    md['Camera.TrueEMGain'] = 1.
+    md.tIndex = 0
+    
+    # include points near the edges so that we exercise the padded ROIs
+    points = [(20, 30), (40, 10), (2, 3), (61, 62), (32, 32)]
+    X, Y = np.mgrid[:64, :64]
+    im = 10. + sum([200*np.exp(-((X - x)**2 + (Y - y)**2)/(2*1.3**2)) for x, y in points])
+    im = np.random.RandomState(42).poisson(im).astype('f')[:, :, None]
+    
+    class Point(object):
+        def __init__(self, x, y):
+            self.x, self.y = x, y
+    
+    ofd = [Point(x, y) for x, y in points]
+    ff = LatGaussFitFR.GaussianFitFactory(im, md)
+    
+    single = np.hstack([ff.FromPoint(p.x, p.y) for p in ofd])
+    batched = ff.FromPoints(ofd)
+    
+    assert np.allclose(single['fitResults'].view('7f4')[:, :5], batched['fitResults'].view('7f4')[:, :5], rtol=1e-3)
+    assert np.allclose(single['fitError'].view('7f4'), batched['fitError'].view('7f4'), rtol=1e-2)
+    assert np.all(single['slicesUsed'] == batched['slicesUsed'])
+    assert np.all(batched['tIndex'] == 0)
+
+
 def test_InterpFitR_astigmatism():
     """Test the 3D interpolated fit by fitting some randomly generated events. The pass condition here is fairly
     loose, but should be sufficient to detect when the code has been broken"""
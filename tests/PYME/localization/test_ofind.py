@@ -0,0 +1,56 @@
+import numpy as np
+
+from PYME.localization import ofind
+
+
+def _identifier(points, shape=(64, 64)):
+    X, Y = np.mgrid[0:shape[0], 0:shape[1]]
+    im = np.zeros(shape, 'f')
+    for x, y, A in points:
+        im += A * np.exp(-((X - x) ** 2 + (Y - y) ** 2) / (2 * 1.5 ** 2))
+    
+    oi = ofind.ObjectIdentifier(im)
+    oi.filteredData = im
+    return oi
+
+
+def test_debounce():
+    # a bright and a dim point within the debounce radius, and an isolated point
+    oi = _identifier([(20, 20, 100), (22, 21, 50), (40, 40, 100)])
+    xs = np.array([22., 20., 40.])
+    ys = np.array([21., 20., 40.])
+    
+    xd, yd = oi._ObjectIdentifier__Debounce(xs, ys, 4)
+    
+    assert np.array_equal(xd, [20, 40])
+    assert np.array_equal(yd, [20, 40])
+
+
+def test_discard_clumped():
+    oi = _identifier([])
+    xs = np.array([20., 22., 40.])
+    ys = np.array([20., 21., 40.])
+    
+    xd, yd = oi._ObjectIdentifier__discardClumped(xs, ys, 4)
+    
+    assert np.array_equal(xd, [40])
+    assert np.array_equal(yd, [40])
+
+
+def test_bbox_centroids_match_per_object_sums():
+    from scipy import ndimage
+    
+    im = np.random.rand(64, 64).astype('f')
+    labels, n = ndimage.label(im > 0.7)
+    objSlices = ndimage.find_objects(labels)
+    
+    x, y, nPixels = ofind._bbox_centroids(im, objSlices)
+    
+    # the original per-object calculation - positions must be identical, not just close, as __Debounce truncates them
+    # to pixel indices
+    X, Y = np.mgrid[0:im.shape[0], 0:im.shape[1]]
+    for i, sl in enumerate(objSlices):
+        imO = im[sl]
+        assert x[i] == (X[sl]*imO).sum()/imO.sum()
+        assert y[i] == (Y[sl]*imO).sum()/imO.sum()
+        assert nPixels[i] == imO.size
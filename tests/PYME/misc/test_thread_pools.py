@@ -0,0 +1,40 @@
+import threading
+
+
+def test_parallel_map(monkeypatch):
+    from PYME.misc import thread_pools
+    monkeypatch.setattr(thread_pools, 'COMPUTE_THREADS', 4)
+    
+    def _thread(i):
+        return i, threading.current_thread(), thread_pools.in_pool()
+    
+    results = thread_pools.parallel_map(_thread, range(20))
+    assert [r[0] for r in results] == list(range(20))
+    assert all([r[2] for r in results])
+    assert not thread_pools.in_pool()
+
+
+def test_nested_parallel_map(monkeypatch):
+    """Parallel code calling parallel code should run the inner map serially, rather than deadlocking"""
+    from PYME.misc import thread_pools
+    monkeypatch.setattr(thread_pools, 'COMPUTE_THREADS', 4)
+    
+    def _outer(i):
+        outer_thread = threading.current_thread()
+        return thread_pools.parallel_map(lambda j: (i*j, threading.current_thread() is outer_thread), range(10))
+    
+    # more outer tasks than threads, so every thread is busy waiting on an inner map
+    results = thread_pools.parallel_map(_outer, range(3*len(thread_pools.get_pool()._pool)))
+    assert [[r[0] for r in res] for res in results] == [[i*j for j in range(10)] for i in range(len(results))]
+    assert all([all([r[1] for r in res]) for res in results])
+
+
+def test_named_pools():
+    from PYME.misc import thread_pools
+    
+    pool = thread_pools.get_pool('test-io', 2)
+    assert thread_pools.get_pool('test-io') is pool
+    assert pool is not thread_pools.get_pool()
+    
+    assert pool.apply(thread_pools.in_pool, ('test-io',))
+    assert not pool.apply(thread_pools.in_pool)
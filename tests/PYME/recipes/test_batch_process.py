@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+
+class _FlakyRecipe(object):
+    """Stand-in for a recipe which fails a given number of times on some inputs"""
+    outputs = set()
+
+    def __init__(self, failures):
+        self.namespace = {}
+        self.failures = dict(failures)
+        self.runs = []
+
+    def loadInput(self, filename, key='input'):
+        self.namespace[key] = filename
+
+    def execute(self):
+        fn = self.namespace['input']
+        self.runs.append(fn)
+        if self.failures.get(fn, 0) > 0:
+            self.failures[fn] -= 1
+            raise RuntimeError('flaky recipe')
+
+    def save(self, context={}):
+        pass
+
+
+def _read_log(output_dir):
+    with open(os.path.join(output_dir, 'bake_progress.log')) as f:
+        lines = f.readlines()
+
+    assert lines[0].startswith('#time')
+    # (inputs, status, attempt)
+    return [tuple(l.split('\t')[1:4]) for l in lines[1:]]
+
+
+def test_bake_retry(tmpdir):
+    from PYME.recipes import batchProcess
+
+    recipe = _FlakyRecipe({'b.h5': 1})
+    failed = batchProcess.bake(recipe, {'input': ['a.h5', 'b.h5', 'c.h5']}, str(tmpdir), num_procs=1, num_retries=1,
+                               prefetch=0)
+
+    assert failed == []
+    assert recipe.runs == ['a.h5', 'b.h5', 'c.h5', 'b.h5']
+    assert _read_log(str(tmpdir)) == [('a.h5', 'ok', '0'), ('b.h5', 'retrying', '0'), ('c.h5', 'ok', '0'),
+                                      ('b.h5', 'ok', '1')]
+
+
+def test_bake_failure(tmpdir):
+    from PYME.recipes import batchProcess
+
+    recipe = _FlakyRecipe({'b.h5': 2})
+    failed = batchProcess.bake(recipe, {'input': ['a.h5', 'b.h5']}, str(tmpdir), num_procs=1, num_retries=1,
+                               prefetch=0)
+
+    assert [f[0] for f in failed] == [{'input': 'b.h5'}]
+    assert 'flaky recipe' in failed[0][1]
+    assert _read_log(str(tmpdir)) == [('a.h5', 'ok', '0'), ('b.h5', 'retrying', '0'), ('b.h5', 'failed', '1')]
+
+
+def test_bake_recipe(tmpdir, monkeypatch):
+    from PYME.recipes import batchProcess
+
+    recipe = _FlakyRecipe({'b.h5': 2})
+    recipe_file = tmpdir.join('recipe.yaml')
+    recipe_file.write('')
+    monkeypatch.setattr(batchProcess.modules.ModuleCollection, 'fromYAML', classmethod(lambda cls, s: recipe))
+
+    failed = batchProcess.bake_recipe(str(recipe_file), {'input': ['a.h5', 'b.h5']}, str(tmpdir.join('output')),
+                                      num_procs=1)
+    assert [f[0] for f in failed] == [{'input': 'b.h5'}]
+
+
+@pytest.mark.parametrize('n_failures', [1, 2])
+def test_main_exit_status(n_failures, tmpdir, monkeypatch):
+    import matplotlib
+    from PYME.recipes import batchProcess
+
+    recipe = _FlakyRecipe({'b.h5': n_failures})
+    recipe.inputs = ['input']
+
+    recipe_file = tmpdir.join('recipe.yaml')
+    recipe_file.write('')
+    output_dir = str(tmpdir.join('output'))
+
+    monkeypatch.setattr(batchProcess.modules.ModuleCollection, 'fromYAML', classmethod(lambda cls, s: recipe))
+    monkeypatch.setattr(batchProcess.glob, 'glob', lambda pattern: ['a.h5', 'b.h5'])
+    monkeypatch.setattr(matplotlib, 'use', lambda *args, **kwargs: None)
+    monkeypatch.setattr('sys.argv', ['bakeshop', str(recipe_file), output_dir, '-n', '1', '--input', '*.h5'])
+
+    if n_failures > batchProcess.NUM_RETRIES:
+        with pytest.raises(SystemExit) as e:
+            batchProcess.main()
+        assert e.value.code == 1
+    else:
+        batchProcess.main()
+
+    assert _read_log(output_dir)[-1] == ('b.h5', 'ok' if n_failures == 1 else 'failed', '1')
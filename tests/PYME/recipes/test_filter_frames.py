@@ -0,0 +1,68 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def parallel(monkeypatch):
+    """Make sure frames are filtered in parallel, even on a single CPU machine"""
+    from PYME.misc import thread_pools
+    monkeypatch.setattr(thread_pools, 'COMPUTE_THREADS', 4)
+
+
+def test_filter_frames_order(parallel):
+    from PYME.recipes.base import _filter_frames
+    
+    data = np.random.rand(8, 10, 20, 2).astype('f')
+    
+    def _filter(frames, chanNum, frameNum):
+        # finish frames out of order
+        time.sleep(0.001*((7*frameNum) % 5))
+        return frames[0] + frameNum
+    
+    for c in range(2):
+        out = _filter_frames([data], _filter, c)
+        assert out.shape == (8, 10, 20)
+        assert np.allclose(out, data[:, :, :, c] + np.arange(20)[None, None, :])
+
+
+def test_filter_frames_depth(parallel):
+    from PYME.recipes.base import _filter_frames
+    
+    data = np.random.rand(8, 10, 20, 1).astype('f')
+    
+    def _filter(frames, chanNum, frameNum):
+        return np.dstack([frames[0], -frames[0], frameNum*np.ones_like(frames[0])])
+    
+    out = _filter_frames([data], _filter, 0)
+    assert out.shape == (8, 10, 60)
+    assert np.allclose(out[:, :, 0::3], data[:, :, :, 0])
+    assert np.allclose(out[:, :, 1::3], -data[:, :, :, 0])
+    assert np.all(out[:, :, 2::3] == np.arange(20)[None, None, :])
+
+
+def test_filter_not_parallel(parallel, monkeypatch):
+    """Filters which don't set _parallel_frames should be called one frame at a time, from the calling thread"""
+    from PYME.recipes import base
+    from PYME.IO.image import ImageStack
+    
+    monkeypatch.setattr(base, 'LAZY_FILTERS', False)
+    
+    calls = []
+    
+    class _Filter(base.Filter):
+        def applyFilter(self, data, chanNum, frNum, im):
+            calls.append((threading.current_thread(), chanNum, frNum))
+            return 2*data
+    
+    assert not _Filter._parallel_frames
+    
+    data = np.random.rand(8, 10, 20, 2).astype('f')
+    out = _Filter().filter(ImageStack(data))
+    
+    assert [c[1:] for c in calls] == [(c, i) for c in range(2) for i in range(20)]
+    assert all([c[0] is threading.current_thread() for c in calls])
+    for c in range(2):
+        assert np.allclose(out.data[:, :, :, c].squeeze(), 2*data[:, :, :, c])
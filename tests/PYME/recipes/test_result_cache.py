@@ -0,0 +1,154 @@
+import numpy as np
+import pytest
+
+
+class _Module(object):
+    """Minimal stand-in for a recipe module - the cache only needs get_params and the trait values"""
+    def __init__(self, **kwargs):
+        self.inputName = 'input'
+        self.outputName = 'output'
+        self.scale = 1.0
+        self.__dict__.update(kwargs)
+    
+    def get_params(self):
+        return ['inputName'], ['outputName'], ['scale']
+
+
+def test_data_hash():
+    from PYME.recipes import result_cache
+    from PYME.IO import tabular
+    
+    a = np.random.rand(100)
+    t = tabular.DictSource({'x': a, 'y': a.copy()})
+    
+    assert result_cache.data_hash(a) == result_cache.data_hash(a.copy())
+    assert result_cache.data_hash(a) != result_cache.data_hash(a + 1)
+    assert result_cache.data_hash(t) == result_cache.data_hash(tabular.DictSource({'x': a.copy(), 'y': a.copy()}))
+    assert result_cache.data_hash(t) != result_cache.data_hash(tabular.DictSource({'x': a, 'y': a + 1}))
+    assert result_cache.data_hash(object()) is None
+
+
+def test_data_hash_metadata(tmpdir):
+    from PYME.recipes import result_cache
+    from PYME.IO import tabular, MetaDataHandler
+    from PYME.IO.image import ImageStack
+    
+    a = np.random.rand(100)
+    t0, t1 = tabular.DictSource({'x': a}), tabular.DictSource({'x': a})
+    t0.mdh = MetaDataHandler.NestedClassMDHandler()
+    t1.mdh = MetaDataHandler.NestedClassMDHandler()
+    t0.mdh['StackSettings.FramesPerStep'] = 10
+    t1.mdh['StackSettings.FramesPerStep'] = 20
+    assert result_cache.data_hash(t0) != result_cache.data_hash(t1)
+    
+    # same file loaded twice, so only the metadata differs
+    fn = str(tmpdir.join('im.npy'))
+    np.save(fn, np.random.rand(10, 10, 2).astype('f'))
+    im0, im1 = ImageStack(filename=fn, haveGUI=False), ImageStack(filename=fn, haveGUI=False)
+    assert result_cache.data_hash(im0) == result_cache.data_hash(im1)
+    im0.mdh['voxelsize.x'] = 0.1
+    im1.mdh['voxelsize.x'] = 0.2
+    assert result_cache.data_hash(im0) != result_cache.data_hash(im1)
+
+
+def test_module_key():
+    from PYME.recipes import result_cache
+    
+    k = result_cache.module_key(_Module(), {'inputName': 'abc'})
+    assert k == result_cache.module_key(_Module(), {'inputName': 'abc'})
+    assert k != result_cache.module_key(_Module(scale=2.0), {'inputName': 'abc'})
+    assert k != result_cache.module_key(_Module(), {'inputName': 'abd'})
+    assert result_cache.module_key(_Module(), {'inputName': None}) is None
+
+
+def test_result_cache(tmpdir):
+    from PYME.recipes import result_cache
+    from PYME.IO import tabular
+    
+    cache = result_cache.ResultCache(str(tmpdir), max_size_mb=0.1)
+    mod = _Module()
+    t = tabular.DictSource({'x': np.arange(1000.)})
+    
+    assert not cache.load(mod, 'a'*40, {})
+    cache.store(mod, 'a'*40, {'output': t})
+    
+    # outputs are mapped back onto the current output names
+    ns = {}
+    assert cache.load(_Module(outputName='other'), 'a' * 40, ns)
+    assert np.all(ns['other']['x'] == t['x'])
+    
+    # each entry is ~8kB, so we should start evicting the least recently used once we have stored ~12 of them
+    for i in range(20):
+        cache.store(mod, '%040d' % i, {'output': t})
+    
+    stats = cache.stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1
+    assert stats['evictions'] > 0
+    assert stats['size'] <= 0.1*1024*1024
+    assert not cache.load(mod, '%040d' % 0, {})
+    assert cache.load(mod, '%040d' % 19, {})
+
+
+def _counting_modules():
+    from PYME.recipes.base import ModuleBase
+    from PYME.recipes.traits import Input, Output, Float
+    from PYME.IO import tabular
+    
+    class _Scale(ModuleBase):
+        input = Input('input')
+        scale = Float(1.0)
+        output = Output('output')
+        n_executions = 0
+        
+        def execute(self, namespace):
+            type(self).n_executions += 1
+            namespace[self.output] = tabular.DictSource({'x': self.scale*namespace[self.input]['x']})
+    
+    class _Upstream(_Scale):
+        n_executions = 0
+    
+    class _Downstream(_Scale):
+        n_executions = 0
+    
+    return _Upstream, _Downstream
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_execute_downstream_change(use_cache, tmpdir, monkeypatch):
+    """Changing a downstream parameter should not re-execute the upstream module"""
+    from PYME.recipes import result_cache
+    from PYME.recipes.base import ModuleCollection
+    from PYME.IO import tabular
+    
+    monkeypatch.setattr(result_cache, 'CACHE_ENABLED', use_cache)
+    monkeypatch.setattr(result_cache, '_cache', result_cache.ResultCache(str(tmpdir)))
+    
+    _Upstream, _Downstream = _counting_modules()
+    
+    rec = ModuleCollection()
+    up = _Upstream(rec, input='input', output='intermediate', scale=2.0)
+    down = _Downstream(rec, input='intermediate', output='output', scale=3.0)
+    rec.modules = [up, down]
+    
+    inp = tabular.DictSource({'x': np.arange(10.)})
+    out = rec.execute(input=inp)
+    assert np.all(out['x'] == 6*inp['x'])
+    assert (_Upstream.n_executions, _Downstream.n_executions) == (1, 1)
+    
+    down.scale = 5.0
+    out = rec.execute()
+    assert np.all(out['x'] == 10*inp['x'])
+    assert (_Upstream.n_executions, _Downstream.n_executions) == (1, 2)
+    
+    if use_cache:
+        # a fresh run of the recipe should be served entirely from the cache ...
+        rec.namespace.clear()
+        out = rec.execute(input=tabular.DictSource({'x': np.arange(10.)}))
+        assert np.all(out['x'] == 10*inp['x'])
+        assert (_Upstream.n_executions, _Downstream.n_executions) == (1, 2)
+        
+        # ... unless the module opts out of caching
+        monkeypatch.setattr(_Upstream, '_cache_results', False)
+        rec.namespace.clear()
+        rec.execute(input=inp)
+        assert _Upstream.n_executions == 2
@@ -0,0 +1,89 @@
+import os
+import numpy as np
+import pytest
+
+cherrypy = pytest.importorskip('cherrypy')
+
+
+def _make_server(tmpdir):
+    from PYME.Analysis.tile_pyramid import ImagePyramid
+    from PYME.tileviewer.tileviewer import TileServer
+    
+    P = ImagePyramid(str(tmpdir), 32)
+    P.add_base_tile(0, 0, 100*np.random.rand(50, 50), np.ones((50, 50)))
+    P.update_pyramid()
+    P._imgs.flush()
+    
+    with open(os.path.join(str(tmpdir), 'metadata.json'), 'w') as f:
+        f.write(P.mdh.to_JSON())
+        
+    return TileServer(str(tmpdir), prerender_levels=0)
+
+def _request(server, headers=None, **kwargs):
+    """Call get_tile as if from a request with the given headers, returning (status, response headers, body)"""
+    from cherrypy import _cprequest
+    from cherrypy.lib import httputil
+    
+    cherrypy.serving.request = _cprequest.Request(httputil.Host('127.0.0.1', 80), httputil.Host('127.0.0.1', 1234))
+    cherrypy.serving.request.method = 'GET'
+    cherrypy.serving.request.headers = httputil.HeaderMap(headers or {})
+    cherrypy.serving.response = _cprequest.Response()
+    
+    try:
+        body = server.get_tile(**kwargs)
+    except cherrypy.HTTPRedirect as e:
+        return e.status, cherrypy.serving.response.headers, None
+    except cherrypy.HTTPError as e:
+        return e.status, cherrypy.serving.response.headers, None
+    
+    return 200, cherrypy.serving.response.headers, body
+
+
+def test_get_tile_etag(tmpdir):
+    server = _make_server(tmpdir)
+    
+    status, headers, body = _request(server, layer=0, x=0, y=0, fmt='raw')
+    assert status == 200
+    assert len(body) == 32*32
+    etag = headers['ETag']
+    
+    # the client already has this version
+    status, _, _ = _request(server, {'If-None-Match': etag}, layer=0, x=0, y=0, fmt='raw')
+    assert status == 304
+    
+    # a stale ETag must get the new tile, even if the tile looks unmodified by date
+    status, _, body = _request(server, {'If-None-Match': '"stale"', 'If-Modified-Since': headers['Last-Modified']},
+                               layer=0, x=0, y=0, fmt='raw')
+    assert status == 200
+    assert len(body) == 32*32
+    
+    # without an ETag, fall back on the modification date
+    status, _, _ = _request(server, {'If-Modified-Since': headers['Last-Modified']}, layer=0, x=0, y=0, fmt='raw')
+    assert status == 304
+    
+    
+def test_get_tile_missing(tmpdir):
+    server = _make_server(tmpdir)
+    
+    status, _, _ = _request(server, layer=0, x=20, y=20)
+    assert status == 404
+    
+    status, _, _ = _request(server, layer=0, x=0, y=0, fmt='jpeg')
+    assert status == 400
+
+
+def test_sqlite_tile_version(tmpdir):
+    from PYME.Analysis.tile_pyramid import SqliteTileIO
+    
+    io = SqliteTileIO(str(tmpdir))
+    assert io.tile_version(0, 0, 0) is None
+    
+    io.save_tile(0, 0, 0, np.ones((8, 8)))
+    v0 = io.tile_version(0, 0, 0)
+    assert v0 is not None
+    assert io.tile_version(0, 0, 0) == v0
+    assert io.tile_version(0, 1, 0) is None
+    
+    io.delete_tile(0, 0, 0)
+    io.save_tile(0, 0, 0, 2*np.ones((8, 8)))
+    assert io.tile_version(0, 0, 0) != v0